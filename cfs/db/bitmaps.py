@@ -0,0 +1,341 @@
+from django.db import connection, transaction
+from time import time
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+###
+### An in-process bitmap index for the faceted browse: for each key property (and each
+### collection), the set of variables which have it (or are in it), so that a selection
+### of several facets is answered by combining sets in memory rather than by one join
+### per facet. The index is built (with NumPy, from three queries) the first time it is
+### used, and kept up to date with changes made in this process (see the receivers in
+### cfs.models, VariableInterface.bulk_create and CollectionInterface.bulk_add_variables).
+###
+### To know whether anything else has changed, we keep (with SQLite) a version table
+### which triggers bump for every row added to or removed from the variable and membership
+### tables, and every change of a variable's key properties, by whatever process or
+### connection. Each change we follow here adds what we know it did to the version we
+### expect, so a version which is not what we expect means someone else has been at work,
+### the index is stale, and VariableInterface uses SQL until it has been rebuilt. (Without
+### SQLite there is no version table, and SQL is always used.)
+###
+
+VERSION_TABLE = 'cfs_bitmap_version'
+
+_ready = {}
+
+
+def available():
+    """
+    Is there (or can we make) a version table with its triggers in the current database?
+    (This is normally made along with the database, see cfs.db.standalone. If we have to
+    make it inside a transaction, which might yet be rolled back, we check again next time.)
+    """
+    from cfs.models import Collection, Variable
+    name = connection.settings_dict['NAME']
+    if name in _ready:
+        return _ready[name]
+    if connection.vendor != 'sqlite':
+        _ready[name] = False
+        return False
+    bump = f'BEGIN UPDATE {VERSION_TABLE} SET version = version + 1 WHERE id = 1; END'
+    variables, members = Variable._meta.db_table, Collection.variables.through._meta.db_table
+    statements = [
+        f'CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (id INTEGER PRIMARY KEY, version INTEGER NOT NULL)',
+        f'INSERT OR IGNORE INTO {VERSION_TABLE} (id, version) VALUES (1, 0)',
+        # (setting key properties to null only happens as a variable is deleted)
+        f'CREATE TRIGGER IF NOT EXISTS {VERSION_TABLE}_kp AFTER UPDATE OF key_properties_id ON {variables} '
+        f'WHEN NEW.key_properties_id IS NOT NULL AND NEW.key_properties_id IS NOT OLD.key_properties_id {bump}']
+    for table in [variables, members]:
+        for event in ['INSERT', 'DELETE']:
+            statements.append(f'CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version '
+                              f'AFTER {event} ON {table} {bump}')
+    statements.append(f'CREATE TRIGGER IF NOT EXISTS {members}_update_version AFTER UPDATE ON {members} {bump}')
+    try:
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+    except Exception as e:
+        logger.warning(f'Facet selections will not use the bitmap index ({e})')
+        _ready[name] = False
+        return False
+    if not connection.in_atomic_block:
+        _ready[name] = True
+    return True
+
+
+def _version():
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT version FROM {VERSION_TABLE} WHERE id = 1')
+        return cursor.fetchone()[0]
+
+
+class Bitset:
+    """
+    A set of (non negative integer) ids, held as a sorted array when sparse, and as packed
+    bits (as from np.packbits, so id 0 is the high bit of the first byte) when that is smaller.
+    """
+    __slots__ = ('ids', 'bits')
+
+    def __init__(self, ids=None, bits=None):
+        self.ids, self.bits = ids, bits
+
+    @classmethod
+    def of(cls, ids, presorted=False):
+        """ A bitset for an array of ids (sorted and unique if presorted) """
+        ids = np.asarray(ids, dtype=np.int64)
+        if not presorted:
+            ids = np.unique(ids)
+        return cls._compact(ids=ids)
+
+    @classmethod
+    def _compact(cls, ids=None, bits=None):
+        """ Choose the smaller representation """
+        if bits is not None:
+            n = int(np.count_nonzero(np.unpackbits(bits)))
+            if n*4 >= len(bits):
+                return cls(bits=bits)
+            ids = np.flatnonzero(np.unpackbits(bits))
+        if len(ids) and len(ids)*4 > (int(ids[-1])+8)//8:
+            mask = np.zeros(int(ids[-1])+1, dtype=bool)
+            mask[ids] = True
+            return cls(bits=np.packbits(mask))
+        return cls(ids=ids.astype(np.uint32))
+
+    def _bits(self, nbytes):
+        """ Packed bits, at least nbytes long """
+        if self.bits is not None:
+            if len(self.bits) >= nbytes:
+                return self.bits
+            return np.concatenate([self.bits, np.zeros(nbytes - len(self.bits), dtype=np.uint8)])
+        mask = np.zeros(nbytes*8, dtype=bool)
+        mask[self.ids] = True
+        return np.packbits(mask)
+
+    def _nbytes(self):
+        if self.bits is not None:
+            return len(self.bits)
+        return (int(self.ids[-1])+8)//8 if len(self.ids) else 0
+
+    def contains(self, ids):
+        """ A boolean array saying which of an array of ids are in the set """
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.ids is not None:
+            return np.isin(ids, self.ids, assume_unique=True)
+        inside = ids < len(self.bits)*8
+        found = np.zeros(len(ids), dtype=bool)
+        i = ids[inside]
+        found[inside] = (self.bits[i >> 3] >> (7 - (i & 7))) & 1 == 1
+        return found
+
+    def to_ids(self):
+        """ The ids, in order """
+        if self.ids is not None:
+            return self.ids.astype(np.int64)
+        return np.flatnonzero(np.unpackbits(self.bits))
+
+    def __len__(self):
+        if self.ids is not None:
+            return len(self.ids)
+        return int(np.count_nonzero(np.unpackbits(self.bits)))
+
+    def __and__(self, other):
+        if self.ids is not None:
+            return Bitset(ids=self.ids[other.contains(self.ids)])
+        if other.ids is not None:
+            return Bitset(ids=other.ids[self.contains(other.ids)])
+        n = min(len(self.bits), len(other.bits))
+        return Bitset._compact(bits=self.bits[:n] & other.bits[:n])
+
+    def __or__(self, other):
+        if self.ids is not None and other.ids is not None:
+            return Bitset._compact(ids=np.union1d(self.ids, other.ids))
+        n = max(self._nbytes(), other._nbytes())
+        return Bitset._compact(bits=self._bits(n) | other._bits(n))
+
+    def __sub__(self, other):
+        if self.ids is not None:
+            return Bitset(ids=self.ids[~other.contains(self.ids)])
+        n = self._nbytes()
+        return Bitset._compact(bits=self.bits & ~other._bits(n)[:n])
+
+    @classmethod
+    def union(cls, bitsets):
+        result = cls(ids=np.zeros(0, dtype=np.uint32))
+        for b in bitsets:
+            result = result | b
+        return result
+
+
+EMPTY = Bitset(ids=np.zeros(0, dtype=np.uint32))
+
+
+def _groups(keys, values):
+    """ Split values (an array aligned with keys) into sorted, unique, id arrays by key """
+    if len(keys) == 0:
+        return {}
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    edges = np.flatnonzero(np.diff(keys)) + 1
+    groups = {}
+    for key, ids in zip(keys[np.concatenate([[0], edges])], np.split(values, edges)):
+        groups[int(key)] = Bitset.of(np.unique(ids), presorted=True)
+    return groups
+
+
+class BitmapIndex:
+    """
+    Bitsets of the variables with each key property and in each collection.
+    """
+    # how long to use SQL for, once the index is stale, before rebuilding it (seconds)
+    REBUILD_INTERVAL = 60
+    # selections with more variables than this are left to SQL (there would be too many
+    # ids to hand back to the database, and such selections are not selective anyway)
+    MAX_IDS = 20000
+
+    def __init__(self):
+        self.database = None
+        self.properties, self.collections = {}, {}
+        self.removed = set()
+        self.version = None
+        self.stale = False
+        self.built = 0
+        self.builds = 0
+
+    def build(self):
+        """ (Re)build the index from the database """
+        from cfs.models import Collection, Variable, VariablePropertySet
+        started = time()
+        # in one transaction, so the version goes with what we read
+        with transaction.atomic():
+            version = _version()
+            variables = np.array(Variable.objects.filter(key_properties__isnull=False).values_list(
+                'id', 'key_properties_id'), dtype=np.int64).reshape(-1, 2)
+            members = np.array(VariablePropertySet.properties.through.objects.values_list(
+                'variablepropertyset_id', 'variableproperty_id'), dtype=np.int64).reshape(-1, 2)
+            memberships = np.array(Collection.variables.through.objects.values_list(
+                'collection_id', 'variable_id'), dtype=np.int64).reshape(-1, 2)
+        # each (set, property) row stands for all the variables with that set
+        variables = variables[np.argsort(variables[:, 1], kind='stable')]
+        starts = np.searchsorted(variables[:, 1], members[:, 0], 'left')
+        lengths = np.searchsorted(variables[:, 1], members[:, 0], 'right') - starts
+        rows = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        self.properties = _groups(np.repeat(members[:, 1], lengths), variables[rows, 0])
+        self.collections = _groups(memberships[:, 0], memberships[:, 1])
+        self.removed = set()
+        self.database = connection.settings_dict['NAME']
+        self.version = version
+        self.stale = False
+        self.built = time()
+        self.builds += 1
+        logger.info(f'Built bitmap index of {len(variables)} variables in {time()-started:.2f}s')
+
+    def ready(self):
+        """
+        Is the index up to date (building it if it has never been built, and rebuilding
+        it if it has been stale for long enough)?
+        """
+        if not available():
+            return False
+        if self.database != connection.settings_dict['NAME']:
+            self.build()
+            return True
+        if not self.stale and _version() != self.version:
+            logger.info('Bitmap index is stale, using SQL')
+            self.stale = True
+        if self.stale and time() - self.built > self.REBUILD_INTERVAL:
+            self.build()
+        return not self.stale
+
+    def lookup(self, list_of_keysets, collections=()):
+        """
+        The ids of the variables with (any of) the properties in each of the keysets, and
+        in any of the collections, or None if that should be found with SQL instead (if
+        the index is stale, or if there are no constraints, or too many answers).
+        : list_of_keysets : list of lists of property ids
+        : collections : list of collection ids
+        """
+        if not (any(list_of_keysets) or collections) or not self.ready():
+            return None
+        sets = [Bitset.union(self.properties.get(int(p), EMPTY) for p in keyset)
+                for keyset in list_of_keysets if keyset]
+        if collections:
+            sets.append(Bitset.union(self.collections.get(int(c), EMPTY) for c in collections))
+        result = sets[0]
+        for s in sets[1:]:
+            result = result & s
+        ids = result.to_ids()
+        if self.removed:
+            ids = ids[~np.isin(ids, list(self.removed))]
+        if len(ids) > self.MAX_IDS:
+            return None
+        return ids.tolist()
+
+    # Changes made in this process. These are applied when (and if) they are committed,
+    # along with the number of rows they changed, as counted by the version triggers.
+
+    def _when_committed(self, change):
+        if self.database is not None and not self.stale:
+            transaction.on_commit(change)
+
+    def variables_added(self, variables):
+        """ Add new variables (with their key property sets) """
+        def change():
+            from cfs.models import VariablePropertySet
+            self.version += len(variables)
+            ids = np.array([[v.pk, v.key_properties_id] for v in variables
+                            if v.key_properties_id is not None], dtype=np.int64).reshape(-1, 2)
+            if len(ids) and self.removed.intersection(ids[:, 0].tolist()):
+                # an id has been reused, and we don't know where the old one was
+                self.stale = True
+                return
+            members = VariablePropertySet.properties.through.objects.filter(
+                variablepropertyset_id__in=set(ids[:, 1].tolist())).values_list(
+                'variablepropertyset_id', 'variableproperty_id')
+            added = {}
+            for set_id, property_id in members:
+                added.setdefault(property_id, []).append(ids[ids[:, 1] == set_id, 0])
+            for property_id, new in added.items():
+                self.properties[property_id] = self.properties.get(property_id, EMPTY) | Bitset.of(
+                    np.concatenate(new))
+        if variables:
+            self._when_committed(change)
+
+    def variables_removed(self, ids):
+        """ Forget variables which have been deleted """
+        def change():
+            # (a variable deleted along with its file can be reported twice)
+            gone = set(ids) - self.removed
+            self.version += len(gone)
+            self.removed.update(gone)
+        if ids:
+            self._when_committed(change)
+
+    def memberships_changed(self, memberships, sign):
+        """
+        Record variables joining (sign=1) or leaving (sign=-1) collections
+        : memberships : list of (collection id, variable id) pairs, all of which change
+        """
+        def change():
+            self.version += len(memberships)
+            by_collection = {}
+            for c, v in memberships:
+                by_collection.setdefault(c, []).append(v)
+            for c, vids in by_collection.items():
+                current = self.collections.get(c, EMPTY)
+                if sign > 0:
+                    self.collections[c] = current | Bitset.of(vids)
+                else:
+                    self.collections[c] = current - Bitset.of(vids)
+        memberships = list(memberships)
+        if memberships:
+            self._when_committed(change)
+
+    def invalidate(self):
+        """ Something has changed which we can't follow """
+        if self.database is not None:
+            transaction.on_commit(lambda: setattr(self, 'stale', True))
+
+
+index = BitmapIndex()
@@ -1,7 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import urlsplit
 import h5netcdf as h5
 import numpy as np
 import uuid, io
+import struct
+import zlib
 from time import time
 import hashlib
 import logging
@@ -19,29 +23,107 @@ def bounds_range(bounds_array):
     print('Bounds range ',x,y)
     return x[:,0],y[:,-1]
 
-def numpy2db(an_array):
+###
+### Manifest bounds are stored in a compact versioned binary format: a short
+### header (magic, version, codec, dtype and shape) followed by the little-endian
+### array buffer, optionally compressed. Uncompressed blobs are decoded with
+### np.frombuffer as a (read-only) view on the blob itself, without copying.
+### Blobs written by earlier versions with np.save are still readable, and
+### ManifestInterface.migrate_bounds rewrites them.
+###
+
+BOUNDS_MAGIC = b'CFSB'
+BOUNDS_VERSION = 1
+# codecs
+RAW, ZLIB, DELTA = 0, 1, 2
+CODECS = {None: RAW, 'zlib': ZLIB, 'delta': DELTA}
+_HEADER = struct.Struct('<4sBBB')
+
+def numpy2db(an_array, compression=None):
     """
     Take a numpy array and serialise it for storage in a database
     :param an_array: Numpy array
     :type an_array: np.array type
+    :param compression: None, 'zlib', or 'delta' (zlib compression of the differences
+        between successive values, which suits regular time steps). Compressed blobs are
+        smaller, but cannot be decoded without copying.
     :returns: binary blob for storage in database
     """
-    binary_stream = io.BytesIO()
-    np.save(binary_stream, an_array)
-    result = binary_stream.getvalue()
-    return result
+    if compression not in CODECS:
+        raise ValueError(f'Unknown bounds compression {compression}')
+    an_array = np.asarray(an_array)
+    if an_array.dtype.kind not in 'biuf':
+        raise ValueError(f'Cannot store {an_array.dtype} arrays in the database')
+    an_array = np.ascontiguousarray(an_array, dtype=an_array.dtype.newbyteorder('<'))
+    codec = CODECS[compression]
+    dtype = an_array.dtype.str.encode('ascii')
+    header = (_HEADER.pack(BOUNDS_MAGIC, BOUNDS_VERSION, codec, an_array.ndim)
+              + struct.pack(f'<B{len(dtype)}s{an_array.ndim}Q', len(dtype), dtype, *an_array.shape))
+    if codec == RAW:
+        return header + an_array.tobytes()
+    if codec == DELTA:
+        # difference the values as unsigned integers, which (with wrap around)
+        # is exactly reversible for any dtype
+        ints = an_array.reshape(-1).view(f'<u{an_array.itemsize}')
+        an_array = np.diff(ints, prepend=ints.dtype.type(0))
+    return header + zlib.compress(an_array.tobytes())
 
 def db2numpy(blob):
     """
     Take a binary blob stored in the database and return it to a numpy array
     :param blob: blob of data
-    :type blob: sequence of bytes produced by numpy2db
-    :returns: a numpy array
+    :type blob: sequence of bytes produced by numpy2db (now, or by earlier versions)
+    :returns: a numpy array (read-only if uncompressed, as it shares memory with the blob)
+    """
+    blob = memoryview(blob)
+    if blob[:len(BOUNDS_MAGIC)] != BOUNDS_MAGIC:
+        # written with np.save by earlier versions
+        binary_stream = io.BytesIO(blob)
+        binary_stream.seek(0)
+        nparray = np.load(binary_stream)
+        return nparray
+    magic, version, codec, ndim = _HEADER.unpack_from(blob)
+    if version > BOUNDS_VERSION:
+        raise ValueError(f'Bounds encoded with unknown version {version}')
+    offset = _HEADER.size
+    ldtype = blob[offset]
+    dtype = np.dtype(bytes(blob[offset+1:offset+1+ldtype]).decode('ascii'))
+    offset += 1 + ldtype
+    shape = struct.unpack_from(f'<{ndim}Q', blob, offset)
+    offset += 8*ndim
+    if codec == RAW:
+        return np.frombuffer(blob, dtype=dtype, offset=offset).reshape(shape)
+    data = np.frombuffer(zlib.decompress(blob[offset:]), dtype=f'<u{dtype.itemsize}')
+    if codec == DELTA:
+        data = np.cumsum(data, dtype=data.dtype)
+    return data.view(dtype).reshape(shape)
+
+def is_legacy_blob(blob):
+    """ True if blob was written by an earlier version of numpy2db """
+    return blob is not None and bytes(blob[:len(BOUNDS_MAGIC)]) != BOUNDS_MAGIC
+
+def blob_compression(blob):
+    """
+    The compression used for a blob written by numpy2db (so that related
+    bounds can be written the same way, and compared byte for byte).
     """
-    binary_stream = io.BytesIO(blob)
-    binary_stream.seek(0)
-    nparray = np.load(binary_stream)
-    return nparray
+    if blob is None or is_legacy_blob(blob):
+        return None
+    codec = _HEADER.unpack_from(memoryview(blob))[2]
+    return {v: k for k, v in CODECS.items()}[codec]
+
+def bounds_hash(blob, units, calendar):
+    """
+    A hash of manifest bounds (as stored by numpy2db, in any encoding, or None)
+    along with their units and calendar, for finding identical manifests.
+    """
+    hasher = hashlib.sha256(f'{units}|{calendar}|'.encode('utf-8'))
+    if blob is not None:
+        bounds = db2numpy(blob)
+        bounds = np.ascontiguousarray(bounds, dtype=bounds.dtype.newbyteorder('<'))
+        hasher.update(f'{bounds.dtype.str}{bounds.shape}|'.encode('utf-8'))
+        hasher.update(bounds.data)
+    return hasher.hexdigest()
 
 def consistent_hash(mylist):
     """ 
@@ -60,52 +142,110 @@ def cf_cells_overlap(value0, value1, units=None):
         "le", value1, units=units, attr="lower_bounds"
     )
 
-def get_quark_field(instance, start_date, end_date):
+def _to_units(date, units):
+    """ The value of a date (a cf.Data instance) in units (a cf.Units instance) """
+    date = date.copy()
+    date.Units = units
+    return date.array.item()
+
+def get_quark_range(instance, start_date, end_date):
     """ Given a CFS manifest field (i.e. an instance of the Manifest class 
-    found in the django models.py) and a pair of bounding dates, return
-    a CF field instance with the information needed to construct a 
-    subspace manifest.
+    found in the django models.py) and a pair of bounding dates, find
+    the fragments which overlap the dates, and their bounds. This is
+    done directly on the manifest bounds, which are in time order.
     : instance : A CFS manifest instance
     : start_date : A date in a cf.Data instance
     : end_date : A date in a cf.Data instance.
-    : output : A CF field instance with the correct bounds, and 
-    a set of fragment ids in the field data.
+    : output : A tuple (start, stop, bounds) where the fragments from 
+    position start to stop-1 overlap the dates, and bounds are their bounds.
     """
-
-    fld = cf.Field(properties={'long_name':'fragments'})
-    
-    fragments = np.array([f.id for f in instance.fragments.files.all()])
-    T_axis= fld.set_construct(cf.DomainAxis(fragments.size))
-    fld.set_data(fragments, axes=T_axis)
-
     bounds = db2numpy(instance.bounds)
-   
-    timedata = np.mean(bounds, axis=1)
-    
-    dimT = cf.DimensionCoordinate(properties={'standard_name':'time',
-                    'units':cf.Units(instance.units,calendar=instance.calendar)},
-                data = timedata,
-                bounds = cf.Bounds(data=bounds)
-                )
-    left, right = bounds_range(dimT.bounds)
-    if start_date < left or end_date > right:
+    units = cf.Units(instance.units, calendar=instance.calendar)
+    start, end = _to_units(start_date, units), _to_units(end_date, units)
+    left, right = bounds[0, 0], bounds[-1, 1]
+    if start < left or end > right:
         raise ValueError(f'Cannot find a quark manifest: Dates {start_date},{end_date} not within {left}{right}')
-    
-    nf, nt = len(fragments), len(timedata)
-    logging.debug(f'Creating time dimension for {nf} fragments with {nt} time entries')
+    # cells which overlap have upper bound >= start and lower bound <= end
+    first = int(np.searchsorted(bounds[:, 1], start, side='left'))
+    stop = int(np.searchsorted(bounds[:, 0], end, side='right'))
+    if first >= stop:
+        raise ValueError(f'Cannot find a quark manifest: No fragments between {start_date} and {end_date}')
+    logger.debug(f'Quark uses fragments {first} to {stop-1} of {len(bounds)}')
+    return first, stop, bounds[first:stop]
+
+
+class FragmentAccessor:
+    """
+    The protocol for tools used during fragment handling to find out
+    about fragment files (see PosixAccessor).
+    Subclasses need only implement _stat. Results are cached on the
+    instance, so one accessor can be shared by all the manifests (and
+    files) in an ingest, and batches of files are looked up concurrently,
+    which matters on parallel file systems where each lookup is slow.
+    """
+    def __init__(self, workers=16):
+        """
+        : workers : number of threads used to look up batches of files
+        """
+        self.workers = workers
+        self.known_files = {}
+
+    def _stat(self, path):
+        """
+        Return the size of the file at path, raising FileNotFoundError
+        if it does not exist.
+        """
+        raise NotImplementedError
+
+    def _lookup(self, path):
+        try:
+            return self._stat(path)
+        except FileNotFoundError:
+            return None
+
+    def get_size(self, path):
+        """ The size of the file at path, or None if it does not exist """
+        if path not in self.known_files:
+            self.known_files[path] = self._lookup(path)
+        return self.known_files[path]
+
+    def get_sizes(self, paths):
+        """
+        Return a dictionary of sizes (None for files which do not exist)
+        for all of paths, looking up any we do not already know concurrently.
+        """
+        wanted = [p for p in dict.fromkeys(paths) if p not in self.known_files]
+        if self.workers > 1 and len(wanted) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(wanted))) as pool:
+                self.known_files.update(zip(wanted, pool.map(self._lookup, wanted)))
+        else:
+            self.known_files.update((p, self._lookup(p)) for p in wanted)
+        return {p: self.known_files[p] for p in paths}
+
+    def exists(self, path):
+        return self.get_size(path) is not None
 
-    if nf != nt:
-      
-        raise RuntimeError(
-            f'Number of of manifest fragments ({nf}) not equal to time data length ({nt}).')
-   
-    fld.set_construct(dimT, axes=T_axis)
-    print('Subspacing using cellwi to ',start_date, end_date)
 
-    quark = fld.subspace(time=cf_cells_overlap(start_date, end_date))
-    dimT = quark.dimension_coordinate('T')
-    return quark, bounds_range(dimT.bounds)
+class PosixAccessor(FragmentAccessor):
+    """ 
+    This class is used within the fragment handling
+    to find the size (and optionally, checksum, of any 
+    files which are accessible at fragment ingestion 
+    """
+    def  __init__(self, checksum_method=None, workers=16):
+        super().__init__(workers=workers)
+        self.checksum_method = checksum_method
+        if self.checksum_method is not None:
+            raise NotImplementedError('No support yet for checksums in PosixAccessor')
+
+    def _stat(self, path):
+        # cf-python reports fragments as file: URIs
+        if path.startswith('file:'):
+            path = urlsplit(path).path
+        return Path(path).stat().st_size
 
+    # the original name for get_size
+    get = FragmentAccessor.get_size
 
 
 class CFAManifest:
@@ -121,7 +261,7 @@ class CFAManifest:
         available and a tool for getting fragment file size, if available.
         : uuid : parent file tracking id
         : accessor : Class instance of tool that can do this.
-                     e.g. PosixAccessor from the posix.py in plugins
+                     e.g. PosixAccessor
         """
         self.bounds = None 
         self._bounds_ncvar = None 
@@ -132,10 +272,11 @@ class CFAManifest:
         self.parent_uuid = uuid
         self.manikey = None
 
-    def add_fragment(self, file_path):
+    def add_fragment(self, file_path, size=None):
         """ 
         Add fragment via file_path.
         For the moment I'm not handling multiple fragments. 
+        : size : the size of the file, if already known
         """
         if file_path in self.fragments:
             raise ValueError('Attempt to add existing fragment into manifest')
@@ -147,9 +288,19 @@ class CFAManifest:
                 fragment['base'] = base
         fragment['name'] = name
         fragment['path'] = file_path
-        if self.accessor:
-            fragment['size'] = self.accessor.get_size(file_path)
+        if size is None and self.accessor:
+            size = self.accessor.get_size(file_path)
+        fragment['size'] = size
         self.fragments[file_path] = fragment
+
+    def add_fragments(self, file_paths):
+        """
+        Add fragments for all of file_paths, looking up their
+        sizes in one batch if we have an accessor.
+        """
+        sizes = self.accessor.get_sizes(file_paths) if self.accessor else {}
+        for f in file_paths:
+            self.add_fragment(f, size=sizes.get(f))
     def get_dbdict(self):
         """ 
         Return a dictionary suitable for uploading
@@ -194,14 +345,17 @@ class CFAhandler:
     so that these fields can be matched to the manifests
     stored in the known manifest directory.
     """
-    def __init__(self, expected_fields, accessor=None):
+    def __init__(self, expected_fields, accessor=None, cfa_file=None):
         """ Opens the aggregation file for further parsing.
         We need to cover the situation where the variables of the 
         aggregation use different fragment sets with differing bounds.
         We want to avoid file and variable handling if we can.
         : expected_fields : total number of fields in file 
+        : accessor : optional FragmentAccessor used to find fragment sizes
+        : cfa_file : the aggregation file, if known (otherwise we find it from
+                     the first field)
         """
-        self.dataset = None
+        self.reader = None if cfa_file is None else CFAReader(cfa_file)
         self.known_manifests = {}
         self.expected = expected_fields
         self.parsed = 0
@@ -219,17 +373,15 @@ class CFAhandler:
         #FIXME: Add tracking id
         #FIXME: All this file handling is brittle. Help David!
         self.arrived_at = time()
-        # at the moment we need to do it from the field, so we do get the CFA file
-        # in the future, we can maybe use field.data.get_filenames since we 
-        # have access to this filename via other routes.
-        files =  field.get_filenames()
-        if self.dataset is None:
-            cfa_file = [f for f in files if Path(f).suffix == '.cfa'][0]
-            self.dataset = h5.File(cfa_file,'r')
+        if self.reader is None:
+            # we weren't told the CFA file, so find it from the field
+            cfa_file = [f for f in field.get_filenames() if Path(f).suffix == '.cfa'][0]
+            self.reader = CFAReader(cfa_file)
 
         # we can only do the sorting because we have timestamps. CF
         # uses a set because aggregation could be multidimensionsonal
-        filenames = sorted([f for f in files if Path(f).suffix !='.cfa'])
+        ncvar = field.nc_get_variable()
+        filenames = self.reader.fragments(ncvar)
         tdim = field.dimension_coordinate('T', default=None)
         if tdim is not None:
             tdimvar = tdim.nc_get_variable()
@@ -239,7 +391,7 @@ class CFAhandler:
         calendar = getattr(tdim, 'calendar', 'standard')
 
         #have we seen this before?
-        manikey = consistent_hash(filenames)
+        manikey = self.reader.manikey(ncvar)
         if manikey in self.known_manifests:
             # maybe, the filenames match
             candidate_manifest = self.known_manifests[manikey]
@@ -260,8 +412,7 @@ class CFAhandler:
                
         # ok, carry on, we're constructing it from scratch
         new_manifest = CFAManifest(accessor=self.accessor)
-        for f in filenames:
-            new_manifest.add_fragment(f)
+        new_manifest.add_fragments(filenames)
         if tdim is not None:
             bounds = self._parse_bounds_from_field(field, tdim)
             new_manifest.add_bounds(bounds, tdim.units, calendar, tdimvar)
@@ -284,31 +435,119 @@ class CFAhandler:
         Sort out the time bounds corresponding to each fragment file
         """
         ncvar = field.nc_get_variable()
-        alocations = self.__get_cfalocation(ncvar)
         if tdim.has_bounds():
-            bounds = tdim.bounds.data.array
-            #FIXME: Do this directly with numpy
-            newbounds = []
-            left=0
-            for n in alocations:
-                right = left + n -1
-                newbounds.append([bounds[left][0],bounds[right][1]])
-                left+=n
-            return np.array(newbounds)
+            alocations = self.reader.fragment_sizes(ncvar, self.__get_taxis(field))
+            return fragment_bounds(tdim.bounds.data.array, alocations)
         else:
             raise NotImplementedError
 
-    def __get_cfalocation(self,ncvar):
-        """ 
-        Find the CFA location by going down the rabbit hole
-        : ncvar :  the netcdf variable name of the field of interest
-        (We use this to go find the aggregation information and 
-        to get the width of each of the fragments in bound space.)
+    def __get_taxis(self, field):
         """
-        ncv = self.dataset.variables[ncvar]
-        aggregated_data = ncv.attrs['aggregated_data']
-        parsed_aggregated_data = dict(zip(aggregated_data.split()[::2], aggregated_data.split()[1::2]))
-        location = parsed_aggregated_data['map:']
-        #FIXME: this assumes time is the first dimension 
-        location = self.dataset.variables[location][:][0]
-        return location
+        Find the netcdf dimension name of the time axis of a field, and
+        if that is not available, the position of the time axis in the data.
+        """
+        key = field.domain_axis('T', key=True)
+        ncdim = field.domain_axis(key).nc_get_dimension(None)
+        if ncdim is not None:
+            return ncdim
+        return field.get_data_axes().index(key)
+
+
+class CFAReader:
+    """
+    Reads the aggregation information for every variable in a CFA file in one
+    pass over the file. The fragment file names and the fragment maps are held
+    by the name of the netcdf variable which holds them, so the (usually many)
+    aggregated variables which share them share the work of reading them, and
+    of sorting and hashing the file names.
+    """
+    def __init__(self, cfa_file):
+        """
+        : cfa_file : path to the aggregation file
+        """
+        self.cfa_file = str(cfa_file)
+        # relative fragment locations are relative to the aggregation file
+        directory = Path(cf.abspath(self.cfa_file, uri=False)).parent
+        self._directory = f'file://{directory}'
+        self.variables = {}
+        self._fragments = {}
+        self._manikeys = {}
+        self._maps = {}
+        self._sizes = {}
+        with h5.File(self.cfa_file, 'r') as dataset:
+            for ncvar, variable in dataset.variables.items():
+                aggregated_data = variable.attrs.get('aggregated_data')
+                if aggregated_data is None:
+                    continue
+                terms = aggregated_data.split()
+                terms = {k.rstrip(':'): v for k, v in zip(terms[::2], terms[1::2])}
+                location, fmap = terms.get('location'), terms['map']
+                if location is not None and location not in self._fragments:
+                    self._fragments[location] = self._read_locations(dataset.variables[location])
+                if fmap not in self._maps:
+                    self._maps[fmap] = np.asarray(dataset.variables[fmap][:])
+                self.variables[ncvar] = {'location': location, 'map': fmap,
+                                         'dimensions': variable.attrs['aggregated_dimensions'].split()}
+
+    def _read_locations(self, variable):
+        """
+        Return the sorted, normalised (as cf-python reports them), fragment
+        file names from a location variable.
+        """
+        names = set()
+        for name in np.asarray(variable[:]).ravel():
+            if isinstance(name, bytes):
+                name = name.decode('utf-8')
+            if not name:
+                # padding where there are fewer locations for some fragments
+                continue
+            if not urlsplit(name).scheme and not name.startswith('/'):
+                name = f'{self._directory}/{name}'
+            names.add(cf.abspath(name, uri=True))
+        return sorted(names)
+
+    def fragments(self, ncvar):
+        """ The sorted list of fragment files for an aggregated variable """
+        location = self.variables.get(ncvar, {}).get('location')
+        return self._fragments.get(location, [])
+
+    def manikey(self, ncvar):
+        """ The manifest key for the fragment files of an aggregated variable """
+        location = self.variables.get(ncvar, {}).get('location')
+        if location not in self._manikeys:
+            self._manikeys[location] = consistent_hash(self.fragments(ncvar))
+        return self._manikeys[location]
+
+    def fragment_sizes(self, ncvar, axis=0):
+        """
+        Return the size of each fragment along one aggregated dimension of a variable.
+        : ncvar : the netcdf variable name of the aggregated variable
+        : axis : the netcdf dimension name, or position, of the dimension
+        """
+        description = self.variables[ncvar]
+        if isinstance(axis, str):
+            axis = description['dimensions'].index(axis)
+        key = (description['map'], axis)
+        if key not in self._sizes:
+            # the map has a row of fragment sizes for each aggregated dimension,
+            # padded with missing values to the length of the longest
+            row = self._maps[description['map']][axis]
+            self._sizes[key] = row[row > 0]
+        return self._sizes[key]
+
+
+def fragment_bounds(bounds, sizes):
+    """
+    Given the cell bounds along an aggregated axis, and the number of cells in each
+    fragment along that axis, return the bounds of each fragment (the lower bound of
+    its first cell and the upper bound of its last).
+    : bounds : array of cell bounds, shape (ncells, 2)
+    : sizes : sequence of fragment sizes, which should sum to ncells
+    : returns : array of fragment bounds, shape (nfragments, 2)
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    ends = np.cumsum(sizes)
+    if sizes.size == 0 or ends[-1] != len(bounds):
+        raise ValueError(f'Fragment sizes (total {ends[-1] if sizes.size else 0}) '
+                         f'do not match the number of cells ({len(bounds)})')
+    return np.column_stack((bounds[ends - sizes, 0], bounds[ends - 1, 1]))
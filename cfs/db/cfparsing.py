@@ -2,7 +2,8 @@ from cfs.db.time_handling import LookupT
 from cfs.db.project_config import ProjectInfo
 import numpy as np
 from cfs.db.cfa_tools import CFAhandler
-from time import time
+from cfs.db.profiling import StageTimer
+import cf
 import logging
 import re
 logger = logging.getLogger(__name__)
@@ -89,8 +90,16 @@ def extract_cfsdomain(field, lookup_xy=LookupXY):
         shape = (ydim,xdim)
     except ValueError:
         shape = (ydim,)
+    return cfsdomain_from_axes(shape, field.domain._unique_domain_axis_identities(), lookup_xy)
+
+
+def cfsdomain_from_axes(shape, axis_names_sizes, lookup_xy=LookupXY):
+    """
+    The domain description for extract_cfsdomain, given the (Y,X) or (Y,) shape
+    and the dictionary of domain axis identities (e.g. {'domainaxis0':'latitude(5)',...},
+    as returned by cf-python's _unique_domain_axis_identities).
+    """
     lookup = lookup_xy(shape)
-    axis_names_sizes = field.domain._unique_domain_axis_identities()
     spatial_coords = [x for x in axis_names_sizes.values() if 'time' not in x]
     size = np.prod([int(re.search(r'\d+', x).group()) for x in spatial_coords])
     spatial_coords = ', '.join(sorted(spatial_coords))
@@ -104,67 +113,133 @@ def extract_cfsdomain(field, lookup_xy=LookupXY):
     return domain_properties
 
 
-def parse_fields_todict(fields, lookup_xy=None, vocab=None, cfa=False):
+def vocab_parameters(vocab):
+    """
+    Return the lists of properties used for the atomic origin, and of those which
+    become key properties (rather than proxied properties) of variables, for vocab.
+    """
+    if vocab is not None:
+        info = ProjectInfo()
+        atomic_params = info.get_atomic_params(vocab)
+        default_params = info.get_facets(vocab)
+        for f in ['standard_name','long_name','realm','frequency']:
+            if f not in default_params:
+                default_params.append(f)
+    else:
+        atomic_params = ['project','mip','experiment','institution','source-id','variant-label','realm']
+        default_params = ['standard_name','long_name','realm','source_id','frequency',
+                  'source','variant_label','experiment','runid']
+    return atomic_params, default_params
+
+
+def split_properties(field, description, default_params):
+    """
+    Copy the default_params properties of field into the description, and return
+    a dictionary of all the other properties.
+    """
+    properties = field.properties()
+    for k in default_params:
+        description[k] = field.get_property(k,None)
+        if description[k] is not None:
+            properties.pop(k)
+        else:
+            description.pop(k)
+    return properties
+
+
+def parse_fields_todict(fields, lookup_xy=None, vocab=None, cfa=False, timer=None, accessor=None,
+                        cfa_file=None):
     """
     Parse a list of cf-python fields into a list of properties suitable for loading into the database.
     : fields : a list of cf fields
     : lookup_class : optional. see description in cfparse_field_for_domain
     : cfa : True if aggregated fields
+    : timer : optional StageTimer (see cfs.db.profiling) in which the time spent in each
+              step of parsing each field is recorded.
+    : accessor : optional FragmentAccessor (see cfs.db.cfa_tools) used to find the
+                 sizes of CFA fragment files.
+    : cfa_file : optional path of the CFA file the fields came from, so that the aggregation
+                 information can be read without asking each field for its files.
     : returns : a list of dictionaries of metadata properties describing
                 each of the cf fields (a subset of the variables) found in the file.
     """
     descriptions = []
+    if timer is None:
+        timer = StageTimer()
    
     # tools for handling domains and manifests
-    cfahandler=CFAhandler(len(fields))
+    cfahandler=CFAhandler(len(fields), accessor=accessor, cfa_file=cfa_file if cfa else None)
     if lookup_xy is None:
             lookup_xy=LookupXY
     lookup_t = LookupT()
 
-    if vocab is not None:
-        info = ProjectInfo()
-        atomic_params = info.get_atomic_params(vocab)
-        default_params = info.get_facets(vocab)
-        for f in ['standard_name','long_name','realm','frequency']:
-            if f not in default_params:
-                default_params.append(f)
-    else:
-        atomic_params = ['project','mip','experiment','institution','source-id','variant-label','realm']
-        default_params = ['standard_name','long_name','realm','source_id','frequency',
-                  'source','variant_label','experiment','runid']
+    atomic_params, default_params = vocab_parameters(vocab)
         
      # loop over fields in file (not the same as netcdf variables)
     for v in fields:
-        t1 = time()
-        description = {'atomic_origin': parse2atomic_name(v, atomic_params), 'identity':v.identity()}
+        times = timer.new_field()
+        with timer.stage('properties', times):
+            description = {'atomic_origin': parse2atomic_name(v, atomic_params), 'identity':v.identity()}
         if cfa:
-            description['manikey'] = cfahandler.parse_field_to_manifest(v)
-        properties = v.properties()
-        for k in default_params:
-            description[k] = v.get_property(k,None)
-            if description[k] is not None:
-                properties.pop(k)
-            else:
-                description.pop(k)
-        t2 = time()
-        description['time_domain'] = lookup_t.extract_cfstemporal(v)   
-        t3 = time()
-        description['spatial_domain'] = extract_cfsdomain(v, lookup_xy)
-        t4 = time()
-        cmlist = []
-        for m, cm in v.cell_methods().items():
-            for a in cm.get_axes():
-                if hasattr(cm,'intervals'):
-                    intervals = cm.intervals
-                else:
-                    intervals=None
-                cmlist.append((a,cm.get_method(),cm.qualifiers(),intervals))
-        description['cell_methods'] = cmlist
-        description['_proxied'] = {k:manage_types(v) for k,v in properties.items()}
+            with timer.stage('manifest', times):
+                description['manikey'] = cfahandler.parse_field_to_manifest(v)
+        with timer.stage('properties', times):
+            properties = split_properties(v, description, default_params)
+        with timer.stage('extract_cfstemporal', times):
+            description['time_domain'] = lookup_t.extract_cfstemporal(v)   
+        with timer.stage('extract_cfsdomain', times):
+            description['spatial_domain'] = extract_cfsdomain(v, lookup_xy)
+        with timer.stage('cell_methods', times):
+            cmlist = []
+            for m, cm in v.cell_methods().items():
+                for a in cm.get_axes():
+                    if hasattr(cm,'intervals'):
+                        intervals = cm.intervals
+                    else:
+                        intervals=None
+                    cmlist.append((a,cm.get_method(),cm.qualifiers(),intervals))
+            description['cell_methods'] = cmlist
+        with timer.stage('properties', times):
+            description['_proxied'] = {k:manage_types(v) for k,v in properties.items()}
         descriptions.append(description)
-        t5 = time()
-        logger.info(f'Parsing steps {t2-t1:.2f},{t3-t2:.2f},{t4-t3:.2f},{t5-t4:.2f} seconds')
+        logger.debug(f'Parsing steps '+', '.join(f'{k} {t:.2f}' for k,t in times.items())+' seconds')
     return descriptions, cfahandler.known_manifests
 
 
-
+def parse_file_todict(path, lookup_xy=None, vocab=None, cfa=False, fixer=None, fast=False, accessor=None):
+    """
+    Read a file with cf-python, apply any fixer, and parse the fields into the
+    dictionaries needed for loading into the database. Nothing here touches
+    the database, so it is safe to run this in a worker process.
+    : path : path to the file to be read
+    : lookup_xy, vocab, cfa, accessor : see parse_fields_todict
+    : fixer : (optional) function which is applied to each field and the path
+    : fast : if True, first try to get the same descriptions directly from the netCDF
+             header (see cfs.db.header_parsing), only using cf-python if the file is
+             not simple enough for that. (Not used with CFA files or a fixer, which
+             need the cf-python fields.)
+    : returns : tuple of (descriptions, manifests, number of fields, timer) with the
+                descriptions and manifests as returned by parse_fields_todict, and
+                a StageTimer recording the time taken by each step.
+    """
+    timer = StageTimer()
+    if fast and not cfa and fixer is None:
+        # imported here, as header_parsing builds on this module
+        from cfs.db.header_parsing import NotSimple, parse_header_todict
+        try:
+            descriptions, nfields = parse_header_todict(path, lookup_xy=lookup_xy, vocab=vocab, timer=timer)
+            return descriptions, {}, nfields, timer
+        except NotSimple as err:
+            logger.info(f'Using cf-python for {path} ({err})')
+            timer = StageTimer()
+    with timer.stage('cf_read'):
+        fields = cf.read(path, aggregate=False)
+    if fixer is not None:
+        with timer.stage('fixer'):
+            for f in fields:
+                fixer(f, path)
+    logger.info(f"Initial CF read of {path} took {timer.stages['cf_read']:.2f}s "
+                f"(fixer={timer.stages.get('fixer', 0):.2f}s)")
+    descriptions, manifests = parse_fields_todict(fields, lookup_xy=lookup_xy, vocab=vocab, cfa=cfa,
+                                                  timer=timer, accessor=accessor, cfa_file=path)
+    return descriptions, manifests, len(fields), timer
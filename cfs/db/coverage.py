@@ -0,0 +1,108 @@
+import cf
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+###
+### Checking the temporal coverage of aggregations. The fragments of a manifest should
+### follow on from each other in time, without gaps, overlaps or repeats, and each should
+### hold a whole number of time steps. These functions find where they don't, working on
+### the whole bounds array at once (so long manifests are cheap), and summarise the result
+### in the form which is kept on the manifest, so that questions about coverage can be
+### answered without decoding the bounds.
+###
+
+# Length of the interval units found by LookupT (and XIOS) in days, in real calendars
+# and in 360 day calendars, along with how far (as a fraction of an interval) a fragment
+# may be from a whole number of intervals, to allow for the varying lengths of real
+# months and years.
+INTERVALS = {'h':(1/24, 1/24, 1e-6), 'd':(1, 1, 1e-6), 'm':(30.436875, 30, 0.1), 'mo':(30.436875, 30, 0.1),
+             'y':(365.2425, 360, 0.01)}
+
+
+def interval_in_units(time_domain, units, calendar):
+    """
+    The sampling interval of a time domain in the units (e.g. days since ...) of some bounds.
+    : returns : tuple (step, tolerance) with the tolerance as a fraction of a step, or
+                (None, None) if the interval is not understood.
+    """
+    if time_domain is None or time_domain.interval_units not in INTERVALS:
+        return None, None
+    real, flat, tolerance = INTERVALS[time_domain.interval_units]
+    days = time_domain.interval*(flat if calendar == '360_day' else real)
+    step = cf.Units.conform(days, cf.Units('day'), cf.Units(units.split(' since ')[0]))
+    return float(step), tolerance
+
+
+def analyse_bounds(bounds, step=None, tolerance=1e-6):
+    """
+    Check an (n, 2) array of fragment bounds, in fragment order, for gaps, overlaps, repeated
+    fragments, fragments out of order and (if the time step is known) fragments which do not
+    hold a whole number of time steps.
+    : step : the time step, in the units of the bounds
+    : tolerance : how far the ends of neighbouring fragments may be apart (and fragments may be
+                  from a whole number of steps) as a fraction of a step (or, without a step,
+                  of the typical fragment length)
+    : returns : a report dictionary, with the start and end of the coverage, the gaps (as
+                [start, end] pairs), and the positions of the fragments which overlap those
+                before, repeat an earlier one, start before the one before, or are irregular
+                (None if the step is unknown). It is complete if there are none of those.
+    """
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 2)
+    n = len(bounds)
+    if n == 0:
+        return {'fragments':0, 'start':None, 'end':None, 'gaps':[], 'overlaps':[], 'duplicates':[],
+                'unordered':[], 'irregular':None if step is None else [], 'step':step, 'complete':False}
+    starts, ends = bounds[:, 0], bounds[:, 1]
+    slack = tolerance*(step if step else float(np.median(ends - starts)))
+
+    repeated = np.ones(n, dtype=bool)
+    repeated[np.unique(bounds, axis=0, return_index=True)[1]] = False
+    # compared with the furthest any fragment so far reaches
+    reach = np.maximum.accumulate(ends)
+    jumps = starts[1:] - reach[:-1]
+    following = np.arange(1, n)
+    gaps = np.flatnonzero(jumps > slack)
+    overlaps = following[(jumps < -slack) & ~repeated[1:]]
+    unordered = following[(np.diff(starts) < 0) & ~repeated[1:]]
+    irregular = None
+    if step:
+        steps = (ends - starts)/step
+        irregular = np.flatnonzero((np.abs(steps - np.rint(steps)) > tolerance) | (np.rint(steps) < 1)).tolist()
+
+    report = {
+        'fragments': n,
+        'start': float(starts.min()),
+        'end': float(ends.max()),
+        'gaps': [[float(reach[i]), float(starts[i+1])] for i in gaps],
+        'overlaps': overlaps.tolist(),
+        'duplicates': np.flatnonzero(repeated).tolist(),
+        'unordered': unordered.tolist(),
+        'irregular': irregular,
+        'step': step,
+    }
+    report['complete'] = not any(report[k] for k in ['gaps', 'overlaps', 'duplicates', 'unordered', 'irregular'])
+    return report
+
+
+def summarise(report):
+    """
+    The parts of a coverage report which are kept on the manifest: the start and end,
+    and a summary with the gaps (which are needed to answer questions about coverage)
+    but just the numbers of the other problems.
+    """
+    summary = {'gaps':report['gaps']}
+    for k in ['overlaps', 'duplicates', 'unordered', 'irregular']:
+        summary[k] = None if report[k] is None else len(report[k])
+    summary['complete'] = report['complete']
+    return {'coverage_start':report['start'], 'coverage_end':report['end'], 'coverage':summary}
+
+
+def covers(coverage_start, coverage_end, gaps, start, end):
+    """
+    Is the period from start to end (in the units of the bounds) within the coverage,
+    and free of gaps?
+    """
+    if coverage_start is None or start < coverage_start or end > coverage_end:
+        return False
+    return not any(left < end and right > start for left, right in gaps)
@@ -0,0 +1,99 @@
+from collections import Counter
+from django.db import transaction
+import logging
+logger = logging.getLogger(__name__)
+
+###
+### Facet counts for the faceted browse: how many variables in each collection have each
+### key property (FacetCount rows). These are kept in step as variables are added to, and
+### removed from, collections (see the receivers in cfs.models, and
+### CollectionInterface.bulk_add_variables), so that the choices for the drop downs, and
+### their counts, can be found without going near the variables.
+###
+
+CHUNK = 500
+
+
+def _chunks(items, size=CHUNK):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def _properties(variable_ids):
+    """ The key property ids of each of a set of variables """
+    from cfs.models import Variable, VariablePropertySet
+    through = VariablePropertySet.properties.through
+    sets = {}
+    for chunk in _chunks(variable_ids):
+        sets.update(Variable.objects.filter(id__in=chunk).values_list('id', 'key_properties_id'))
+    members = {}
+    for chunk in _chunks({s for s in sets.values() if s is not None}):
+        for set_id, property_id in through.objects.filter(variablepropertyset_id__in=chunk).values_list(
+                'variablepropertyset_id', 'variableproperty_id'):
+            members.setdefault(set_id, []).append(property_id)
+    return {v: members.get(s, []) for v, s in sets.items()}
+
+
+def adjust(memberships, sign):
+    """
+    Update the counts for variables joining (sign=1) or leaving (sign=-1) collections.
+    : memberships : iterable of (collection id, variable id) pairs
+    """
+    from cfs.models import FacetCount
+    memberships = list(memberships)
+    if not memberships:
+        return
+    properties = _properties({v for c, v in memberships})
+    deltas = Counter()
+    for c, v in memberships:
+        for p in properties.get(v, []):
+            deltas[(c, p)] += sign
+    deltas = {k: n for k, n in deltas.items() if n}
+    if not deltas:
+        return
+    with transaction.atomic():
+        existing = {}
+        for c in {c for c, p in deltas}:
+            pids = [p for cc, p in deltas if cc == c]
+            for chunk in _chunks(pids):
+                for row in FacetCount.objects.filter(collection_id=c, property_id__in=chunk):
+                    existing[(c, row.property_id)] = row
+        changed, new, empty = [], [], []
+        for (c, p), n in deltas.items():
+            row = existing.get((c, p))
+            if row is None:
+                if n > 0:
+                    new.append(FacetCount(collection_id=c, property_id=p, variable_count=n))
+                else:
+                    logger.warning(f'Facet count for property {p} in collection {c} was missing')
+                continue
+            row.variable_count += n
+            if row.variable_count > 0:
+                changed.append(row)
+            else:
+                empty.append(row.id)
+        FacetCount.objects.bulk_update(changed, ['variable_count'], batch_size=CHUNK)
+        FacetCount.objects.bulk_create(new, batch_size=CHUNK)
+        for chunk in _chunks(empty):
+            FacetCount.objects.filter(id__in=chunk).delete()
+
+
+def rebuild(collections=None):
+    """
+    Count everything from scratch (e.g. for a database loaded before the counts were kept).
+    : collections : optional list of collections, otherwise all of them
+    : returns : the number of counts made
+    """
+    from cfs.models import Collection, FacetCount
+    through = Collection.variables.through
+    with transaction.atomic():
+        rows = through.objects.all()
+        counts = FacetCount.objects.all()
+        if collections is not None:
+            ids = [c.id for c in collections]
+            rows = rows.filter(collection_id__in=ids)
+            counts = counts.filter(collection_id__in=ids)
+        counts.delete()
+        adjust(rows.values_list('collection_id', 'variable_id').iterator(), 1)
+        return counts.count()
@@ -1,89 +1,239 @@
-from time import time
+from time import time, perf_counter
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context
+from itertools import islice
 import logging
 logger = logging.getLogger(__name__)
-import cf
 
-from cfs.db.cfparsing import parse_fields_todict
+from cfs.db.cfparsing import parse_fields_todict, parse_file_todict
 from cfs.db.interface import LocationInterface
+from cfs.db import interning
+from cfs.db.profiling import IngestProfile, StageTimer, count_queries
+from cfs.db.parse_cache import ParseCache
 
 def cfupload_variables(db, location, fields, fd, collection, vocab, extra_collections, cfa=False):
     """
     Parse a set of cf fields and load cf metadata into the database.
     : db : a CollectionDB instance
     : location :  a location name
-    : fields : a list of CF field constructs 
+    : fields : a list of CF field constructs
     : fd : a file data dictionary
     : collection : a db collection name
     : vocab :  a vocab name
     : extra_collections : names of any extra collections in which these files and variables might appear
     : returns : tuple (status message, time taken in seconds)
     """
-    
+
     t2 = time()
     descriptions, manifests = parse_fields_todict(fields, vocab=vocab, cfa=cfa)
     t2b = time()-t2
     logger.info(f'Parsing to dictionary took {t2b:.2f}s')
+    cfupload_descriptions(db, location, descriptions, manifests, fd, collection, vocab,
+                          extra_collections, cfa=cfa)
+
 
-    filedata = {'properties':fd, 
+def cfupload_descriptions(db, location, descriptions, manifests, fd, collection, vocab,
+                          extra_collections, cfa=False):
+    """
+    Load the variable descriptions (and, for CFA files, the manifests) produced by
+    parse_fields_todict for one file into the database. Arguments as for
+    cfupload_variables.
+    """
+    t2 = time()
+    filedata = {'properties':fd,
                 'variables':descriptions}
     if cfa:
         filedata['manifests'] = manifests
 
     vars = db.upload_file_to_collection(location, collection, filedata, vocab=vocab)
-    for ec in extra_collections:
-        for v in vars:
-            db.variable.add_to_collection(ec,v)
+    if extra_collections:
+        extras = [db.collection.retrieve(name=ec) for ec in extra_collections]
+        db.collection.bulk_add_variables(extras, vars)
 
     t3 = time()
     logger.info(f'cfupload_file: {len(descriptions)} uploaded in {t3-t2:.2f}s')
 
 
-def cfupload_ncfiles(db, location_name, base_collection, vocab, dbfiles, intent, cfa=False, accessor=None, fixer=None):
-    """ 
+def _from_cache(cache, path, kwargs):
+    """
+    Look for the parse results for path in cache. Returns the cache key,
+    and either the results (as returned by parse_file_todict) or None.
+    """
+    timer = StageTimer()
+    with timer.stage('parse_cache'):
+        key = cache.key(path, **kwargs)
+        cached = cache.get(key)
+    if cached is None:
+        return key, None
+    return key, (*cached, timer)
+
+def _to_cache(cache, key, result):
+    """ Save results from parse_file_todict in the cache (without the timer) """
+    with result[3].stage('parse_cache'):
+        cache.put(key, result[0:3])
+
+def cached_parse(path, cache=None, **kwargs):
+    """
+    As parse_file_todict, but if a ParseCache is provided, use the results
+    from that if we can, and save them there if we can't.
+    """
+    if cache is None:
+        return parse_file_todict(path, **kwargs)
+    key, result = _from_cache(cache, path, kwargs)
+    if result is None:
+        result = parse_file_todict(path, **kwargs)
+        _to_cache(cache, key, result)
+    return result
+
+def parallel_parse(paths, workers, cache=None, **kwargs):
+    """
+    Parse files with parse_file_todict in a pool of worker processes, yielding
+    the results in the same order as the input paths. At most two files per
+    worker are in flight at any one time, so a slow consumer (i.e. the
+    database writer) does not cause parsed results to pile up in memory.
+    : paths : iterable of file paths
+    : workers : number of worker processes
+    : cache : optional ParseCache, files with cached results are not sent to the workers
+    : kwargs : passed to parse_file_todict (the fixer must be picklable,
+               i.e. a module level function)
+    """
+    def done():
+        key, future = pending.popleft()
+        result = future.result()
+        if key is not None:
+            _to_cache(cache, key, result)
+        return result
+
+    # We spawn rather than fork, so the workers do not inherit the parent's
+    # database connection or dask thread pool.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+        pending = deque()
+        for path in paths:
+            key, result = (None, None) if cache is None else _from_cache(cache, path, kwargs)
+            if result is None:
+                pending.append((key, pool.submit(parse_file_todict, path, **kwargs)))
+            else:
+                future = Future()
+                future.set_result(result)
+                pending.append((None, future))
+            if len(pending) >= 2*workers:
+                yield done()
+        while pending:
+            yield done()
+
+
+def cfupload_ncfiles(db, location_name, base_collection, vocab, dbfiles, intent, cfa=False, accessor=None,
+                     fixer=None, workers=1, commit_every=1, cache_size=None, profile=None,
+                     parse_cache=None, fast=False, extend_aggregations=False):
+    """
     Upload the cf information held in a bunch of files described by "normal file dictionaries"
     with a list of extra target collections embedded in each.
     : location_name : storage location name
     : base_collection : this will be a collection name used for _this_ set of file uploads.
     : vocab : name of a vocab to apply if appropriate.
-    : dbfiles : a list of file details
+    : dbfiles : a list (or any iterable, which is consumed lazily) of file details. If one of
+        these has a 'replaces' entry, that file (and its variables) is deleted in the same
+        transaction as the new one is uploaded, once the new one has been parsed.
     : intent : the collection intent, which will correspond to the filetype
     : cfa : if the list of files is a list of CFA files
-    : accessor : optional class for handling inspection of CFA fragments 
+    : accessor : optional FragmentAccessor for handling inspection of CFA fragments
                 (What, if anything can be done with the fragment file details will depend
-                on the capability provided by this class. If None, then only the 
-                path informaiton is used.)
+                on the capability provided by this class. If None, then only the
+                path informaiton is used.) With parallel parsing each worker gets its own
+                copy, so fragment sizes are only shared between the files each worker parses.
     : fixer : often the fields data may need to be fixed before uploading.
         If this is necessary, pass a function which can be applied to the list of fields and the name of
         the file the fields were in.
-
+    : workers : number of processes used to read and parse files. If more than one, the
+        files are parsed in a pool of worker processes, while this process writes the
+        results to the database in the original order (so the database only ever sees
+        one writer).
+    : commit_every : number of files to upload in each database transaction. Each file is
+        always uploaded atomically, but grouping files reduces the number of commits (and
+        hence fsyncs). If any file in a group fails, the whole group is rolled back.
+        At most commit_every files, plus those being parsed by the workers, are in hand at
+        any one time, so dbfiles can be a generator over a very large number of files.
+    : cache_size : the upload is done in an interning session, so that properties, domains
+        and cell methods which recur between files are only looked up once (see cfs.db.interning).
+        This optionally changes the number of entries each of those caches can hold.
+    : profile : optional filename, to which a JSON summary of the time spent in each stage of
+        the ingest (and the number of database queries) is written at the end (see cfs.db.profiling).
+    : parse_cache : optionally, a ParseCache (or the name of a directory to use for one) in
+        which the results of parsing files are kept. Files which are found there (because they
+        have been parsed before and not changed since) are not read again.
+    : fast : if True, and the intent is 'S', parse files directly from their netCDF headers where
+        they are simple enough, rather than with cf-python (see cfs.db.header_parsing).
+    : extend_aggregations : if True (for CFA files), a file which replaces another is first
+        used to extend the stored aggregation in place, if it has only had fragments appended
+        (see CollectionDB.extend_aggregation), and is only uploaded again if it has not.
+        The paths of those which were extended are kept in the IngestProfile.
+    : returns : the IngestProfile for this upload
     """
     if intent == 'F':
         raise ValueError('Intent cannot be to be a fragment')
     nv = 0
-    nf = 0 
+    nf = 0
     t1 = time()
     loci = LocationInterface()
     loc, created = loci.get_or_create(location_name)
-    for fd in dbfiles:
-        try:
-            collections = fd.pop('collections')
-        except KeyError:
-            collections = []
-        fd['type']=intent
-        fd['location']=loc
-        logger.info(f'Handling {fd}')
-        xt1 = time()
-        fields = cf.read(fd['path'], aggregate=False)
-        xt2 = time()
-        if fixer is not None:
-            for f in fields:
-                fixer(f, fd['path'])
-        xt3 = time()-xt2
-        logger.info(f"Initial CF read of {fd['name']} took {xt2-xt1:.2f}s (fixer={xt3:.2f}s)")
-        cfupload_variables(db, location_name, fields, fd, base_collection.name, vocab,  collections, cfa=cfa)
-        nv += len(fields)
-        nf += 1
+    kwargs = {'vocab':vocab, 'cfa':cfa, 'fixer':fixer, 'fast':fast and intent == 'S'}
+    if cfa and accessor is not None:
+        kwargs['accessor'] = accessor
+    profiler = IngestProfile()
+    if parse_cache is not None and not isinstance(parse_cache, ParseCache):
+        parse_cache = ParseCache(parse_cache)
+    if workers > 1:
+        # parallel_parse pulls each path before it yields the corresponding
+        # result, so the file details can follow along in a queue.
+        inflight = deque()
+        def paths():
+            for fd in dbfiles:
+                inflight.append(fd)
+                yield fd['path']
+        files = ((inflight.popleft(), result)
+                 for result in parallel_parse(paths(), workers, cache=parse_cache, **kwargs))
+    else:
+        files = ((fd, cached_parse(fd['path'], cache=parse_cache, **kwargs)) for fd in dbfiles)
+    with interning.session(maxsize=cache_size):
+        while group := list(islice(files, commit_every)):
+            with interning.atomic():
+                for fd, (descriptions, manifests, nfields, timer) in group:
+                    try:
+                        collections = fd.pop('collections')
+                    except KeyError:
+                        collections = []
+                    replaces = fd.pop('replaces', None)
+                    fd['type']=intent
+                    fd['location']=loc
+                    logger.info(f'Handling {fd}')
+                    with timer.stage('db_write'), count_queries(timer):
+                        if (extend_aggregations and replaces is not None and db.extend_aggregation(
+                                replaces, {'properties':fd, 'variables':descriptions, 'manifests':manifests})
+                                is not None):
+                            profiler.extended.append(fd['path'])
+                        else:
+                            if replaces is not None:
+                                db.file.delete_with_variables(replaces)
+                                # that may have removed domains etc which are in the interning caches
+                                interning.invalidate()
+                            cfupload_descriptions(db, location_name, descriptions, manifests, fd,
+                                                  base_collection.name, vocab, collections, cfa=cfa)
+                    profiler.add(fd['path'], timer)
+                    nv += nfields
+                    nf += 1
+                t3 = perf_counter()
+            profiler.add_commit(perf_counter()-t3)
+        stats = interning.cache_stats()
     t2 = time()-t1
-    msg = f'cfupload_ncfiles uploaded {nf} files ({nv} variables) which took {t2:.2f}s'
+    hits = sum(s['hits'] for s in stats.values())
+    misses = sum(s['misses'] for s in stats.values())
+    msg = (f'cfupload_ncfiles uploaded {nf} files ({nv} variables) which took {t2:.2f}s '
+           f'(interning cache hits {hits}, misses {misses})')
+    if parse_cache is not None:
+        msg += f' (parse cache hits {parse_cache.hits}, misses {parse_cache.misses})'
     logger.info(msg)
+    if profile is not None:
+        profiler.to_json(profile)
+    return profiler
 
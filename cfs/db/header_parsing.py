@@ -0,0 +1,258 @@
+from cfs.db.cfparsing import (LookupXY, cfsdomain_from_axes, manage_types, parse2atomic_name,
+                              split_properties, vocab_parameters)
+from cfs.db.profiling import StageTimer
+from cfs.db.time_handling import LookupT
+import h5netcdf as h5
+import numpy as np
+import re
+import logging
+logger = logging.getLogger(__name__)
+
+###
+### A fast path for parsing simple netCDF4 files. Rather than have cf-python build
+### full field constructs, we read the attributes and coordinate metadata (and just
+### the few time values needed) with h5netcdf and produce exactly the same variable
+### descriptions as parse_fields_todict would. Anything outside the (common) simple
+### case raises NotSimple, and the caller should use cf-python instead.
+###
+
+class NotSimple(Exception):
+    """ The file needs the full cf-python treatment """
+    pass
+
+# variable attributes which cf-python interprets, rather than treating as properties
+INTERPRETED = {'coordinates', 'cell_methods', 'bounds', 'scale_factor', 'add_offset'}
+# attributes for constructs we do not attempt to replicate here
+UNSUPPORTED = {'grid_mapping', 'cell_measures', 'ancillary_variables', 'formula_terms', 'climatology',
+               'geometry', 'compress', 'instance_dimension', 'sample_dimension', 'nodes',
+               'aggregated_dimensions', 'aggregated_data', 'axis', 'cf_role'}
+# global attributes which imply something other than simple gridded data
+UNSUPPORTED_GLOBAL = {'featureType', 'external_variables'}
+
+X_NAMES = {'longitude', 'grid_longitude', 'projection_x_coordinate'}
+Y_NAMES = {'latitude', 'grid_latitude', 'projection_y_coordinate'}
+X_UNITS = {'degrees_east', 'degree_east', 'degree_E', 'degrees_E', 'degreeE', 'degreesE'}
+Y_UNITS = {'degrees_north', 'degree_north', 'degree_N', 'degrees_N', 'degreeN', 'degreesN'}
+
+QUALIFIERS = {'where', 'over', 'within'}
+
+
+def _attribute(value):
+    """ Convert an attribute as read by h5netcdf to the type cf-python would give it """
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, np.ndarray):
+        if value.size != 1 or value.dtype.kind in 'SUO':
+            raise NotSimple('array valued attribute')
+        return value.reshape(())[()]
+    return value
+
+def _attributes(attrs):
+    return {k: _attribute(v) for k, v in attrs.items()}
+
+
+class HeaderCoordinate:
+    """
+    The description of a dimension coordinate (or scalar coordinate) variable
+    """
+    def __init__(self, variable, key):
+        self.variable = variable
+        self.ncvar = variable.name.split('/')[-1]
+        self.key = key
+        self.size = int(np.prod(variable.shape))
+        attrs = _attributes(variable.attrs)
+        if set(attrs) & {'scale_factor', 'add_offset'} or variable.dtype.kind in 'SUO':
+            raise NotSimple(f'coordinate {self.ncvar} is not simple')
+        if 'standard_name' not in attrs:
+            raise NotSimple(f'coordinate {self.ncvar} has no standard name')
+        self.standard_name = attrs['standard_name']
+        self.units = attrs.get('units', '')
+        self.calendar = attrs.get('calendar', None)
+        self.bounds = attrs.get('bounds', None)
+
+    def value(self, i):
+        """ Read one value """
+        return self.variable[()] if self.variable.shape == () else self.variable[i]
+
+    def is_axis(self, axis):
+        """ Does cf-python consider this the X, Y or T coordinate? """
+        match axis:
+            case 'X':
+                return self.standard_name in X_NAMES or self.units in X_UNITS
+            case 'Y':
+                return self.standard_name in Y_NAMES or self.units in Y_UNITS
+            case 'T':
+                return self.standard_name == 'time' or ' since ' in self.units
+
+
+class HeaderField:
+    """
+    Enough of a field, built from a netCDF data variable, to be described as
+    parse_fields_todict would describe the corresponding cf-python field.
+    """
+    def __init__(self, variable, global_attributes, coordinates, dataset):
+        self.ncvar = variable.name.split('/')[-1]
+        attrs = _attributes(variable.attrs)
+        if set(attrs) & UNSUPPORTED or variable.dtype.kind in 'SUO':
+            raise NotSimple(f'{self.ncvar} is not simple')
+        self._properties = global_attributes | {k: v for k, v in attrs.items() if k not in INTERPRETED}
+
+        # domain axes, in the order cf-python makes them
+        self.axes = {}
+        self.coordinates = []
+        names = {}
+        for dim in variable.dimensions:
+            key = f'domainaxis{len(self.axes)}'
+            self.axes[key] = (f'ncdim%{dim}', dataset.dimensions[dim].size)
+            names[dim] = key
+            if dim in coordinates:
+                self.coordinates.append(HeaderCoordinate(coordinates[dim], key))
+        for name in attrs.get('coordinates', '').split():
+            if name in variable.dimensions and name in coordinates:
+                continue
+            if name not in dataset.variables or dataset.variables[name].shape != ():
+                raise NotSimple(f'{self.ncvar} has auxiliary coordinates')
+            key = f'domainaxis{len(self.axes)}'
+            self.axes[key] = (f'ncdim%{name}', 1)
+            names[name] = key
+            self.coordinates.append(HeaderCoordinate(dataset.variables[name], key))
+        for c in self.coordinates:
+            self.axes[c.key] = (c.standard_name, self.axes[c.key][1])
+
+        self.cell_methods = self._parse_cell_methods(attrs.get('cell_methods', ''), names)
+
+    def _parse_cell_methods(self, string, names):
+        """
+        Parse a CF cell_methods string into (axes, method, qualifiers) tuples, with axes
+        named as cf-python names them (netCDF dimensions and scalar coordinates by their
+        domain axis key, anything else as it is).
+        """
+        if '(' in string:
+            raise NotSimple('cell methods with comments or intervals')
+        methods = []
+        words = string.split()
+        while words:
+            axes = []
+            while words and words[0].endswith(':'):
+                name = words.pop(0)[:-1]
+                axes.append(names.get(name, name))
+            if not axes or not words:
+                raise NotSimple(f'cannot parse cell methods {string}')
+            method = words.pop(0)
+            qualifiers = {}
+            while words and words[0] in QUALIFIERS:
+                if len(words) < 2:
+                    raise NotSimple(f'cannot parse cell methods {string}')
+                qualifier = words.pop(0)
+                qualifiers[qualifier] = words.pop(0)
+            methods.append((tuple(axes), method, qualifiers))
+        return methods
+
+    def identity(self):
+        if 'standard_name' in self._properties:
+            return self._properties['standard_name']
+        if 'long_name' in self._properties:
+            return f"long_name={self._properties['long_name']}"
+        return f'ncvar%{self.ncvar}'
+
+    def properties(self):
+        return self._properties.copy()
+
+    def get_property(self, key, *default):
+        try:
+            return self._properties[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise ValueError(f'{self.identity()} has no property {key}')
+
+    def coordinate(self, axis):
+        """ The X, Y or T coordinate, or None """
+        found = [c for c in self.coordinates if c.is_axis(axis)]
+        if len(found) > 1:
+            raise NotSimple(f'ambiguous {axis} coordinate')
+        return found[0] if found else None
+
+    def axis_identities(self):
+        """ Equivalent to cf-python's domain._unique_domain_axis_identities """
+        counts = {}
+        for name_size in self.axes.values():
+            counts[name_size] = counts.get(name_size, 0) + 1
+        identities = {}
+        for key, (name, size) in self.axes.items():
+            if counts[(name, size)] == 1:
+                identities[key] = f'{name}({size})'
+            else:
+                identities[key] = f"{name}{{{re.findall(r'[0-9]+$', key)[0]}}}({size})"
+        return identities
+
+
+def read_header_fields(dataset):
+    """
+    Find the data variables in an open h5netcdf dataset (in the order cf-python would
+    return the corresponding fields) and return a HeaderField for each.
+    """
+    if dataset.groups:
+        raise NotSimple('file has groups')
+    global_attributes = _attributes(dataset.attrs)
+    if set(global_attributes) & UNSUPPORTED_GLOBAL:
+        raise NotSimple('file is not simple gridded data')
+    variables = dataset.variables
+    coordinates = {name: v for name, v in variables.items() if v.dimensions == (name,)}
+    referenced = set()
+    for v in variables.values():
+        for attr in ['coordinates', 'bounds']:
+            referenced.update(_attribute(v.attrs.get(attr, '')).split())
+    data = sorted(name for name in variables if name not in coordinates and name not in referenced)
+    return [HeaderField(variables[name], global_attributes, coordinates, dataset) for name in data]
+
+
+def parse_header_todict(path, lookup_xy=None, vocab=None, timer=None):
+    """
+    Parse a simple netCDF4 file into the same descriptions that parse_fields_todict
+    produces from the cf-python fields in the file, using only the file header
+    (and the first, third and last time values).
+    : path : path to the file
+    : lookup_xy, vocab : see parse_fields_todict
+    : timer : optional StageTimer (see cfs.db.profiling)
+    : returns : tuple (descriptions, number of fields)
+    : raises : NotSimple if cf-python is needed for this file
+    """
+    if timer is None:
+        timer = StageTimer()
+    if lookup_xy is None:
+        lookup_xy = LookupXY
+    lookup_t = LookupT()
+    atomic_params, default_params = vocab_parameters(vocab)
+    descriptions = []
+    try:
+        dataset = h5.File(path, 'r')
+    except OSError as err:
+        # e.g. netCDF3
+        raise NotSimple(str(err))
+    with dataset:
+        with timer.stage('header_read'):
+            fields = read_header_fields(dataset)
+        for v in fields:
+            times = timer.new_field()
+            with timer.stage('properties', times):
+                description = {'atomic_origin': parse2atomic_name(v, atomic_params), 'identity':v.identity()}
+                properties = split_properties(v, description, default_params)
+            with timer.stage('extract_cfstemporal', times):
+                tcoord = v.coordinate('T')
+                if tcoord is not None and tcoord.size < 3:
+                    raise NotSimple('too few times to infer resolution')
+                description['time_domain'] = lookup_t.extract_header_temporal(v, tcoord)
+            with timer.stage('extract_cfsdomain', times):
+                y, x = v.coordinate('Y'), v.coordinate('X')
+                if y is None:
+                    raise NotSimple('no Y coordinate')
+                shape = (y.size,) if x is None else (y.size, x.size)
+                description['spatial_domain'] = cfsdomain_from_axes(shape, v.axis_identities(), lookup_xy)
+            with timer.stage('cell_methods', times):
+                description['cell_methods'] = [(a, method, qualifiers, None)
+                                               for axes, method, qualifiers in v.cell_methods for a in axes]
+            with timer.stage('properties', times):
+                description['_proxied'] = {k:manage_types(v) for k,v in properties.items()}
+            descriptions.append(description)
+    return descriptions, len(fields)
@@ -1,17 +1,28 @@
 import os
+from collections import Counter
+import json
+import math
+import numpy as np
 
 from django import template
 from django.db import transaction
-from django.db.models import Q, Count,OuterRef, Subquery
-from cfs.db.cfa_tools import get_quark_field
+from django.db.models import F, Q, Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from cfs.db.cfa_tools import get_quark_range
+from cfs.db.coverage import analyse_bounds, covers, interval_in_units, summarise
 from django.core.exceptions import ObjectDoesNotExist
 
 from cfs.models import (Cell_MethodSet, Cell_Method, Collection, CollectionType, 
-                            Domain, File, FileSet, FileType, Location, Manifest,  
+                            Domain, FacetCount, File, FileSet, FileSetMember, FileType, Location, Manifest,  
                             VariableProperty, VariablePropertyKeys, VariablePropertySet,
-                            Relationship, Tag, TimeDomain, Variable)
+                            ProxiedAttribute, Relationship, Tag, TimeDomain, Variable, HOT_KEYS)
 import cf
-from cfs.db.cfa_tools import numpy2db, db2numpy
+from cfs.db.cfa_tools import (numpy2db, db2numpy, blob_compression, bounds_hash, consistent_hash,
+                              is_legacy_blob)
+from cfs.db import interning
+from cfs.db import bitmaps, facets
+from cfs.db import search as text_search
+from cfs.db.interning import InternCache
 from time import time
 from uuid import uuid4
 
@@ -27,6 +38,105 @@ def get_obj_field(obj, key):
     return obj[key]
 #FIXME: When and how is the filter used, it's come from the old db.py, but it's a GOB thing.
 
+# Keep the number of SQL parameters in any one bulk query well inside the
+# limits of the database backend (SQLite in particular).
+BULK_CHUNK = 500
+
+def _chunked(items, size=BULK_CHUNK):
+    """ Yield successive slices of a list of items """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+def _natural_key(model, kw):
+    """
+    Hashable key for a dictionary of field values for <model>. We use the field
+    conversions so that (e.g.) numpy and python integers give the same key.
+    """
+    return tuple((k, model._meta.get_field(k).to_python(kw[k])) for k in sorted(kw))
+
+def _bulk_get_or_create(model, kwlist, cache=None):
+    """
+    Set based equivalent of calling model.objects.get_or_create(**kw) for
+    each kw in kwlist. Existing instances are found with a few OR queries,
+    and the missing ones created with one bulk_create.
+    : model : a django model class
+    : kwlist : list of dictionaries of field values
+    : cache : optional InternCache, keyed by natural key, consulted before the database
+    : returns : list of model instances, one for each element of kwlist
+    """
+    found = {}
+    groups = {}
+    for kw in kwlist:
+        key = _natural_key(model, kw)
+        if key in found:
+            continue
+        if cache is not None and (instance := cache.get(key)) is not None:
+            found[key] = instance
+        else:
+            groups.setdefault(tuple(sorted(kw)), {})[key] = kw
+
+    def find(names, keys):
+        for chunk in _chunked(keys, 100):
+            query = Q()
+            for key in chunk:
+                query |= Q(**dict(key))
+            for instance in model.objects.filter(query).order_by('pk'):
+                found.setdefault(tuple((k, getattr(instance, k)) for k in names), instance)
+
+    for names, wanted in groups.items():
+        find(names, list(wanted))
+        missing = [key for key in wanted if key not in found]
+        if missing:
+            model.objects.bulk_create([model(**dict(key)) for key in missing])
+            find(names, missing)
+        if cache is not None:
+            for key in wanted:
+                cache.put(key, found[key])
+    return [found[_natural_key(model, kw)] for kw in kwlist]
+
+def _bulk_get_or_create_sets(set_model, member_field, member_lists, cache=None):
+    """
+    Set based equivalent of the get_or_create_from_<members> class methods
+    of the unordered "hash table" models (Cell_MethodSet, VariablePropertySet)
+    for each list of members in member_lists.
+    : set_model : the set model class, which must provide generate_key
+    : member_field : the name of the many to many field holding the members
+    : member_lists : list of lists of member instances
+    : cache : optional InternCache, keyed by set key, consulted before the database
+    : returns : list of set instances, one for each element of member_lists
+    """
+    keys = [set_model.generate_key(members) for members in member_lists]
+    found = {}
+    wanted = {}
+    for key, members in zip(keys, member_lists):
+        if key in found or key in wanted:
+            continue
+        if cache is not None and (instance := cache.get(key)) is not None:
+            found[key] = instance
+        else:
+            wanted[key] = members
+    for chunk in _chunked(wanted):
+        found.update({s.key: s for s in set_model.objects.filter(key__in=chunk)})
+    missing = [k for k in wanted if k not in found]
+    if missing:
+        set_model.objects.bulk_create([set_model(key=k) for k in missing])
+        for chunk in _chunked(missing):
+            found.update({s.key: s for s in set_model.objects.filter(key__in=chunk)})
+        field = set_model._meta.get_field(member_field)
+        through = field.remote_field.through
+        source, target = f'{field.m2m_field_name()}_id', f'{field.m2m_reverse_field_name()}_id'
+        rows = []
+        for k in missing:
+            for member_id in {m.id for m in wanted[k]}:
+                rows.append(through(**{source: found[k].id, target: member_id}))
+        through.objects.bulk_create(rows, batch_size=BULK_CHUNK)
+    if cache is not None:
+        for k in wanted:
+            cache.put(k, found[k])
+    return [found[k] for k in keys]
+
+
 class GenericInterface:
     # This is the replacement for GenericHandler, I will migrate the subclassses
     # over time as I can.
@@ -80,6 +190,11 @@ class GenericInterface:
         """ Get an existing instance or create a new one. """
         return cls.model.objects.get_or_create(**kwargs)
 
+    @classmethod
+    def bulk_get_or_create(cls, kwlist):
+        """ Set based get_or_create for a list of keyword dictionaries """
+        return _bulk_get_or_create(cls.model, kwlist)
+
     @classmethod
     def delete(cls, instance):
         """ Delete the given instance. """
@@ -145,6 +260,13 @@ class GenericHandler:
         """
         instance, created = self.model.objects.get_or_create(**kwargs)
         return instance, created
+
+    def bulk_get_or_create(self, kwlist):
+        """
+        Set based get_or_create for a list of keyword dictionaries,
+        returns a list of instances (no created flags).
+        """
+        return _bulk_get_or_create(self.model, kwlist)
     
     def queryset_delete(self, queryset):
         """ 
@@ -170,6 +292,10 @@ class GenericHandler:
 
 class CellMethodsInterface(GenericHandler):
 
+    # shared by all instances, used during ingest sessions (see cfs.db.interning)
+    method_cache = InternCache('cell_method')
+    method_set_cache = InternCache('cell_method_set')
+
     def __init__(self):
         super().__init__(Cell_Method)
     
@@ -181,9 +307,21 @@ class CellMethodsInterface(GenericHandler):
         : returns : An instance of CellMethodSet
         """
         methods = [self.get_or_create_by_pair(m) for m in methods]
-        method_set = Cell_MethodSet.get_or_create_from_methods(methods)
+        method_set = self.method_set_cache.lookup(Cell_MethodSet.generate_key(methods),
+                        lambda: Cell_MethodSet.get_or_create_from_methods(methods))
         return method_set
 
+    def bulk_set_get_or_create(self, method_lists):
+        """
+        Set based version of set_get_or_create for many sets of methods at once.
+        : method_lists : list of lists of (axis, method) pairs
+        : returns : list of Cell_MethodSet instances
+        """
+        pairs = [dict(zip(['axis','method'], list(m))) for methods in method_lists for m in methods]
+        methods = iter(_bulk_get_or_create(self.model, pairs, cache=self.method_cache))
+        members = [[next(methods) for m in method_list] for method_list in method_lists]
+        return _bulk_get_or_create_sets(Cell_MethodSet, 'methods', members, cache=self.method_set_cache)
+
     def get_or_create_by_pair(self, method):
         """ 
         The standard cell method creation interface takes a pair 
@@ -193,8 +331,8 @@ class CellMethodsInterface(GenericHandler):
         : returns : A CellMethod instance
         """    
         kw = {k:v for k,v in zip(['axis','method'],list(method))}
-        cm, created = self.get_or_create(**kw)
-        return cm
+        return self.method_cache.lookup(_natural_key(self.model, kw),
+                                        lambda: self.get_or_create(**kw)[0])
     
     def retrieve(self,method):
         """ Retrieve a cell method supplied as a tuple"""
@@ -240,6 +378,28 @@ class CollectionInterface(GenericInterface):
         with transaction.atomic():
             collection.variables.add(*variable_set)
 
+    @classmethod
+    def bulk_add_variables(cls, collections, variables):
+        """
+        Add a list of variables to each of a list of collections with
+        a single insert into the membership table. Memberships which
+        already exist are ignored. The facet counts are updated for
+        the new ones.
+        """
+        through = Collection.variables.through
+        vids = [v.id for v in variables]
+        existing = set()
+        for c in collections:
+            for i in range(0, len(vids), BULK_CHUNK):
+                existing.update(through.objects.filter(collection_id=c.id, variable_id__in=vids[i:i+BULK_CHUNK]
+                                                       ).values_list('collection_id', 'variable_id'))
+        new = list(dict.fromkeys((c.id, v) for c in collections for v in vids if (c.id, v) not in existing))
+        with transaction.atomic():
+            rows = [through(collection_id=c, variable_id=v) for c, v in new]
+            through.objects.bulk_create(rows, batch_size=BULK_CHUNK, ignore_conflicts=True)
+            facets.adjust(new, 1)
+            bitmaps.index.memberships_changed(new, 1)
+
     @classmethod
     def delete(cls, collection, force=False):
         """
@@ -267,6 +427,17 @@ class CollectionInterface(GenericInterface):
         collection.do_empty(force)
         super().delete(collection)
 
+    @staticmethod
+    def search(text, limit=50):
+        """
+        Ranked full text search over collection names, descriptions, tags and properties
+        (see cfs.db.search).
+        : returns : list of up to limit collections, best match first
+        """
+        ids = text_search.search(text, text_search.COLLECTION, limit)
+        found = Collection.objects.in_bulk(ids)
+        return [found[i] for i in ids if i in found]
+
     @classmethod
     def retrieve_all(cls, name_contains=None, description_contains=None, 
                  contains=None, tagname=None, facet=None, **kw):
@@ -367,6 +538,23 @@ class CollectionInterface(GenericInterface):
         unique_manifests = Manifest.objects.filter(variable__in=variables).distinct()
         return unique_manifests
     
+    @classmethod
+    def coverage(cls, collection_name, start_tuple=None, end_tuple=None):
+        """
+        Analyse the temporal coverage of all the manifests used by variables in a collection
+        (keeping the summaries on the manifests, see ManifestInterface.analyse_coverage).
+        : start_tuple, end_tuple : optionally, (day, month, year) for a period of interest, in
+                                   which case each report also says whether it is covered.
+        : returns : dictionary of coverage reports keyed by manifest id
+        """
+        c = Collection.objects.get(name=collection_name)
+        reports = {}
+        for m in cls.unique_manifests(c.id).order_by('id'):
+            reports[m.id] = ManifestInterface.analyse_coverage(m)
+            if start_tuple is not None:
+                reports[m.id]['covers'] = ManifestInterface.covers(m, start_tuple, end_tuple)
+        return reports
+
     @classmethod
     def make_quarks(cls, collection_name, start_tuple, end_tuple, variables):
         """
@@ -418,14 +606,24 @@ class CollectionInterface(GenericInterface):
 
 
 class DomainInterface(GenericHandler):
+
+    # shared by all instances, used during ingest sessions (see cfs.db.interning)
+    cache = InternCache('domain')
         
     def __init__(self):
         super().__init__(Domain)
 
 
     def get_or_create(self,kw):
-        td, created = super().get_or_create(**kw)
-        return td
+        return self.cache.lookup(_natural_key(self.model, kw),
+                                 lambda: super(DomainInterface, self).get_or_create(**kw)[0])
+
+    def bulk_get_or_create(self, kwlist):
+        """
+        Set based get_or_create for a list of domain dictionaries,
+        returns a list of instances (no created flags).
+        """
+        return _bulk_get_or_create(self.model, kwlist, cache=self.cache)
     
     def retrieve(self, **properties):
         """ 
@@ -523,6 +721,31 @@ class FileInterface(GenericInterface):
     @classmethod
     def in_location(self, location_name):
         return File.objects.filter(locations__name=location_name).all()
+
+    @classmethod
+    def in_collection(cls, collection, location_name=None):
+        """
+        Find all the files which hold variables in the collection, optionally
+        restricted to those in a particular location.
+        """
+        files = File.objects.filter(variable__contained_in=collection)
+        if location_name is not None:
+            files = files.filter(locations__name=location_name)
+        return files.distinct()
+
+    @classmethod
+    def delete_with_variables(cls, file):
+        """
+        Remove a file from the database by deleting the variables it holds
+        (the last of which removes the file itself, and any manifests and
+        fragments, in the same way as emptying a collection does).
+        """
+        variables = file.variable_set.all()
+        if variables.exists():
+            for v in variables:
+                v.delete()
+        else:
+            file.delete()
         
     
 class LocationInterface(GenericInterface):
@@ -557,54 +780,39 @@ class ManifestInterface(GenericInterface):
     def add(cls, properties):
         """
         Add a CFA manifest
-        This should always be unique.
-        Can be deleted by deleting the parent file.
+        This should always be unique: if there is already a manifest with the same
+        fragments and bounds (e.g. from another CFA file aggregating the same fragments),
+        that is returned instead.
+        Can be deleted by deleting the parent file (and any other files using it).
         """
         if 'cells' in properties:
             cells = properties.pop('cells')
             logger.info(f'Removed cells {cells} from manifest, why did we want them?')
         # parse fragment file dictionaries into proper files
         fragments = properties.pop('fragments')
-        # pull out bases if they exist
-        for k,f in fragments.items():
-            base = f.pop('base',None)
-            if base is not None:
-                loc, created = LocationInterface.get_or_create(base)
-                f['location']=loc
+        properties['manikey'] = properties.pop('manikey', None) or consistent_hash(fragments.keys())
+        properties['bounds_hash'] = bounds_hash(properties.get('bounds'), properties.get('units'),
+                                                properties.get('calendar'))
+        existing = Manifest.objects.filter(manikey=properties['manikey'], bounds_hash=properties['bounds_hash'],
+                                           is_quark=False).first()
+        if existing is not None:
+            logger.info(f'Using existing manifest {existing.id} for {properties["manikey"]}')
+            return existing
+        locations = cls._fragment_locations(fragments.values())
         properties.pop('_bounds_ncvar')  #not intended for the database
         with transaction.atomic():
             # We do this directly for efficiency, and to bypass
             # the interface file check on size, which we may not know
-            # for fragment files.
-           
-            # extract locations and prepare file objects 
-            locations = [f.pop('location',None) for f in fragments.values()]
-
-            # Check for existing files or prepare new ones for creation
-            existing_files = []
-            file_objects = []
-            for f in fragments.values():
-                existing_file = File.objects.filter(**f).first()
-                if existing_file:
-                    existing_files.append(existing_file)
-                else:
-                    file_objects.append(File(**f))
-            
-            # Bulk create new files
-            if file_objects:
-                File.objects.bulk_create(file_objects)
-
-            # Combine both newly created and existing files
-            all_files = file_objects + existing_files
-
-            # now we can add the locations
-            for loc, f in zip(locations,all_files):
-                f.locations.add(loc)
+            # for fragment files. Everything stays in fragment (and
+            # hence bounds) order, so files and locations pair up.
+            all_files = cls._resolve_fragments(list(fragments.values()))
+            cls._add_fragment_locations(all_files, locations)
 
-            # Combine both newly created and existing files
-            all_files = file_objects + existing_files
             fileset, created = FileSet.get_or_create_from_files(all_files)
             properties['fragments'] = fileset
+            if properties.get('bounds') is not None:
+                # without the time step, until we know the variables (see analyse_coverage)
+                properties.update(summarise(analyse_bounds(db2numpy(properties['bounds']))))
 
             #nowcreate the manifest
             m = Manifest.objects.create(**properties)
@@ -612,27 +820,159 @@ class ManifestInterface(GenericInterface):
             # no saves needed, all done by the transaction
         return m
 
+    @classmethod
+    def extension(cls, manifest, properties):
+        """
+        Is the newly parsed manifest described by <properties> (as from CFAhandler) the same
+        aggregation as the stored <manifest>, with fragments appended? It is if the stored
+        bounds are exactly the start of the new ones, and the first and last stored
+        fragments are where they were. A manifest which is also used by other CFA files,
+        or whose fragment set is used by another manifest, cannot be extended in place.
+        : returns : the number of stored fragments, or None if it is not an extension.
+        """
+        if manifest.is_quark or (manifest.units, manifest.calendar) != (properties.get('units'),
+                                                                       properties.get('calendar')):
+            return None
+        n = FileSetMember.objects.filter(fileset=manifest.fragments).count()
+        paths = list(properties['fragments'])
+        if n == 0 or len(paths) < n:
+            return None
+        old, new = db2numpy(manifest.bounds), db2numpy(properties['bounds'])
+        if len(new) != len(paths) or not np.array_equal(new[:n], old):
+            return None
+        ends = sorted({0, n-1})
+        if list(manifest.fragments.files_at(ends).values_list('path', flat=True)) != [paths[i] for i in ends]:
+            return None
+        if manifest.variable_set.values('in_file').distinct().count() > 1:
+            return None
+        if Manifest.objects.filter(fragments=manifest.fragments).exclude(id=manifest.id).exists():
+            return None
+        return n
+
+    @classmethod
+    def extend(cls, manifest, properties):
+        """
+        Append the new fragments of a grown aggregation to a stored manifest (in place, so
+        the variables using it are unchanged), along with their bounds. Only the new
+        fragments are looked up or created, so this costs O(new fragments).
+        : properties : the newly parsed manifest, which must be an extension (see extension)
+        : returns : the number of fragments appended, or None if it is not an extension
+                    (in which case nothing is changed).
+        """
+        n = cls.extension(manifest, properties)
+        if n is None:
+            return None
+        fragments = properties['fragments']
+        if len(fragments) == n:
+            return 0
+        # copied, as the bases are removed, and the parse results may yet be used for an upload
+        tail = [dict(f) for f in list(fragments.values())[n:]]
+        locations = cls._fragment_locations(tail)
+        fileset = manifest.fragments
+        with transaction.atomic():
+            files = cls._resolve_fragments(tail)
+            cls._add_fragment_locations(files, locations)
+            FileSetMember.objects.bulk_create(
+                [FileSetMember(fileset=fileset, file=f, position=n+i) for i, f in enumerate(files)],
+                batch_size=BULK_CHUNK)
+            fileset.key = FileSet.generate_key(fileset.ordered_files().only('id'))
+            if FileSet.objects.filter(key=fileset.key).exists():
+                # these fragments have been seen before, we can't make them ours
+                transaction.set_rollback(True)
+                return None
+            fileset.save()
+            manifest.bounds = numpy2db(db2numpy(properties['bounds']),
+                                       compression=blob_compression(manifest.bounds))
+            manifest.manikey = properties.get('manikey') or consistent_hash(fragments.keys())
+            manifest.bounds_hash = bounds_hash(manifest.bounds, manifest.units, manifest.calendar)
+            cls.analyse_coverage(manifest, save=False)
+            manifest.save()
+        logger.info(f'Appended {len(tail)} fragments to manifest {manifest.id}')
+        return len(tail)
+
+    @staticmethod
+    def _fragment_locations(descriptions):
+        """
+        Remove the bases from a list of fragment descriptions, and return the
+        corresponding list of locations (None where there is no base). Each
+        distinct base is looked up once.
+        """
+        bases = {}
+        locations = []
+        for f in descriptions:
+            base = f.pop('base',None)
+            if base is not None and base not in bases:
+                bases[base], created = LocationInterface.get_or_create(base)
+            locations.append(bases.get(base))
+        return locations
+
+    @staticmethod
+    def _resolve_fragments(descriptions):
+        """
+        Find or create the File for each of a list of fragment descriptions (dictionaries
+        of File fields), looking them up by (name, path) in chunks, and creating all
+        the missing ones with one bulk_create.
+        : returns : the files, in the same order as the descriptions
+        """
+        if not descriptions:
+            return []
+        fields = sorted(descriptions[0])
+        found = {}
+        for chunk in _chunked(descriptions):
+            candidates = File.objects.filter(name__in={d['name'] for d in chunk},
+                                             path__in={d['path'] for d in chunk})
+            for f in candidates:
+                found.setdefault(tuple(getattr(f, k) for k in fields), f)
+        keys = [tuple(d.get(k) for k in fields) for d in descriptions]
+        missing = {}
+        for key, d in zip(keys, descriptions):
+            if key not in found and key not in missing:
+                missing[key] = File(**d)
+        File.objects.bulk_create(missing.values(), batch_size=BULK_CHUNK)
+        found.update(missing)
+        return [found[key] for key in keys]
+
+    @staticmethod
+    def _add_fragment_locations(files, locations):
+        """
+        Add each file to the corresponding location (if not None) with one bulk_create
+        into the through table, and, as FileInterface.create does, add the sizes of
+        the new copies to the location volumes.
+        """
+        pairs = {(f.id, loc.id): (f, loc) for f, loc in zip(files, locations) if loc is not None}
+        if not pairs:
+            return
+        through = File.locations.through
+        existing = set()
+        for chunk in _chunked(pairs):
+            existing.update(through.objects.filter(file_id__in={f for f, l in chunk}).values_list(
+                'file_id', 'location_id'))
+        new = [pair for pair in pairs if pair not in existing]
+        through.objects.bulk_create([through(file_id=f, location_id=l) for f, l in new], batch_size=BULK_CHUNK)
+        volumes = {}
+        for pair in new:
+            f, loc = pairs[pair]
+            volumes[loc.id] = volumes.get(loc.id, 0) + (f.size or 0)
+        for location_id, volume in volumes.items():
+            if volume:
+                Location.objects.filter(id=location_id).update(volume=F('volume') + volume)
+
     @classmethod
     def subset(cls, manifest, start_date, end_date):
         """ Make a quark subset of this particular atomic dataset manifest """
-        nf = manifest.fragment_count()
-        fset = [manifest.fragments.files.all()[i] for i in [0,1,int(nf/2)-1,int(nf/2),1+int(nf/2),nf-2,nf-1]]
-        import numpy as np
-        print(f'Inputs {nf} fragments',np.shape(db2numpy(manifest.bounds)))
-        print(fset)
-        quark_field, brange = get_quark_field(manifest, start_date, end_date)
-        logger.debug(f'Subsetting manifest ({quark_field}, {brange} with {start_date},{end_date}')
-        fragments = [FileInterface.retrieve(id=f) for f in quark_field.data.array.tolist()]
-        tdim = quark_field.dimension_coordinate('T', default=None)
-        bounds = numpy2db(tdim.bounds.data.array)
+        first, stop, bounds = get_quark_range(manifest, start_date, end_date)
+        logger.debug(f'Subsetting manifest (fragments {first}:{stop}) with {start_date},{end_date}')
+        fragments = list(manifest.fragments.ordered_files(first, stop))
+        # encoded as the parent bounds are, so that we can find existing quarks
+        bounds = numpy2db(bounds, compression=blob_compression(manifest.bounds))
     
         fileset, fcreated = FileSet.get_or_create_from_files(fragments)
         logger.debug(f'Fileset (with {len(fragments)} fragments) created? {fcreated}')
         quark, created = cls.get_or_create(cfa_file=manifest.cfa_file,
                          fragments = fileset,
                          bounds = bounds,
-                         units = tdim.units,
-                         calendar = tdim.calendar,
+                         units = manifest.units,
+                         calendar = manifest.calendar,
         )
         if created: 
             quark.uuid = uuid4()
@@ -640,6 +980,60 @@ class ManifestInterface(GenericInterface):
 
         return quark,created
 
+    @classmethod
+    def analyse_coverage(cls, manifest, save=True):
+        """
+        Check the fragment bounds of a manifest for gaps, overlaps, repeated fragments,
+        and fragments which do not hold a whole number of the time steps of its variables,
+        and keep a summary on the manifest (see cfs.db.coverage).
+        : save : if False, the summary is updated, but the manifest is not saved
+        : returns : the full coverage report
+        """
+        td = TimeDomain.objects.filter(variable__in_manifest=manifest).first()
+        step, tolerance = interval_in_units(td, manifest.units, manifest.calendar)
+        report = analyse_bounds(db2numpy(manifest.bounds), step, tolerance or 1e-6)
+        for k, v in summarise(report).items():
+            setattr(manifest, k, v)
+        if save:
+            manifest.save(update_fields=['coverage_start', 'coverage_end', 'coverage'])
+        return report
+
+    @classmethod
+    def covers(cls, manifest, start_tuple, end_tuple):
+        """
+        Is the manifest complete from start_tuple to end_tuple (day, month, year)?
+        This uses the coverage summary kept on the manifest, without decoding the bounds.
+        """
+        if manifest.coverage is None:
+            cls.analyse_coverage(manifest)
+        units = cf.Units(manifest.units, calendar=manifest.calendar)
+        start, end = [cf.Data(cf.dt(t[2], t[1], t[0]), units=units).array.item() for t in [start_tuple, end_tuple]]
+        return covers(manifest.coverage_start, manifest.coverage_end, manifest.coverage['gaps'], start, end)
+
+    @classmethod
+    def migrate_bounds(cls, compression=None, force=False, batch_size=BULK_CHUNK):
+        """
+        Rewrite manifest bounds still held in the original (np.save) format in the
+        current compact format (see cfa_tools.numpy2db). Quarks are found by comparing
+        their encoded bounds, so this should be done before making any more quarks
+        from manifests with bounds in the original format.
+        : compression : as for numpy2db
+        : force : if True, rewrite all bounds (e.g. to change the compression)
+        : batch_size : number of manifests rewritten in each transaction
+        : returns : the number of manifests rewritten
+        """
+        rewritten = 0
+        ids = cls.model.objects.exclude(bounds=None).values_list('id', flat=True)
+        for chunk in _chunked(ids, batch_size):
+            with transaction.atomic():
+                manifests = [cls.model(id=i, bounds=numpy2db(db2numpy(b), compression=compression))
+                             for i, b in cls.model.objects.filter(id__in=chunk).values_list('id', 'bounds')
+                             if force or is_legacy_blob(b)]
+                cls.model.objects.bulk_update(manifests, ['bounds'])
+            rewritten += len(manifests)
+        logger.info(f'Rewrote bounds for {rewritten} manifests')
+        return rewritten
+
 
 class RelationshipInterface(GenericInterface):
 
@@ -778,13 +1172,27 @@ class TagInterface(GenericInterface):
 
 class TimeInterface(GenericInterface):
     model = TimeDomain
+    # used during ingest sessions (see cfs.db.interning)
+    cache = InternCache('time_domain')
+
     @classmethod
     def get_or_create(cls,kw):
         if kw == {}:
             td = None
         else: 
-             td, created = super().get_or_create(**kw)
+            td = cls.cache.lookup(_natural_key(cls.model, kw),
+                                  lambda: super(TimeInterface, cls).get_or_create(**kw)[0])
         return td
+
+    @classmethod
+    def bulk_get_or_create(cls, kwlist):
+        """
+        Set based get_or_create for a list of time domain dictionaries,
+        as for get_or_create, empty dictionaries result in None.
+        """
+        instances = iter(_bulk_get_or_create(cls.model, [kw for kw in kwlist if kw], cache=cls.cache))
+        return [next(instances) if kw else None for kw in kwlist]
+
     @classmethod
     def subset(cls, td, start_date, end_date):
         """
@@ -814,23 +1222,39 @@ class VariableProperyInterface:
         """ 
         Generate a subset of properties depending on whether or
         not the properties belong to variables in a collection, and
-        whether or not they are stored in location.
+        whether or not they are stored in location. Each property
+        comes with the number of variables (in those collections) which
+        have it, as variable_count, taken from the facet counts (so this
+        does not depend on the number of variables). Variables in more
+        than one of the collections are counted once for each.
         """
-        print(keylist, collection_ids, location_ids)
-        try:
-            result = VariableProperty.objects.all()
-            if collection_ids:
-                collections = Collection.objects.filter(id__in=collection_ids)
-                result = result.filter(variable__contained_in__in=collections).distinct()
-            if keylist:
-                result = result.filter(key__in=keylist)
-            if location_ids:
-                print('Not implemented in variablepropertyinterface')  #FIXME
-            return result.all()
-        except Exception as err:
-            print(str(err))
-            return VariableProperty.objects.all()
-       
+        result = VariableProperty.objects.all()
+        if keylist:
+            result = result.filter(key__in=keylist)
+        if collection_ids:
+            result = result.filter(facets__collection_id__in=collection_ids)
+        if location_ids:
+            logger.warning('Filtering properties by location is not implemented')  #FIXME
+        return result.annotate(variable_count=Coalesce(Sum('facets__variable_count'), 0)).order_by('key', 'value')
+
+    @staticmethod
+    def facet_counts(collection):
+        """
+        The number of variables in a collection for each of the key properties they have.
+        : returns : dictionary of {key: {value: count}} with keys as in VariablePropertyKeys
+        """
+        counts = {}
+        for key, value, n in FacetCount.objects.filter(collection=collection).values_list(
+                'property__key', 'property__value', 'variable_count'):
+            counts.setdefault(VariablePropertyKeys(key).label, {})[value] = n
+        return counts
+
+    @staticmethod
+    def rebuild_facet_counts(collections=None):
+        """
+        Count everything again (see cfs.db.facets.rebuild).
+        """
+        return facets.rebuild(collections)
 
 
 class VariableInterface(GenericInterface):
@@ -840,6 +1264,9 @@ class VariableInterface(GenericInterface):
     tdomain=TimeInterface()
     cellm=CellMethodsInterface()
     file = FileInterface()
+    # used during ingest sessions (see cfs.db.interning)
+    property_cache = InternCache('variable_property')
+    property_set_cache = InternCache('variable_property_set')
 
     @classmethod
     def _construct_properties(cls, varprops, ignore_proxy=False):
@@ -851,9 +1278,9 @@ class VariableInterface(GenericInterface):
       
         for key in varprops:
             if key in VariablePropertyKeys.labels:
-                ekey = cls.varprops[key]
-                out_value, _ = VariableProperty.objects.get_or_create(
-                                        key=ekey, value=varprops[key])
+                kw = {'key':cls.varprops[key], 'value':varprops[key]}
+                out_value = cls.property_cache.lookup(_natural_key(VariableProperty, kw),
+                                lambda: VariableProperty.objects.get_or_create(**kw)[0])
                 definition['key_properties'].append(out_value)
             elif key == 'spatial_domain':
                 definition[key]=cls.xydomain.get_or_create(varprops[key])
@@ -884,17 +1311,25 @@ class VariableInterface(GenericInterface):
         c.save()
 
     @staticmethod
-    def filter_by_property_keys(list_of_keysets):
+    def filter_by_property_keys(list_of_keysets, collections=None):
         """ 
         Return a queryset of variables which have been
         filtered by the key properties which lie in
         the list of keysets. Each keyset will be 
-        a list of property ids.
+        a list of property ids. Optionally also limit the
+        variables to those in any of a list of collection ids.
+        The selection is made with the bitmap index (see cfs.db.bitmaps),
+        or, if that can't be used, with SQL.
         """
+        ids = bitmaps.index.lookup(list_of_keysets, collections or [])
+        if ids is not None:
+            return Variable.objects.filter(id__in=ids)
         results = Variable.objects.all()
         for value in list_of_keysets:
             if value:
                 results = results.filter(key_properties__properties__id__in=value)
+        if collections:
+            results = results.filter(contained_in__in=collections)
         return results
         
     @classmethod
@@ -911,7 +1346,8 @@ class VariableInterface(GenericInterface):
                 'id,' 'long_name', 'standard_name', 'temporal_resolution', 'nominal_resolution'
                 'cell_method', 'spatial_domain', 'time_domain', 'in_file'
                 It can also be any other arbitrary property which we might expect to find
-                in the proxied properties. But querying on those will be very slow!
+                in the proxied properties (these are found via the ProxiedAttribute index),
+                or '_proxied' with a dictionary of such properties.
         : values : 'id','long_name','standard_name' are identity strings
                    'time_resolution' : an integer describing a temporal resolution interval
                    'nominal_resolution' : string describing a nominal spatial resolution
@@ -920,6 +1356,7 @@ class VariableInterface(GenericInterface):
                    'time_domain' :  a db time domain instance
                    'in_file': a db file instance
                    'in_manifest': a db manifest instance
+        All the conditions are combined into one query.
         """
         if from_collection is None:
              base = Variable.objects
@@ -928,13 +1365,12 @@ class VariableInterface(GenericInterface):
                 from_collection = Collection.objects.get(name=from_collection)
             base = from_collection.variables
            
-        proxied = []
         for key,value in queries:
             #print('Query step', key, value)
             if key == 'key_properties':
                 for p in value:
                     base = base.filter(key_properties__properties=p)
-            elif key in ["spatial_domain","temporal_domain"]:
+            elif key in ["spatial_domain","temporal_domain","time_domain"]:
                 base = base.filter(**{key:value})
             elif key == 'in_file':
                 base = base.filter(in_file=value)
@@ -947,25 +1383,12 @@ class VariableInterface(GenericInterface):
             elif key == 'nominal_resolution':
                 base = base.filter(spatial_domain__nominal_resolution=value)
             else:
-                #it's a proxied field, ideally we'd do this, but we can't, doesn't work with sqllite
-                #base = base.filter(_proxied__contains={key:value})
-                proxied.append((key,value))
-                
-        if proxied:
-            print(f'Querying {[k for k,v in proxied]} will be horrendously slow. Try to avoid')
-            # If it's a regular need we should move this key value pair to a term.
-            # At this point we have no good choices for speed
-            candidates = base.all()
-            for k,v in proxied:
-                results = []
-                for c in candidates:
-                    if k in c:
-                        if c[k]==v:
-                            results.append(c)
-                candidates = results
-            return results
-        else:
-            return base.all()
+                proxied = value.items() if key == '_proxied' else [(key, value)]
+                for k, v in proxied:
+                    text, digest = ProxiedAttribute.encode(v)
+                    base = base.filter(id__in=ProxiedAttribute.objects.filter(
+                        key=k, digest=digest, value=text).values('variable'))
+        return base.all()
     
     @staticmethod
     def retrieve_in_collection(collection_name):
@@ -1003,7 +1426,153 @@ class VariableInterface(GenericInterface):
         if unique and not created:
             raise PermissionError('Attempt to re-create existing variable {var}')
         return var
-    
+
+    @staticmethod
+    def _signature(v):
+        """ Identify a variable by all the fields which define its uniqueness """
+        return (json.dumps(v._proxied, sort_keys=True), v.key_properties_id, v.spatial_domain_id,
+                v.time_domain_id, v.cell_methods_id, v.in_file_id, v.in_manifest_id)
+
+    @classmethod
+    def _resolve(cls, descriptions):
+        """
+        Find (or create) everything a list of variable descriptions refer to (properties,
+        property sets, domains, time domains and cell method sets), in a handful of queries,
+        and make the corresponding (unsaved) variables.
+        : descriptions : list of varprops dictionaries (see get_or_create)
+        : returns : list of unsaved variables in the same order as descriptions
+        """
+        definitions = []
+        for varprops in descriptions:
+            if 'identity' not in varprops:
+                raise ValueError('Variable definitions must include identity')
+            if not {'in_file', 'spatial_domain', 'time_domain'} <= set(varprops):
+                raise ValueError('Insufficient properties to create a variable')
+            definition = {'key_properties': [], '_proxied': {}, 'cell_methods': None, 'in_manifest': None}
+            for key, value in varprops.items():
+                if key in VariablePropertyKeys.labels:
+                    definition['key_properties'].append({'key': cls.varprops[key], 'value': value})
+                elif key in ['spatial_domain', 'time_domain', 'cell_methods', 'in_file', 'in_manifest']:
+                    definition[key] = value
+                else:
+                    definition['_proxied'][key] = value
+            definition['_proxied'] = {k: (None if isinstance(v, float) and math.isnan(v) else v)
+                                      for k, v in definition['_proxied'].items()}
+            definitions.append(definition)
+
+        # properties and property sets
+        properties = iter(_bulk_get_or_create(VariableProperty,
+                                [p for d in definitions for p in d['key_properties']],
+                                cache=cls.property_cache))
+        members = [[next(properties) for p in d['key_properties']] for d in definitions]
+        property_sets = _bulk_get_or_create_sets(VariablePropertySet, 'properties', members,
+                                                 cache=cls.property_set_cache)
+        # domains, time domains and cell methods
+        domains = cls.xydomain.bulk_get_or_create([d['spatial_domain'] for d in definitions])
+        tdomains = cls.tdomain.bulk_get_or_create([d['time_domain'] for d in definitions])
+        with_methods = [d for d in definitions if d['cell_methods'] is not None]
+        method_sets = iter(cls.cellm.bulk_set_get_or_create([d['cell_methods'] for d in with_methods]))
+
+        variables = []
+        for d, kp, sd, td, m in zip(definitions, property_sets, domains, tdomains, members):
+            cm = next(method_sets) if d['cell_methods'] is not None else None
+            variables.append(Variable(_proxied=d['_proxied'], key_properties=kp, spatial_domain=sd,
+                                      time_domain=td, cell_methods=cm, in_file=d['in_file'],
+                                      in_manifest=d['in_manifest'],
+                                      key_summary=VariablePropertySet.summarise(m)))
+        return variables
+
+    @classmethod
+    def bulk_create(cls, descriptions, unique=True):
+        """
+        Set based equivalent of calling get_or_create for each of a list of
+        variable descriptions (e.g. those from one file). All the properties,
+        domains, time domains and cell method sets needed by the whole list
+        are resolved in a handful of queries, and the new variables are
+        inserted with one bulk_create. The rows produced are the same as
+        those produced by get_or_create.
+        : descriptions : list of varprops dictionaries (see get_or_create)
+        : unique : if True, raise a PermissionError if any variable already exists,
+                   otherwise return the existing variable.
+        : returns : list of variables in the same order as descriptions
+        """
+        variables = cls._resolve(descriptions)
+
+        # uniqueness, against the database and within this list
+        files = {v.in_file_id for v in variables}
+        known = {cls._signature(v): v for v in Variable.objects.filter(in_file__in=files)}
+        results, new = [], []
+        for v in variables:
+            signature = cls._signature(v)
+            if signature in known:
+                if unique:
+                    raise PermissionError(f'Attempt to re-create existing variable {known[signature]}')
+                results.append(known[signature])
+            else:
+                known[signature] = v
+                results.append(v)
+                new.append(v)
+        Variable.objects.bulk_create(new, batch_size=BULK_CHUNK)
+        if any(v.pk is None for v in new):
+            # not all database backends return primary keys from bulk inserts
+            stored = {cls._signature(v): v.pk for v in Variable.objects.filter(in_file__in=files)}
+            for v in new:
+                v.pk = stored[cls._signature(v)]
+        ProxiedAttribute.index(new, replace=False, batch_size=BULK_CHUNK)
+        text_search.index_variables(new)
+        bitmaps.index.variables_added(new)
+        return results
+
+    @staticmethod
+    def search(text, limit=50):
+        """
+        Ranked full text search over the names and properties of variables (see cfs.db.search).
+        : returns : list of up to limit variables, best match first
+        """
+        ids = text_search.search(text, text_search.VARIABLE, limit)
+        found = Variable.objects.in_bulk(ids)
+        return [found[i] for i in ids if i in found]
+
+    @staticmethod
+    def reindex_attributes(batch_size=BULK_CHUNK):
+        """
+        Rebuild the ProxiedAttribute rows for all variables (for databases loaded before
+        those were kept, or after changing _proxied behind the back of Variable.save).
+        : returns : the number of variables indexed
+        """
+        n = 0
+        ids = list(Variable.objects.order_by('id').values_list('id', flat=True))
+        for chunk in _chunked(ids, batch_size):
+            with transaction.atomic():
+                ProxiedAttribute.index(list(Variable.objects.filter(id__in=chunk)), batch_size=batch_size)
+            n += len(chunk)
+        return n
+
+    @staticmethod
+    def refresh_key_summaries(batch_size=BULK_CHUNK):
+        """
+        Rewrite the key property summaries kept with all variables (for databases
+        loaded before those were kept).
+        : returns : the number of variables updated
+        """
+        through = VariablePropertySet.properties.through
+        n = 0
+        ids = list(Variable.objects.order_by('id').values_list('id', flat=True))
+        for chunk in _chunked(ids, batch_size):
+            variables = list(Variable.objects.filter(id__in=chunk).only('id', 'key_properties'))
+            summaries = {}
+            for set_id, key, value in through.objects.filter(
+                    variablepropertyset_id__in={v.key_properties_id for v in variables},
+                    variableproperty__key__in=HOT_KEYS).values_list(
+                    'variablepropertyset_id', 'variableproperty__key', 'variableproperty__value'):
+                summaries.setdefault(set_id, {})[key] = value
+            for v in variables:
+                v.key_summary = summaries.get(v.key_properties_id, {}) if v.key_properties_id else None
+            with transaction.atomic():
+                Variable.objects.bulk_update(variables, ['key_summary'], batch_size=batch_size)
+            n += len(variables)
+        return n
+
     @staticmethod
     def all():
         return Variable.objects.all()
@@ -1155,7 +1724,7 @@ class CollectionDB:
                                                [f], lazy, update=True, progress=False )[0]
 
 
-    def upload_file_to_collection(self, location_name, collection_name, filedata, vocab=None):
+    def upload_file_to_collection(self, location_name, collection_name, filedata, vocab=None, bulk=True):
         """
         Upload a file and set of variables described by <filedata> to the database.
         This method should only be used for the first time these data are exposed
@@ -1170,6 +1739,8 @@ class CollectionDB:
         : location_name : the location where the file is stored
         : collection_name : the primary collection for these data.
         : vocab: A project name for which vocabs can be found.
+        : bulk : if True (the default), use the set based VariableInterface.bulk_create
+                 to load all the variables, otherwise load them one at a time.
         : filedata : A dictionary with the following structure
         {'properties':{Dictionary of file properties},
          'variables': List of dictionaries of variable properties.
@@ -1198,74 +1769,146 @@ class CollectionDB:
         if vocab is not None:
             cv = self.collection.retrieve(name=vocab)
 
-        # manually controlling rollback
+        # Everything for this file is done in one transaction, so a failure at
+        # any step rolls back everything done for this file (but, if we are
+        # inside a larger transaction, nothing else).
         step = 0
-        created = []
         #pathology=[]
         #manology=[]
         try:
-            file = self.file.create(filedata['properties'])
-            created.append(file)
-            manifests={}
-            step = 1
-            manidata = filedata.pop('manifests',{})
-            for key,value in manidata.items():
-                #manology.append(value.copy())
-                manifest = value.pop('manikey')
-                value['cfa_file'] = file
-                step = 2
-                manifests[key] = self.manifest.add(value)
-                created.append(manifests[key])
-            step = 3
-            vars = []
-            for v in filedata['variables']:
-                #pathology.append(v.copy())
-                key = v.pop('manikey',None)
-                if key is not None:
-                    v['in_manifest'] = manifests[key]
-                v['in_file'] = file
-                t0 = time()
-                try:
+            with interning.atomic():
+                file = self.file.create(filedata['properties'])
+                manifests={}
+                step = 1
+                manidata = filedata.pop('manifests',{})
+                for key,value in manidata.items():
+                    #manology.append(value.copy())
+                    value['cfa_file'] = file
+                    step = 2
+                    manifests[key] = self.manifest.add(value)
+                step = 3
+                vars = []
+                for v in filedata['variables']:
+                    #pathology.append(v.copy())
+                    key = v.pop('manikey',None)
+                    if key is not None:
+                        v['in_manifest'] = manifests[key]
+                    v['in_file'] = file
+                    if bulk:
+                        continue
+                    t0 = time()
                     var = self.variable.get_or_create(v)
-                except:
-                    #import json
-                    #with open('crash.json','w') as f:
-                    #    for m in manology:
-                    #        if m['bounds'] is not None:
-                    #            m['bounds']=m['bounds'].tolist()
-                    #    p = {'manifests':manology,'variables':pathology}
-                    #    json.dump(p,f)
-                    #    print('dumped')
-                    raise
-                        
-                t1 = time()-t0
-                logger.info(f'Created ({t1:.2f}s) {var}')
-                created.append(var)
-                vars.append(var)
-            step = 4
-            for v in vars:
-                self.variable.add_to_collection(c.name,v)
-                if vocab is not None:
-                    self.variable.add_to_collection(cv.name,v)
+                    t1 = time()-t0
+                    logger.info(f'Created ({t1:.2f}s) {var}')
+                    vars.append(var)
+                if bulk:
+                    t0 = time()
+                    vars = self.variable.bulk_create(filedata['variables'])
+                    t1 = time()-t0
+                    logger.info(f'Created ({t1:.2f}s) {len(vars)} variables in {file.name}')
+                step = 4
+                targets = [c] if vocab is None else [c, cv]
+                self.collection.bulk_add_variables(targets, vars)
             return vars
-        
-        except ExceptionGroup as e:
-            # roll back
-            items = len(created)
-            for c in reversed(created):
-                c.delete()
-            logger.fatal(f'Failure encountered at step {step}, {items} items deleted. Problem was:')
+
+        except Exception as e:
+            logger.fatal(f'Failure encountered at step {step}, all changes for this file rolled back. Problem was:')
             match step:
                 case 0:
                     logger.fatal(filedata['properties'])
                 case 1:
                     logger.fatal(manidata)
                 case 2:
-                    logger.fatal(manifests[key])
+                    logger.fatal(value)
                 case 3:
                     logger.fatal(v)
                 case 4:
                     logger.fatal(f'Problem with adding to collection {c}')
+            e.add_note(f'(Failed after step {step}, changes rolled back)')
+            raise
 
-            msg = str(e)+f' (Failed after step {step}, {items} items deleted)'
-            raise Exception(msg)
+    def _unchanged(self, file, manifest, descriptions, variables):
+        """
+        Do the descriptions (parsed from file) describe the same variables as those stored,
+        apart from their time domains? (Anything the descriptions need which is not yet
+        known is created, so this should be done in a transaction which is rolled back if not.)
+        """
+        def signature(v):
+            s = VariableInterface._signature(v)
+            return s[:3] + s[4:]
+        descriptions = [{k: v for k, v in d.items() if k != 'manikey'} | {'in_file':file, 'in_manifest':manifest}
+                        for d in descriptions]
+        return (Counter(signature(v) for v in self.variable._resolve(descriptions)) ==
+                Counter(signature(v) for v in variables))
+
+    def extend_aggregation(self, file, filedata):
+        """
+        Bring the database up to date with a CFA file which has grown (by having fragments
+        appended to its aggregations) since it was uploaded, by extending its manifests in
+        place (see ManifestInterface.extend) and moving its variables onto time domains
+        with the new endings, rather than replacing everything.
+        : file : the File, as uploaded
+        : filedata : as for upload_file_to_collection, parsed from the file as it is now
+        : returns : the number of fragments appended, or None if the file has changed in
+                    some other way, including any change to the variables other than in
+                    time (in which case nothing is changed, and it should be uploaded again).
+        """
+        manifests = filedata.get('manifests', {})
+        descriptions = {}
+        for v in filedata['variables']:
+            descriptions.setdefault(v.get('manikey'), []).append(v)
+        stored = {}
+        for v in Variable.objects.filter(in_file=file).select_related('in_manifest'):
+            stored.setdefault(v.in_manifest, []).append(v)
+        unmanaged = stored.pop(None, [])
+        if len(descriptions.get(None, [])) != len(unmanaged):
+            return None
+
+        # pair each new manifest with the stored manifest it extends
+        pairs = []
+        for key, properties in manifests.items():
+            group = descriptions.get(key, [])
+            domains = {json.dumps(v['time_domain'], sort_keys=True) for v in group}
+            if len(domains) != 1:
+                return None
+            for m, variables in stored.items():
+                if len(variables) == len(group) and self.manifest.extension(m, properties) is not None:
+                    pairs.append((m, properties, group, stored.pop(m)))
+                    break
+            else:
+                return None
+        if stored:
+            return None
+
+        appended = 0
+        try:
+            with interning.atomic():
+                checks = [(None, descriptions.get(None, []), unmanaged)] + [
+                    (m, group, variables) for m, properties, group, variables in pairs]
+                for m, group, variables in checks:
+                    if not self._unchanged(file, m, group, variables):
+                        transaction.set_rollback(True)
+                        return None
+                for m, properties, group, variables in pairs:
+                    domain = group[0]['time_domain']
+                    n = self.manifest.extend(m, properties)
+                    if n is None:
+                        transaction.set_rollback(True)
+                        return None
+                    appended += n
+                    td = self.tdomain.get_or_create(domain)
+                    old = {v.time_domain for v in variables} - {td, None}
+                    Variable.objects.filter(id__in=[v.id for v in variables]).update(time_domain=td)
+                    for o in old:
+                        if not o.variable_set.exists():
+                            o.delete()
+                change = filedata['properties']['size'] - file.size
+                file.size = filedata['properties']['size']
+                file.mtime = filedata['properties'].get('mtime', file.mtime)
+                file.save()
+                file.locations.update(volume=F('volume') + change)
+        finally:
+            # we may have removed (or rolled back) time domains which are in the interning caches
+            interning.invalidate()
+        logger.info(f'Extended {file.name} with {appended} new fragments')
+        return appended
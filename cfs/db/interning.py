@@ -0,0 +1,134 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.db import transaction
+import logging
+logger = logging.getLogger(__name__)
+
+###
+### During ingest the same few properties, domains, time domains and cell methods
+### turn up in file after file. These caches remember the model instances we have
+### already found (or made) so that repeat lookups do not go to the database.
+###
+### The caches are only used inside an interning session (see session below),
+### and are emptied when it ends, so they can never hold instances which have been
+### deleted by something else in the meantime. They are also emptied whenever a
+### transaction managed by atomic (below) is rolled back, since they may hold
+### instances which were created in that transaction and no longer exist.
+###
+
+DEFAULT_SIZE = 10000
+
+_sessions = 0
+
+class InternCache:
+    """
+    A bounded least recently used map from natural keys to model instances,
+    which keeps count of hits and misses. Each cache registers itself so that
+    all of them can be invalidated together.
+    : name : used for reporting
+    : maxsize : maximum number of instances held
+    """
+    _caches = []
+
+    def __init__(self, name, maxsize=DEFAULT_SIZE):
+        self.name = name
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        InternCache._caches.append(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Return the instance for key, or None if we do not have it """
+        if not _sessions:
+            return None
+        try:
+            instance = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return instance
+
+    def put(self, key, instance):
+        """ Remember an instance, dropping the least recently used if we are full """
+        if not _sessions or instance is None:
+            return
+        self._entries[key] = instance
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def lookup(self, key, factory):
+        """
+        Return the instance for key, calling factory() to find or create
+        it (and remembering the result) if we do not have it.
+        """
+        instance = self.get(key)
+        if instance is None:
+            instance = factory()
+            self.put(key, instance)
+        return instance
+
+    def clear(self):
+        self._entries.clear()
+
+    def reset(self):
+        """ Empty the cache and zero the counters """
+        self.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits':self.hits, 'misses':self.misses, 'size':len(self)}
+
+
+def invalidate():
+    """ Empty all the caches (but keep the counters) """
+    for cache in InternCache._caches:
+        cache.clear()
+
+def cache_stats():
+    """
+    Hit and miss counts for each cache, for the current session, or, if there
+    is no current session, the most recent one.
+    """
+    return {cache.name: cache.stats() for cache in InternCache._caches}
+
+@contextmanager
+def session(maxsize=None):
+    """
+    Use the interning caches within this context. Sessions can be nested,
+    the caches are emptied (and the counters reported) when the outermost one ends.
+    : maxsize : optionally change the size of all the caches
+    """
+    global _sessions
+    if not _sessions:
+        for cache in InternCache._caches:
+            cache.reset()
+            if maxsize is not None:
+                cache.maxsize = maxsize
+    _sessions += 1
+    try:
+        yield
+    finally:
+        _sessions -= 1
+        if not _sessions:
+            logger.info(f'Interning cache usage {cache_stats()}')
+            invalidate()
+
+@contextmanager
+def atomic():
+    """
+    Equivalent to django.db.transaction.atomic, but if the block is rolled
+    back, all the caches are invalidated.
+    """
+    try:
+        with transaction.atomic():
+            yield
+    except Exception:
+        invalidate()
+        raise
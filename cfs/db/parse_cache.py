@@ -0,0 +1,136 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import pickle
+import logging
+logger = logging.getLogger(__name__)
+
+###
+### An on-disk cache of the results of parsing files with parse_file_todict, so
+### that re-ingesting unchanged files (into a fresh database, a test database or
+### at another site) does not need to read them with cf-python again.
+###
+
+# Change this whenever the output of parse_fields_todict changes, so that
+# results cached by older versions are not used.
+PARSER_VERSION = 1
+
+DEFAULT_MAX_BYTES = 2**30
+
+class ParseCache:
+    """
+    A directory of pickled (descriptions, manifests, number of fields) tuples, as
+    produced by parse_file_todict, keyed by the identity of the file and by everything
+    else which affects the parsing (parser version, vocab, cfa, lookup and fixer).
+
+    Files are identified either by (path, size, modification time), which is cheap,
+    or by (size, md5 checksum of the content), which is not, but which is independent
+    of the path (and so works for copies of the same files elsewhere).
+
+    The cache is kept below max_bytes by removing the least recently used entries.
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, checksum=False, version=''):
+        """
+        : directory : where to keep the cache, created if necessary
+        : max_bytes : maximum size of the cache
+        : checksum : if True, identify files by checksum rather than path and modification time
+        : version : an additional version string to include in all keys (e.g. the version of
+                    a vocabulary, or of any fixer, which would not otherwise be recognised)
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.checksum = checksum
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._size = sum(p.stat().st_size for p in self.directory.glob('*.pkl'))
+
+    def key(self, path, lookup_xy=None, vocab=None, cfa=False, fixer=None, fast=False, accessor=None):
+        """
+        The cache key for parsing the file at path with parse_file_todict and these arguments.
+        Fixers (and fragment accessors) are identified by name, and by their version attribute
+        if they have one.
+        (The fast option does not change the results, so is not part of the key.)
+        """
+        stat = os.stat(path)
+        if self.checksum:
+            md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    md5.update(block)
+            identity = [stat.st_size, md5.hexdigest()]
+        else:
+            identity = [str(Path(path).resolve()), stat.st_size, stat.st_mtime]
+        def name(thing):
+            if thing is None:
+                return None
+            if not hasattr(thing, '__qualname__'):
+                # an instance, e.g. an accessor
+                thing = type(thing)
+            return [f'{thing.__module__}.{thing.__qualname__}', getattr(thing, 'version', None)]
+        parameters = [PARSER_VERSION, self.version, vocab, bool(cfa), name(lookup_xy), name(fixer)]
+        if accessor is not None:
+            parameters.append(name(accessor))
+        return hashlib.sha256(json.dumps(identity + parameters).encode('utf-8')).hexdigest()
+
+    def _entry(self, key):
+        return self.directory/f'{key}.pkl'
+
+    def get(self, key):
+        """ Return the cached result for key, or None """
+        entry = self._entry(key)
+        try:
+            with open(entry, 'rb') as f:
+                result = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f'Ignoring unreadable parse cache entry {entry} ({e})')
+            self._remove(entry)
+            self.misses += 1
+            return None
+        # mark as recently used, for eviction
+        os.utime(entry)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """ Cache result (a tuple of descriptions, manifests, number of fields) under key """
+        entry = self._entry(key)
+        tmp = entry.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if entry.exists():
+            self._size -= entry.stat().st_size
+        os.replace(tmp, entry)
+        self._size += entry.stat().st_size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _remove(self, entry):
+        try:
+            size = entry.stat().st_size
+            entry.unlink()
+            self._size -= size
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache is within max_bytes """
+        entries = sorted(self.directory.glob('*.pkl'), key=lambda p: p.stat().st_mtime)
+        self._size = sum(p.stat().st_size for p in entries)
+        for entry in entries:
+            if self._size <= self.max_bytes:
+                break
+            self._remove(entry)
+
+    def clear(self):
+        for entry in self.directory.glob('*.pkl'):
+            self._remove(entry)
+
+    @property
+    def size(self):
+        return self._size
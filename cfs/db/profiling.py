@@ -0,0 +1,135 @@
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+from django.db import connection
+import numpy as np
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+###
+### Instrumentation for ingest. A StageTimer accumulates the time spent in each named
+### stage of handling one file (and each field within it). These are cheap, picklable,
+### and travel back from parsing worker processes with the parse results. An IngestProfile
+### collects them for a whole ingest and summarises them.
+###
+### Database queries are only counted per file: all the variables of a file are written
+### together, with set-based lookups and bulk inserts (see VariableInterface.bulk_create),
+### so no query belongs to any one field, and a per field count would be meaningless.
+###
+
+PERCENTILES = [50, 90, 99]
+
+class StageTimer:
+    """
+    Accumulates the time spent in named stages for one file, along with the
+    per field stage times and the number of database queries (for the file as
+    a whole, as the fields are written together).
+    """
+    def __init__(self):
+        self.stages = {}
+        self.fields = []
+        self.queries = 0
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name, field=None):
+        """
+        Time the enclosed block as stage <name>. If a field record (a dictionary
+        returned by new_field) is provided, the time is also recorded against that field.
+        """
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - t0
+            self.add(name, seconds)
+            if field is not None:
+                field[name] = field.get(name, 0.0) + seconds
+
+    def new_field(self):
+        """ Start, and return, the record for another field """
+        self.fields.append({})
+        return self.fields[-1]
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+
+@contextmanager
+def count_queries(timer):
+    """
+    Add the number of database queries executed in the enclosed block to timer.queries
+    (this does not need settings.DEBUG). There is no field argument, as the queries
+    for a file are shared between its fields.
+    """
+    def counter(execute, sql, params, many, context):
+        timer.queries += 1
+        return execute(sql, params, many, context)
+    with connection.execute_wrapper(counter):
+        yield
+
+
+def _distribution(values):
+    """ Summary statistics for a list of times (or counts) """
+    values = np.asarray(values, dtype=float)
+    if values.size == 0:
+        return {}
+    summary = {'total':float(values.sum()), 'mean':float(values.mean())}
+    for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        summary[f'p{p}'] = float(v)
+    summary['max'] = float(values.max())
+    return summary
+
+
+class IngestProfile:
+    """
+    Collects the StageTimers for all the files in an ingest, and summarises them.
+    """
+    def __init__(self):
+        self.files = []
+        self.commits = []
+        # paths of the aggregations which were extended in place, rather than uploaded again
+        self.extended = []
+        self.started = perf_counter()
+
+    def add(self, path, timer):
+        self.files.append((str(path), timer))
+
+    def add_commit(self, seconds):
+        self.commits.append(seconds)
+
+    def summary(self, slowest=10):
+        """
+        Return a dictionary with totals and percentiles (over files, and over fields) of the
+        time spent in each stage, and (over files only) of the queries, along with the slowest files.
+        : slowest : the number of slowest files to report
+        """
+        stages = sorted({s for p, t in self.files for s in t.stages})
+        field_stages = sorted({s for p, t in self.files for f in t.fields for s in f})
+        ranked = sorted(self.files, key=lambda x: x[1].total, reverse=True)
+        return {
+            'files': len(self.files),
+            'fields': sum(len(t.fields) for p, t in self.files),
+            'wall': perf_counter() - self.started,
+            'stages': {s: _distribution([t.stages.get(s, 0.0) for p, t in self.files]) for s in stages},
+            'field_stages': {s: _distribution([f.get(s, 0.0) for p, t in self.files for f in t.fields])
+                             for s in field_stages},
+            'queries': _distribution([t.queries for p, t in self.files]),
+            'commits': _distribution(self.commits) | {'count':len(self.commits)},
+            'slowest_files': [{'path':p, 'total':t.total, 'stages':t.stages, 'queries':t.queries}
+                              for p, t in ranked[:slowest]],
+        }
+
+    def to_json(self, filename=None, slowest=10):
+        """
+        Return the summary as JSON, and if filename is provided, also write it there.
+        """
+        result = json.dumps(self.summary(slowest=slowest), indent=2)
+        if filename is not None:
+            Path(filename).write_text(result)
+            logger.info(f'Ingest profile written to {filename}')
+        return result
@@ -0,0 +1,176 @@
+from django.db import connection
+from django.db.models import Q
+import re
+import logging
+logger = logging.getLogger(__name__)
+
+###
+### Ranked full text search over collections (name, description and tags) and variables
+### (identity, standard and long names, and the text of their other properties). With
+### SQLite we keep an FTS5 table alongside the model tables, which is updated as collections
+### and variables are saved and deleted (see the receivers in cfs.models, and
+### VariableInterface.bulk_create). Each row is a document with a title (the names, which
+### count for more in the ranking) and a body (everything else). With other databases
+### (or an SQLite without FTS5) searches fall back to matching terms in the model tables,
+### ranked by how many of the terms are matched.
+###
+
+TABLE = 'cfs_search'
+VARIABLE, COLLECTION = 0, 1
+# bm25 weights for the title and body columns
+WEIGHTS = (10.0, 1.0)
+# key properties which are names, the rest go in the body
+TITLE_KEYS = {'ID', 'SN', 'LN'}
+
+_ready = {}
+
+
+def available():
+    """
+    Is there (or can we make) an FTS5 table in the current database? (This is normally
+    made along with the database, see cfs.db.standalone. If we have to make it inside a
+    transaction, which might yet be rolled back, we check again next time.)
+    """
+    name = connection.settings_dict['NAME']
+    if name in _ready:
+        return _ready[name]
+    if connection.vendor != 'sqlite':
+        _ready[name] = False
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5"
+                           f"(title, body, tokenize='unicode61 remove_diacritics 2')")
+    except Exception as e:
+        logger.warning(f'Full text search will not be indexed ({e})')
+        _ready[name] = False
+        return False
+    if not connection.in_atomic_block:
+        _ready[name] = True
+    return True
+
+
+def _rowid(kind, id):
+    # variables and collections share the table, so interleave their ids
+    return 2*id + kind
+
+
+def _text(value):
+    """ The searchable text in a property value """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, tuple)):
+        return ' '.join(_text(v) for v in value)
+    return ''
+
+
+def _write(documents):
+    """ Replace the rows for a list of (rowid, title, body) documents """
+    if not documents:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {TABLE} WHERE rowid = %s', [(d[0],) for d in documents])
+        cursor.executemany(f'INSERT INTO {TABLE} (rowid, title, body) VALUES (%s, %s, %s)', documents)
+
+
+def remove(kind, ids):
+    """ Remove the documents for variables (or collections) with these ids """
+    if ids and available():
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {TABLE} WHERE rowid = %s', [(_rowid(kind, i),) for i in ids])
+
+
+def index_variables(variables):
+    """
+    (Re)index a list of saved variables, with one query for all their key properties
+    """
+    if not variables or not available():
+        return
+    from cfs.models import VariablePropertySet
+    through = VariablePropertySet.properties.through
+    sets = {v.key_properties_id for v in variables}
+    properties = {}
+    for set_id, key, value in through.objects.filter(variablepropertyset_id__in=sets).values_list(
+            'variablepropertyset_id', 'variableproperty__key', 'variableproperty__value'):
+        properties.setdefault(set_id, []).append((key, value or ''))
+    documents = []
+    for v in variables:
+        kp = properties.get(v.key_properties_id, [])
+        title = ' '.join(value for key, value in kp if key in TITLE_KEYS)
+        body = ' '.join([value for key, value in kp if key not in TITLE_KEYS] +
+                        [_text(value) for value in v._proxied.values()])
+        documents.append((_rowid(VARIABLE, v.pk), title, body))
+    _write(documents)
+
+
+def index_collections(collections):
+    """ (Re)index a list of saved collections """
+    if not collections or not available():
+        return
+    documents = []
+    for c in collections:
+        body = ' '.join([c.description] + [t.name for t in c.tags.all()] +
+                        [_text(value) for value in c._proxied.values()])
+        documents.append((_rowid(COLLECTION, c.pk), c.name, body))
+    _write(documents)
+
+
+def rebuild(batch_size=1000):
+    """
+    Index everything from scratch (e.g. for a database loaded before the index was kept)
+    : returns : the number of collections and variables indexed
+    """
+    from cfs.models import Collection, Variable
+    if not available():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE}')
+    index_collections(list(Collection.objects.all()))
+    n = Collection.objects.count()
+    ids = list(Variable.objects.order_by('id').values_list('id', flat=True))
+    for i in range(0, len(ids), batch_size):
+        index_variables(list(Variable.objects.filter(id__in=ids[i:i+batch_size])))
+    return n + len(ids)
+
+
+def _terms(text):
+    return re.findall(r'\w+', text.lower())
+
+
+def search(text, kind, limit=50):
+    """
+    Find the variables (or collections) best matching all the words in text
+    (each word matches words starting with it).
+    : kind : VARIABLE or COLLECTION
+    : returns : a list of ids, best match first
+    """
+    terms = _terms(text)
+    if not terms:
+        return []
+    if not available():
+        return _fallback(terms, kind, limit)
+    query = ' '.join(f'"{t}"*' for t in terms)
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s AND rowid %% 2 = %s '
+                       f'ORDER BY bm25({TABLE}, {WEIGHTS[0]}, {WEIGHTS[1]}) LIMIT %s', [query, kind, limit])
+        return [rowid//2 for (rowid,) in cursor.fetchall()]
+
+
+def _fallback(terms, kind, limit):
+    """
+    Search without FTS5: find everything matching any of the terms (anywhere in a
+    name or property), ranked by the number of terms matched.
+    """
+    from cfs.models import Collection, Variable
+    if kind == VARIABLE:
+        model, fields = Variable, ['key_properties__properties__value', 'attributes__value']
+    else:
+        model, fields = Collection, ['name', 'description', 'tags__name']
+    scores = {}
+    for t in terms:
+        q = Q()
+        for f in fields:
+            q |= Q(**{f'{f}__icontains': t})
+        for i in model.objects.filter(q).values_list('id', flat=True).distinct():
+            scores[i] = scores.get(i, 0) + 1
+    return sorted(scores, key=lambda i: (-scores[i], i))[:limit]
@@ -79,6 +79,10 @@ def check_and_create_database():
         execute_from_command_line(['manage.py','migrate'])
     else:
         print("Using existing database without modification")
+    # the full text search and bitmap version tables are not models, so are not made by the migrations
+    from cfs.db import bitmaps, search
+    search.available()
+    bitmaps.available()
 
 def setup_migrations_location(migrations_location):
     """
@@ -289,6 +289,50 @@ class LookupT:
             'calendar': getattr(tdim, "calendar", 'standard')
         }
     
+    def extract_header_temporal(self, field, tcoord):
+        """
+        As extract_cfstemporal, but for the lightweight field and time coordinate
+        descriptions made by cfs.db.header_parsing from the netCDF header (and a
+        few time values), rather than from cf-python constructs.
+
+        :param field: a HeaderField
+        :param tcoord: its HeaderCoordinate for time, or None
+        :return:  A dictionary defining the time domain associated with
+                  the field.
+        """
+        if tcoord is None:
+            return {}
+        ncvar = tcoord.ncvar
+        if ncvar not in self.bounds:
+            self.bounds[ncvar] = float(tcoord.value(0)),float(tcoord.value(-1))
+        bounds = self.bounds[ncvar]
+
+        if ncvar not in self.inferred:
+            try:
+                interval, interval_offset, interval_units = self.xios_resolution(field)
+            except ValueError as err:
+                if 'XIOS' in str(err):
+                    interval_offset=None
+                    units = cf.Units(tcoord.units, calendar=tcoord.calendar)
+                    data = cf.Data([tcoord.value(0), tcoord.value(2)], units=units)
+                    delta = (data[1]-data[0])/2
+                    interval, interval_units = self.infer_temporal_resolution(tcoord, delta)
+                else:
+                    raise
+            self.inferred[ncvar] = interval, interval_units,interval_offset
+        else:
+            interval, interval_units, interval_offset = self.inferred[ncvar]
+
+        return {
+            'interval': interval,
+            'interval_units': interval_units,
+            'interval_offset': interval_offset,
+            'starting': bounds[0],
+            'ending': bounds[1],
+            'units': tcoord.units,
+            'calendar': tcoord.calendar or 'standard'
+        }
+
     def infer_temporal_resolution(self,tdim, delta):
         """
         Guess temporal resolution, based on cell methods and 
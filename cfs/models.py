@@ -1,13 +1,16 @@
 from django.db import models
 from django.db.models import Q, Count,OuterRef, Subquery, UniqueConstraint
 from django.core.exceptions import ValidationError
-from django.db.models.signals import pre_delete, m2m_changed, post_delete
+from django.db.models.signals import pre_delete, m2m_changed, post_delete, post_save
 import hashlib
+import json
 from pathlib import Path
 import logging
 logger = logging.getLogger(__name__)
 import cf
 import math
+from cfs.db import search
+from cfs.db import bitmaps, facets
 
 
 from django.dispatch import receiver
@@ -227,6 +230,7 @@ class File(models.Model):
 
     class Meta:
         app_label = 'cfs'
+        indexes = [models.Index(fields=['name', 'path'], name='file_name_path')]
 
     id = models.AutoField(primary_key=True)
     
@@ -243,6 +247,9 @@ class File(models.Model):
     checksum_method = models.CharField(max_length=8,null=True)
     uuid = models.UUIDField(null=True)
     format = models.CharField(max_length=3, null=True)
+    # modification time (seconds since epoch) when we last parsed the file,
+    # used to decide whether a re-scan needs to parse it again.
+    mtime = models.FloatField(null=True)
     #if there is a remotely accessible version
     #definition of remote includes our own tape system.
     remoteuri = models.URLField(null=True,max_length=200)
@@ -289,13 +296,21 @@ class File(models.Model):
         if not islastvar:
             for v in candidates: 
                 v.delete()
+        # Manifests can be shared by other CFA files aggregating the same
+        # fragments, if so, hand them over to one of those rather than
+        # letting them go with us.
+        for m in self.manifests.all():
+            other = m.variable_set.exclude(in_file=self).first()
+            if other is not None:
+                m.cfa_file = other.in_file
+                m.save()
         # We need to get rid of fragments here, if we a manifest, since
         # when we are deleted, our manifest goes too, leaving the fragments
         # isolated, and we need to handle their deletion to get volumes
         # to work properly
         if hasattr(self,'manifests'):
             for m in self.manifests.all():
-                for f in m.fragments.all():
+                for f in m.fragments.files.all():
                     f.delete()
 
     def delete(self,*args,**kwargs):
@@ -308,30 +323,62 @@ class FileSet(models.Model):
     """ 
     Provides a single view of a set of files, e.g. associated with
     a manifest. We need this to simplify concepts of uniqueness, and 
-    improve performance in filtering.
+    improve performance in filtering. The files are ordered (for manifests,
+    in the order of the fragment bounds), with each position held in the
+    FileSetMember through table.
     """
-    files = models.ManyToManyField(File)
+    files = models.ManyToManyField(File, through='FileSetMember')
     key = models.CharField(max_length=64, unique=True)
 
     def __str__(self):
-        return ','.join([str(f) for f in self.files.all()])
+        return ','.join([str(f) for f in self.ordered_files()])
 
     @staticmethod
     def generate_key(files):
-        """Generate a unique key (e.g., hash) for a list of property ids."""
-        file_ids = sorted([str(f.id) for f in files])
+        """Generate a unique key (e.g., hash) for an ordered list of files."""
+        file_ids = [str(f.id) for f in files]
         key_string = ",".join(file_ids)
         return hashlib.md5(key_string.encode('utf-8')).hexdigest()
 
     @classmethod
     def get_or_create_from_files(cls, files):
-        """Retrieve or create a FileSet based on the list of files."""
+        """Retrieve or create a FileSet based on the (ordered) list of files."""
         key = cls.generate_key(files)
         file_set, created = cls.objects.get_or_create(key=key)
         if created:
-            file_set.files.set(files) 
+            FileSetMember.objects.bulk_create(
+                [FileSetMember(fileset=file_set, file=f, position=i) for i, f in enumerate(files)])
         return file_set, created
 
+    def ordered_files(self, start=0, stop=None):
+        """
+        Return the files in positions start to stop-1 (or to the end, if stop is None),
+        in order, with one indexed query.
+        """
+        criteria = {'filesetmember__fileset':self, 'filesetmember__position__gte':start}
+        if stop is not None:
+            criteria['filesetmember__position__lt'] = stop
+        return File.objects.filter(**criteria).order_by('filesetmember__position')
+
+    def files_at(self, positions):
+        """ Return the files at the given positions (in position order) with one query """
+        return File.objects.filter(filesetmember__fileset=self,
+                                   filesetmember__position__in=positions).order_by('filesetmember__position')
+
+
+class FileSetMember(models.Model):
+    """
+    The position of a file within a FileSet.
+    """
+    class Meta:
+        app_label = 'cfs'
+        ordering = ['fileset', 'position']
+        constraints = [UniqueConstraint(fields=['fileset', 'position'], name='unique_fileset_position')]
+
+    fileset = models.ForeignKey(FileSet, on_delete=models.CASCADE)
+    file = models.ForeignKey(File, on_delete=models.CASCADE)
+    position = models.PositiveIntegerField()
+
 
 class Location(models.Model):
   
@@ -360,9 +407,14 @@ class Manifest(models.Model):
 
     class Meta:
         app_label = 'cfs'
+        indexes = [models.Index(fields=['manikey', 'bounds_hash'], name='manifest_content')]
 
     id = models.AutoField(primary_key=True)
     cfa_file = models.ForeignKey(File, on_delete=models.CASCADE, related_name="manifests")
+    # identify the content (fragment files and bounds) so that other CFA files
+    # aggregating the same fragments can share this manifest
+    manikey = models.CharField(null=True, max_length=64)
+    bounds_hash = models.CharField(null=True, max_length=64)
     fragments = models.ForeignKey(FileSet, null=True, on_delete=models.CASCADE)
     bounds = models.BinaryField(null=True)
     units = models.CharField(null=True, max_length=20)
@@ -370,6 +422,10 @@ class Manifest(models.Model):
     total_size = models.PositiveBigIntegerField(null=True)
     parent_uuid = models.UUIDField(null=True)
     is_quark = models.BooleanField(default=False)
+    # summary of the temporal coverage, in the units of the bounds (see cfs.db.coverage)
+    coverage_start = models.FloatField(null=True)
+    coverage_end = models.FloatField(null=True)
+    coverage = models.JSONField(null=True)
 
     def delete(self,*args,**kwargs):
         kwargs.pop('islastvar',None)
@@ -385,14 +441,20 @@ class Manifest(models.Model):
     def __str__(self):
         fcount = self.fragment_count()
         lines = [f'Manifest {self.id} for {self.cfa_file} has {fcount} fragments',
-                 f'     (First file {self.fragments.files.first()},',
-                 f'      Last file  {self.fragments.files.last()} )']
+                 f'     (First file {self.fragments.ordered_files().first()},',
+                 f'      Last file  {self.fragments.ordered_files().last()} )']
         return '\n'.join(lines)
        
+    def fragment_names(self, chunk_size=2000):
+        """
+        Iterate over the fragment file names, in order, without loading the files
+        (or all the names at once)
+        """
+        return self.fragments.ordered_files().values_list('name', flat=True).iterator(chunk_size=chunk_size)
+
     def fragments_as_text(self):
         """ Download a list of fragments for action"""
-        fragments = self.fragments.files.all()
-        return '\n'.join([f.name for f in fragments])
+        return '\n'.join(self.fragment_names())
     
     def fragment_count(self):
         return self.fragments.files.count()
@@ -506,6 +568,11 @@ class VariablePropertyKeys(models.TextChoices):
         reversed = {v:k for k,v in cls.choices}
         return reversed[myvalue]
 
+# The key properties which are read most often (for display and listing), which are
+# also kept with each variable (see Variable.key_summary), so they can be read without
+# a query.
+HOT_KEYS = ['ID', 'SN', 'LN', 'AO', 'VL', 'F']
+
 class VariableProperty(models.Model):
     """ 
     We hold all the properties which get used as keys and values of 
@@ -550,6 +617,15 @@ class VariablePropertySet(models.Model):
             property_set.properties.set(properties)  # Set properties if it's a new VariablePropertySet
         return property_set, created
 
+    @staticmethod
+    def summarise(properties):
+        """ The summary of a list of properties kept with a variable (see HOT_KEYS) """
+        return {p.key: p.value for p in properties if p.key in HOT_KEYS}
+
+    def summary(self):
+        """ The summary of this set of properties kept with its variables """
+        return self.summarise(self.properties.filter(key__in=HOT_KEYS))
+
 
 class Variable(models.Model):
     """
@@ -594,6 +670,8 @@ class Variable(models.Model):
     cell_methods = models.ForeignKey(Cell_MethodSet, null=True, on_delete=models.SET_NULL)
     in_file = models.ForeignKey(File, on_delete=models.CASCADE)
     in_manifest = models.ForeignKey(Manifest, null=True, on_delete=models.SET_NULL)
+    # a copy of the most used key properties (HOT_KEYS), so get_kp needs no query for those
+    key_summary = models.JSONField(null=True)
 
     def __str__(self):
         """ String representation using the identity key property"""
@@ -629,6 +707,8 @@ class Variable(models.Model):
         # Use the mykey method from VariablePropertyKeys to map from prop_name to the enum value
         try:
             key_code = VariablePropertyKeys.mykey(key)
+            if self.key_summary is not None and key_code in HOT_KEYS:
+                return self.key_summary.get(key_code)
             return self.key_properties.properties.get(key=key_code).value
         except (KeyError, VariableProperty.DoesNotExist):
             return None  # Return None if no matching property is found
@@ -663,13 +743,29 @@ class Variable(models.Model):
                 self.key_properties, _ = VariablePropertySet.get_or_create_from_properties(kp)
             else:
                 self.key_properties = kp
+        if isinstance(kp, list) and kp:
+            self.key_summary = VariablePropertySet.summarise(kp)
+        elif self.key_properties_id is not None:
+            self.key_summary = self.key_properties.summary()
         if self.get_kp('identity') is None:
             raise ValueError(f"One of the key_properties ({kp}) must be 'identity'!")
 
         unique, _ = self.__check_uniqueness(kp, self._proxied, self.spatial_domain, self.time_domain,
                                     self.cell_methods, self.in_file, self.in_manifest)
         if unique:
-            super().save(*args, **kwargs)
+            previous = None
+            if self.pk is not None:
+                previous = Variable.objects.filter(pk=self.pk).values_list('key_properties_id', flat=True).first()
+            if previous is not None and previous != self.key_properties_id:
+                # the facet counts of any collections holding this variable change too
+                memberships = list(self.contained_in.values_list('id', flat=True))
+                facets.adjust([(c, self.pk) for c in memberships], -1)
+                super().save(*args, **kwargs)
+                facets.adjust([(c, self.pk) for c in memberships], 1)
+                bitmaps.index.invalidate()
+            else:
+                super().save(*args, **kwargs)
+            ProxiedAttribute.index([self])
         else:
             raise ValueError(f'Cannot save non-unique variable with value {args}')   
 
@@ -751,13 +847,153 @@ class Variable(models.Model):
                     instance.delete(islastvar=True)
     
     def delete(self,*args,**kwargs):
+        # leave collections first, so their facet counts are kept while we still know our properties
+        self.contained_in.clear()
         self.predelete()
         super().delete(*args,**kwargs)
 
- 
 
+class ProxiedAttribute(models.Model):
+    """
+    One of the _proxied properties of a variable, as a (key, value) row, so that
+    variables can be found by any of those properties in SQL. These are kept in step
+    by Variable.save and VariableInterface.bulk_create, and go with the variable.
+    Values are held as JSON, and found by a digest of that (as values can be long).
+    """
+    class Meta:
+        app_label = 'cfs'
+        indexes = [models.Index(fields=['key', 'digest'], name='proxied_key_value')]
 
+    variable = models.ForeignKey(Variable, on_delete=models.CASCADE, related_name='attributes')
+    key = models.CharField(max_length=256)
+    value = models.TextField()
+    digest = models.CharField(max_length=32)
 
-   
+    @staticmethod
+    def encode(value):
+        """
+        The JSON text and digest for a property value. Whole numbers are held as integers,
+        so that (as for python comparisons) 1.0 matches 1.
+        """
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        text = json.dumps(value, sort_keys=True)
+        return text, hashlib.md5(text.encode('utf-8')).hexdigest()
 
-  
+    @classmethod
+    def index(cls, variables, replace=True, batch_size=500):
+        """
+        (Re)make the rows for a list of (saved) variables
+        : replace : if False, the variables are new, so there are no rows to remove
+        """
+        if replace:
+            cls.objects.filter(variable__in=[v.pk for v in variables]).delete()
+        rows = []
+        for v in variables:
+            for key, value in v._proxied.items():
+                text, digest = cls.encode(value)
+                rows.append(cls(variable_id=v.pk, key=key, value=text, digest=digest))
+        cls.objects.bulk_create(rows, batch_size=batch_size)
+
+    def __str__(self):
+        return f'{self.key}={self.value}'
+
+
+class FacetCount(models.Model):
+    """
+    The number of variables in a collection with a given key property, for the faceted
+    browse. These are kept in step as variables join and leave collections (see cfs.db.facets).
+    """
+    class Meta:
+        app_label = 'cfs'
+        constraints = [UniqueConstraint(fields=['collection', 'property'], name='unique_facet_count')]
+
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE, related_name='facets')
+    property = models.ForeignKey(VariableProperty, on_delete=models.CASCADE, related_name='facets')
+    variable_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.collection_id}/{self.property}: {self.variable_count}'
+
+
+### Keep the full text search index (see cfs.db.search) in step with collections and variables.
+### (Variables made with VariableInterface.bulk_create are indexed there.)
+
+@receiver(post_save, sender=Variable)
+def _index_variable(sender, instance, created, **kwargs):
+    search.index_variables([instance])
+    if created:
+        bitmaps.index.variables_added([instance])
+
+@receiver(post_delete, sender=Variable)
+def _unindex_variable(sender, instance, **kwargs):
+    search.remove(search.VARIABLE, [instance.pk])
+    bitmaps.index.variables_removed([instance.pk])
+
+@receiver(post_save, sender=Collection)
+def _index_collection(sender, instance, **kwargs):
+    search.index_collections([instance])
+
+@receiver(post_delete, sender=Collection)
+def _unindex_collection(sender, instance, **kwargs):
+    search.remove(search.COLLECTION, [instance.pk])
+
+@receiver(m2m_changed, sender=Collection.tags.through)
+def _reindex_collection_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # clearing from the tag end doesn't tell us which collections were tagged
+        instance._untagged = list(instance.collection_set.values_list('pk', flat=True))
+    elif action in ['post_add', 'post_remove', 'post_clear']:
+        if reverse:
+            # changed from the tag end
+            if action == 'post_clear':
+                pk_set = instance.__dict__.pop('_untagged', [])
+            search.index_collections(list(Collection.objects.filter(pk__in=pk_set)))
+        else:
+            search.index_collections([instance])
+
+@receiver(pre_delete, sender=Tag)
+def _untag_collections(sender, instance, **kwargs):
+    # the tagging goes by cascade, without any m2m signal
+    instance._untagged = list(instance.collection_set.values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Tag)
+def _reindex_untagged(sender, instance, **kwargs):
+    search.index_collections(list(Collection.objects.filter(pk__in=instance.__dict__.pop('_untagged', []))))
+
+
+### Keep the facet counts (see cfs.db.facets) and the bitmap index (see cfs.db.bitmaps)
+### in step with collection membership. (CollectionInterface.bulk_add_variables does this itself.)
+
+@receiver(m2m_changed, sender=Collection.variables.through)
+def _count_collection_variables(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add':
+        # pk_set holds only the memberships which are new
+        if reverse:
+            memberships = [(c, instance.pk) for c in pk_set]
+        else:
+            memberships = [(instance.pk, v) for v in pk_set]
+        facets.adjust(memberships, 1)
+        bitmaps.index.memberships_changed(memberships, 1)
+    elif action in ['pre_remove', 'pre_clear']:
+        # count those memberships which exist, before they go
+        rows = sender.objects.filter(**{'variable_id' if reverse else 'collection_id': instance.pk})
+        if action == 'pre_remove':
+            rows = rows.filter(**{'collection_id__in' if reverse else 'variable_id__in': pk_set})
+        memberships = list(rows.values_list('collection_id', 'variable_id'))
+        facets.adjust(memberships, -1)
+        bitmaps.index.memberships_changed(memberships, -1)
+
+@receiver(pre_delete, sender=Variable)
+def _uncount_variable(sender, instance, **kwargs):
+    # variables deleted other than by Variable.delete, their memberships go by cascade
+    rows = Collection.variables.through.objects.filter(variable_id=instance.pk)
+    memberships = list(rows.values_list('collection_id', 'variable_id'))
+    facets.adjust(memberships, -1)
+    bitmaps.index.memberships_changed(memberships, -1)
+
+@receiver(pre_delete, sender=Collection)
+def _forget_collection_variables(sender, instance, **kwargs):
+    # the memberships go by cascade (as do the facet counts)
+    rows = Collection.variables.through.objects.filter(collection_id=instance.pk)
+    bitmaps.index.memberships_changed(rows.values_list('collection_id', 'variable_id'), -1)
@@ -1,8 +1,11 @@
 from cfs.db.file_handling import cfupload_ncfiles
+from cfs.db.cfa_tools import PosixAccessor
 from django.core.exceptions import ObjectDoesNotExist
 from pathlib import Path
+from itertools import chain
 from cfs.db.project_config import ProjectInfo
 import logging
+import sys
 
 logger = logging.getLogger(__name__)
 
@@ -11,7 +14,7 @@ class Posix:
     Supports establishing and/or updating a cfstore view of _part_ or _all_ of a 
     posix storage path, using a "collection_head" for the entire thing, and 
     "sub_collection_of" for all directories within it.
-    (Updating not yet implemented)
+    (Use update_collection to re-scan an existing collection.)
     """
 
     def __init__(self, db, location):
@@ -39,10 +42,22 @@ class Posix:
         regex='*.nc',
         intent='S',
         vocab=None,
-        fixer=None
+        fixer=None,
+        workers=1,
+        commit_every=1,
+        file_list=None,
+        profile=None,
+        parse_cache=None,
+        fast=False
     ):
         """
         Add a new collection with all netcdf files below a particular path.
+
+        Files are streamed through the ingest as the directory tree is walked (each is
+        described, has its subcollections created, is parsed and then written before
+        the walk goes much further), so the number of files in flight at any one time
+        is bounded (by commit_every and twice the number of workers) rather than by
+        the size of the tree.
         
         : path_to_collection_head : the location in which we will look for files
         : collection_name : this is the collection name to be used in the database, it needs to be uniuque.
@@ -60,6 +75,15 @@ class Posix:
                  (A, Q, S).
         : vocab: a vocab name which can be accessed by project config to get terms to be used in the db (as opposed loaded into proxies)
         : fixer : a function which can be applied to fields to fix metadata
+        : workers : number of processes to use for reading and parsing files (see cfupload_ncfiles)
+        : commit_every : number of files to upload in each database transaction (see cfupload_ncfiles)
+        : file_list : optionally, rather than walking the directory tree, use a precomputed list of files,
+            either the name of a text file with one path per line, '-' to read that list from standard
+            input, or any iterable of paths (see read_file_list). Relative paths are taken to be relative
+            to path_to_collection_head, and only paths which match regex are used.
+        : profile : optional filename for a JSON summary of where the ingest spent its time (see cfupload_ncfiles)
+        : parse_cache : optional ParseCache, or directory for one, to avoid re-reading known files (see cfupload_ncfiles)
+        : fast : if True, parse simple standalone files from their netCDF headers (see cfupload_ncfiles)
         """
         # Require a unique collection name here
         try:
@@ -85,6 +109,7 @@ class Posix:
             checksum,
             regex,
             vocab,
+            intent,
         ]
         keys = [
             "_path_to_collection_head",
@@ -94,6 +119,7 @@ class Posix:
             "_checksum",
             "_regex",
             "_vocab",
+            "_intent",
         ]
 
         if regex is None:
@@ -111,22 +137,120 @@ class Posix:
         
         # walk the directory view
         basedir = Path(path_to_collection_head)
-        dbfiles = []
-        for p in basedir.rglob(regex):
+        dbfiles = self._walk(basedir, regex, collection_name, subcollections, checksum, file_list)
+
+        first = next(dbfiles, None)
+        if first is None:
+            print(f'No {regex} files found at {basedir}')
+            return
+        dbfiles = self._add_subcollections(c, chain([first], dbfiles))
+        cfupload_ncfiles(self.db, self.location, c, vocab, dbfiles, intent, cfa=cfa, fixer=fixer,
+                         accessor=PosixAccessor() if cfa else None,
+                         workers=workers, commit_every=commit_every, profile=profile, parse_cache=parse_cache,
+                         fast=fast)
+
+    def update_collection(self, collection_name, fixer=None, workers=1, commit_every=1, remove_vanished=True,
+                          file_list=None, profile=None, parse_cache=None, fast=False):
+        """
+        Re-scan the directory tree of a collection previously established with add_collection
+        (using the same path, regex, vocab etc recorded in the collection properties), and
+        only parse and upload files which are new, or which have changed size or modification
+        time since they were uploaded. The variables from changed files are replaced, except
+        for CFA files which have only had fragments appended, which are extended in place.
+        : collection_name : name of an existing collection
+        : fixer : a function which can be applied to fields to fix metadata
+        : workers : number of processes to use for reading and parsing files (see cfupload_ncfiles)
+        : commit_every : number of files to upload in each database transaction (see cfupload_ncfiles)
+        : remove_vanished : if True, files which are no longer present in the directory tree
+            are removed (along with their variables), otherwise they are just reported.
+        : file_list : optionally use a precomputed list of files rather than walking the directory
+            tree (see add_collection). Any known files not in the list are treated as vanished.
+        : profile : optional filename for a JSON summary of where the ingest spent its time (see cfupload_ncfiles)
+        : parse_cache : optional ParseCache, or directory for one, to avoid re-reading known files (see cfupload_ncfiles)
+        : fast : if True, parse simple standalone files from their netCDF headers (see cfupload_ncfiles)
+        : returns : dictionary of the paths which were new, changed, extended, vanished and unchanged
+        """
+        c = self.db.collection.retrieve(name=collection_name)
+        basedir = Path(c['_path_to_collection_head'])
+        regex = c['_regex'] or '*.nc'
+        vocab = c['_vocab']
+        # collections made before we recorded the intent were all standalone by default
+        intent = c._proxied.get('_intent', 'S')
+        cfa = Path(regex).suffix=='.cfa'
+
+        known = {f.path: f for f in self.db.file.in_collection(c, self.location)}
+        outcome = {'new':[], 'changed':[], 'extended':[], 'vanished':[], 'unchanged':[]}
+
+        def todo():
+            # streams the files which need uploading, as we walk
+            walk = self._walk(basedir, regex, collection_name, c['_subcollections'], c['_checksum'], file_list)
+            for fd in walk:
+                existing = known.pop(fd['path'], None)
+                if existing is None:
+                    outcome['new'].append(fd['path'])
+                elif existing.size == fd['size'] and existing.mtime in [None, fd['mtime']]:
+                    # files uploaded before we kept modification times are assumed unchanged
+                    if existing.mtime is None:
+                        existing.mtime = fd['mtime']
+                        existing.save()
+                    outcome['unchanged'].append(fd['path'])
+                    continue
+                else:
+                    outcome['changed'].append(fd['path'])
+                    # replaced in the same transaction as the new upload, or for
+                    # CFA files, extended if possible (see cfupload_ncfiles)
+                    fd['replaces'] = existing
+                yield fd
+
+        profiler = cfupload_ncfiles(self.db, self.location, c, vocab, self._add_subcollections(c, todo()), intent,
+                                    cfa=cfa, accessor=PosixAccessor() if cfa else None, fixer=fixer,
+                                    workers=workers, commit_every=commit_every, profile=profile,
+                                    parse_cache=parse_cache, fast=fast, extend_aggregations=cfa)
+        extended = set(profiler.extended)
+        outcome['extended'] = [p for p in outcome['changed'] if p in extended]
+        outcome['changed'] = [p for p in outcome['changed'] if p not in extended]
+
+        for path, f in known.items():
+            outcome['vanished'].append(path)
+            if remove_vanished:
+                self.db.file.delete_with_variables(f)
+            else:
+                logger.warning(f'File {path} in collection {collection_name} has vanished from {basedir}')
+
+        logger.info(f'Update of {collection_name}: '+', '.join(f'{len(v)} {k}' for k,v in outcome.items()))
+        return outcome
+
+    def _walk(self, basedir, regex, collection_name, subcollections, checksum, file_list=None):
+        """
+        Walk the directory tree below basedir (or the file_list, if provided), and yield
+        the file dictionaries for all the files which match regex.
+        """
+        if file_list is None:
+            paths = basedir.rglob(regex)
+        else:
+            paths = (p if p.is_absolute() else basedir/p for p in read_file_list(file_list))
+            paths = (p for p in paths if p.match(regex))
+        for p in paths:
             if p.is_file():
                 if subcollections:
                     parents = get_parent_paths(p,basedir,collection_name)
                 else:
                     parents = []
-                dbfiles.append(file2dict(p, parents, checksum=checksum))
-                
-        if len(dbfiles) == 0:
-            print(f'No {regex} files found at {basedir}')
-            return
-        # create all the subcollections
+                yield file2dict(p, parents, checksum=checksum)
+            elif file_list is not None:
+                logger.warning(f'Ignoring {p} from file list, it is not a file')
+
+    def _add_subcollections(self, c, dbfiles):
+        """
+        Create the subcollections needed for each of a stream of file dictionaries,
+        yielding them once that has been done.
+        """
+        done = set()
         for f in dbfiles:
             collections = f['collections']
             for sc in collections:
+                if sc in done:
+                    continue
                 try:
                     cc = self.db.collection.retrieve(name=str(sc))
                 except ObjectDoesNotExist:
@@ -135,8 +259,9 @@ class Posix:
                     #print(f'Created {cc} with parent {pd}')
                     #ppd = self.db.collection_retrieve(pd)
                     self.db.relationship.add_double(pd,cc.name,'parent_of','subdir_of')
-        cfupload_ncfiles(self.db, self.location, c, vocab, dbfiles, intent, cfa=cfa, fixer=fixer)
-     
+                done.add(sc)
+            yield f
+
 
 def file2dict(p, parents, checksum=None):
     """
@@ -148,10 +273,33 @@ def file2dict(p, parents, checksum=None):
     """
     if checksum is not None:
         raise NotImplementedError
-    f = {"size": p.stat().st_size, "path": str(p), "name":str(p.name), 'collections':parents}
+    stat = p.stat()
+    f = {"size": stat.st_size, "mtime": stat.st_mtime, "path": str(p), "name":str(p.name),
+         'collections':parents}
 
     return f
 
+def read_file_list(file_list):
+    """
+    Yield the paths in a precomputed list of files. Blank lines, and lines
+    starting with #, are ignored.
+    : file_list : the name of a text file with one path per line, '-' to read
+        such a list from standard input, or any iterable of paths.
+    """
+    if isinstance(file_list, (str, Path)):
+        if str(file_list) == '-':
+            lines = sys.stdin
+        else:
+            with open(file_list) as f:
+                yield from read_file_list(f)
+            return
+    else:
+        lines = file_list
+    for line in lines:
+        line = str(line).strip()
+        if line and not line.startswith('#'):
+            yield Path(line)
+
 def get_parent_paths(path, basedir, headname):
     if basedir not in path.parents:
         raise ValueError(f'Base directory {basedir} not part of path {path}')
@@ -162,28 +310,3 @@ def get_parent_paths(path, basedir, headname):
         relative_path = parent.relative_to(basedir)
         parents.append(f'{headname}/{relative_path}')
     return parents
-
-
-class PosixAccessor:
-    """ 
-    This class is used within the fragment handling
-    to find the size (and optionally, checksum, of any 
-    files which are accessible at fragment ingestion 
-    """
-    def  __init__(self, checksum_method=None):
-        self.checksum_method = checksum_method
-        if self.checksum_method is not None:
-            raise NotImplementedError('No support yet for checksums in PosixAccessor')
-        self.known_files={}
-    def get(self, path):
-        if path in self.known_files:
-            return self.known_files[path]
-        else:
-            p = Path(path)
-            try:
-                s = p.stat().st_size
-                self.known_files[path]=s
-                return s
-            except:
-                #FIXME: error handling in posix accessor
-                raise 
@@ -41,17 +41,28 @@ class DomainSerializer(serializers.ModelSerializer):
 
 
 class VariableSerializer(serializers.ModelSerializer):
-    key_properties = VariablePropertySetSerializer()  # Ensure this is linked correctly
+    # taken from the key property summary kept with the variable, so no query is needed
+    key_properties = serializers.SerializerMethodField()
     time_domain = TimeDomainSerializer(allow_null=True,read_only=True)
     spatial_domain = DomainSerializer(allow_null=True, read_only=True)
     # the following is the magic incantation to use the get_cell_methods function on this class:
     cell_methods = serializers.SerializerMethodField()
     size = serializers.SerializerMethodField()
 
+    # Select properties to go to display
+    properties_to_include = ['ID','AO','VL']
+
     class Meta:
         model = Variable
         fields = ['key_properties','time_domain','spatial_domain','cell_methods','size']
 
+    def get_key_properties(self, instance):
+        summary = instance.key_summary
+        if summary is None:
+            # variables stored before the summary was kept
+            summary = instance.key_properties.summary()
+        return {k: summary[k] for k in self.properties_to_include if k in summary}
+
     def get_cell_methods(self, instance):
         if instance.cell_methods:
             return str(instance.cell_methods)
@@ -59,25 +70,3 @@ class VariableSerializer(serializers.ModelSerializer):
     
     def get_size(self, instance):
         return sizeof_fmt(instance.size)
-
-    def to_representation(self, instance):
-        # Get the default representation
-        representation = super().to_representation(instance)
-        
-        # Select properties to go to display
-        properties_to_include = ['ID','AO','VL']
-        
-        # Assuming key_properties is a dict-like structure
-        properties = representation['key_properties']['properties']
-       
-        # Create a filtered list of properties
-        filtered_properties = [
-            prop for prop in properties if prop['key'] in properties_to_include
-        ]
-
-        # Update the representation to use the filtered properties
-        # properties to include starts out as a list of dictionaries
-        representation['key_properties'] =  {item['key']: item['value'] for item in filtered_properties}
-
-        return representation
-
@@ -79,19 +79,14 @@ def get_variable_properties(request):
     """
     cell_methods = request.query_params.getlist('cell_methods')  # Accept multiple values
 
-    # Query for variables based on the selected cell methods
-    variables = Variable.objects.filter(cell_methods__id__in=cell_methods)
+    # Find the names of the variables with the selected cell methods in one query
+    properties = VariableProperty.objects.filter(
+        key__in=['SN', 'LN'],
+        variablepropertyset__variable__cell_methods__id__in=cell_methods
+        ).values_list('key', 'value').distinct().order_by('key', 'value')
 
-    # Collect standard names and long names
-    standard_names = []
-    long_names = []
-
-    for variable in variables:
-        for prop in variable.key_properties.all():
-            if prop.key == 'SN' and prop.value not in [name['value'] for name in standard_names]:
-                standard_names.append({'value': prop.value})
-            elif prop.key == 'LN' and prop.value not in [name['value'] for name in long_names]:
-                long_names.append({'value': prop.value})
+    standard_names = [{'value': value} for key, value in properties if key == 'SN']
+    long_names = [{'value': value} for key, value in properties if key == 'LN']
 
     return Response({'standard_names': standard_names, 'long_names': long_names})
 
@@ -125,7 +120,7 @@ def vocab_select(request):
         loc = loc.split(',')
     if col:
         col = col.split(',')
-    data = [{'id':v.id, 'name':v.value} for v in 
+    data = [{'id':v.id, 'name':v.value, 'count':v.variable_count} for v in 
             VariableProperyInterface.filter_properties(keylist=[key],
                                                        collection_ids=col,
                                                        location_ids=loc)]
@@ -1,7 +1,6 @@
 # views/collections.py
 from django.shortcuts import render
-from django.http import HttpResponse
-from io import BytesIO
+from django.http import StreamingHttpResponse
 import zipfile
 from cfs.db.interface import CollectionInterface, TagInterface
 
@@ -11,23 +10,82 @@ def collections(request):
     tags = TagInterface.all()
     return render(request, 'gui/collections.html', {'collections': collections, 'tags': tags})
 
+
+class _ChunkWriter:
+    """
+    A write-only file for zipfile, which just hands on whatever has been written
+    since it was last asked. (Having no tell or seek, zipfile writes the sizes
+    after each member, so nothing needs to be revisited.)
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _manifest_lines(manifest):
+    """ Yield the fragment names of a manifest, as lines of text """
+    first = True
+    for name in manifest.fragment_names():
+        yield name.encode() if first else b'\n' + name.encode()
+        first = False
+
+
+def _batched(lines, size=2**16):
+    """ Gather lines into blocks of about size bytes """
+    block = []
+    length = 0
+    for line in lines:
+        block.append(line)
+        length += len(line)
+        if length >= size:
+            yield b''.join(block)
+            block, length = [], 0
+    if block:
+        yield b''.join(block)
+
+
+def _stream_zip(name, manifests):
+    """ Yield a zip file with one text file per manifest, as it is built """
+    stream = _ChunkWriter()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        for manifest in manifests:
+            with zip_file.open(f'{name}_manifest_{manifest.id}.txt', 'w', force_zip64=True) as member:
+                for block in _batched(_manifest_lines(manifest)):
+                    member.write(block)
+                    if stream.chunks:
+                        yield stream.take()
+    yield stream.take()
+
+
 def get_manifests(request, col_id):
-    """Return a serialized view of a manifest for downloading."""
-    unique_manifests = CollectionInterface.unique_manifests(col_id)
+    """
+    Return a serialized view of a manifest for downloading, or a zip of them all if
+    there are several. Both are streamed, so the fragment lists are never all in memory.
+    """
+    # the bounds are not needed, and could be large
+    unique_manifests = CollectionInterface.unique_manifests(col_id).defer('bounds').order_by('id')
     name = CollectionInterface.retrieve(id=col_id).name
-    manifest_fragments = [manifest.fragments_as_text() for manifest in unique_manifests]
+    ids = list(unique_manifests.values_list('id', flat=True)[:2])
 
-    if len(manifest_fragments) == 1:
+    if len(ids) == 1:
         file_name = f'{name}_manifest_1.txt'
-        response = HttpResponse(manifest_fragments[0], content_type="text/plain")
+        manifest = unique_manifests.get(id=ids[0])
+        response = StreamingHttpResponse(_batched(_manifest_lines(manifest)), content_type="text/plain")
         response['Content-Disposition'] = f'attachment; filename={file_name}'
     else:
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-            for manifest, fragments in zip(unique_manifests, manifest_fragments):
-                file_name = f'{name}_manifest_{manifest.id}.txt'
-                zip_file.writestr(file_name, fragments)
-        response = HttpResponse(zip_buffer.getvalue(), content_type="application/zip")
+        response = StreamingHttpResponse(_stream_zip(name, unique_manifests.iterator()),
+                                         content_type="application/zip")
         response['Content-Disposition'] = f'attachment; filename={name}_manifests.zip'
 
-    return response
\ No newline at end of file
+    return response
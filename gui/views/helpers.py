@@ -8,10 +8,9 @@ def _filterview(selections):
     properties_ens = set(selections['dd-ens'])
     collections = set(selections['dd-col'])
     results = VariableInterface.filter_by_property_keys(
-        [properties_sname, properties_lname, properties_tave, properties_ens]
+        [properties_sname, properties_lname, properties_tave, properties_ens],
+        collections=list(collections)
         )
-    if collections:
-        results = results.filter(contained_in__in=collections)
     return results
 
 def _summary(sdata, n, nvariants):
@@ -4,6 +4,7 @@ from pathlib import Path
 from cfdm import cellmethod
 from django.db import connection
 import cf
+import sqlite3
 
 import pytest
 
@@ -183,6 +184,118 @@ def test_retrieving_by_property_keys(test_data):
     variables = test_db.variable.retrieve_by_key('institution','Narnia')
     assert len(variables) == 1
 
+def test_proxied_attribute_queries(test_data):
+    """
+    Queries on proxied properties should use the attribute index, be combined
+    with the other conditions in one query, and follow changes to the variable.
+    """
+    from cfs.models import ProxiedAttribute
+    from django.test.utils import CaptureQueriesContext
+    test_db, f, c  = test_data
+    properties = {'identity':'test var 5b','atomic_origin':'imaginary',
+                  'spatial_domain': STD_DOMAIN_PROPERTIES, 'time_domain':DAILY_TEMPORAL,
+                  'experiment':'mytest','institution':'Narnia','realization':1,'in_file':f}
+    var = test_db.variable.bulk_create([properties])[0]
+    assert {a.key for a in var.attributes.all()} == {'institution', 'realization'}
+
+    with CaptureQueriesContext(connection) as context:
+        found = list(test_db.variable.retrieve_by_queries([('institution','Narnia'), ('realization', 1.0)]))
+    assert found == [var] and len(context) == 1
+    assert len(test_db.variable.retrieve_by_key('institution','Narnia')) == 2
+    found = test_db.variable.retrieve_by_properties({'identity':'test var 5b','institution':'Narnia'})
+    assert list(found) == [var]
+    assert test_db.variable.retrieve_by_properties({'identity':'test var 5','realization':1}).count() == 0
+
+    var['institution'] = 'Atlantis'
+    var.save()
+    assert test_db.variable.retrieve_by_key('institution','Narnia').count() == 1
+    assert list(test_db.variable.retrieve_by_key('institution','Atlantis')) == [var]
+
+    ProxiedAttribute.objects.all().delete()
+    assert test_db.variable.reindex_attributes() == test_db.variable.count()
+    assert list(test_db.variable.retrieve_by_key('institution','Atlantis')) == [var]
+    var.delete()
+    assert not ProxiedAttribute.objects.filter(variable_id=var.id).exists()
+
+
+def test_text_search(test_data):
+    """
+    Full text search should rank name matches first, follow tags and deletions,
+    and give the same answers without FTS5 (if less well ranked).
+    """
+    from cfs.db import search
+    test_db, f, c  = test_data
+    common = {'atomic_origin':'imaginary', 'spatial_domain': STD_DOMAIN_PROPERTIES,
+              'time_domain':DAILY_TEMPORAL, 'in_file':f}
+    named, described = test_db.variable.bulk_create([
+        common | {'identity':'surface_snow_amount', 'long_name':'Snow on the ground'},
+        common | {'identity':'test var search', 'comment':'no snow here, just rain'}])
+    assert test_db.variable.search('snow') == [named, described]
+    assert test_db.variable.search('SNOW grou') == [named]
+    assert test_db.variable.search('rain') == [described]
+    assert test_db.variable.search('') == []
+    assert sorted(search._fallback(['snow'], search.VARIABLE, 10)) == sorted([named.id, described.id])
+    assert search._fallback(['snow', 'rain'], search.VARIABLE, 10)[0] == described.id
+
+    col = test_db.collection.create(name='search test', description='Where the snowmen are')
+    assert test_db.collection.search('snowmen') == [col]
+    test_db.tag.add_to_collection(col.name, 'blizzard')
+    assert test_db.collection.search('blizzard') == [col]
+    assert search._fallback(['blizzard'], search.COLLECTION, 10) == [col.id]
+    # untagging from the tag end, or deleting the tag, should be followed too
+    from cfs.models import Tag
+    tag = Tag.objects.get(name='blizzard')
+    tag.collection_set.clear()
+    assert test_db.collection.search('blizzard') == []
+    test_db.tag.add_to_collection(col.name, 'blizzard')
+    assert test_db.collection.search('blizzard') == [col]
+    Tag.objects.get(name='blizzard').delete()
+    assert test_db.collection.search('blizzard') == []
+    test_db.tag.add_to_collection(col.name, 'blizzard')
+    assert search.rebuild() == test_db.variable.count() + test_db.collection.count()
+    assert test_db.variable.search('snow') == [named, described]
+
+    for v in [named, described]:
+        v.delete()
+    assert test_db.variable.search('snow') == []
+    test_db.collection.delete(col)
+    assert test_db.collection.search('snowmen') == []
+
+
+def test_key_summary(test_data):
+    """
+    The most used key properties should be read from the variable without any
+    query, however the variable was made, and be restorable for old variables.
+    """
+    from cfs.models import Variable
+    from gui.serializers import VariableSerializer
+    from django.test.utils import CaptureQueriesContext
+    test_db, f, c  = test_data
+    common = {'atomic_origin':'imaginary', 'spatial_domain': STD_DOMAIN_PROPERTIES,
+              'time_domain':DAILY_TEMPORAL, 'in_file':f, 'variant_label':'r1i1p1f1'}
+    bulk = test_db.variable.bulk_create([common | {'identity':'test var summary', 'experiment':'hot'}])[0]
+    single = test_db.variable.get_or_create(common | {'identity':'test var summary 2'})
+    for v, identity in [(bulk, 'test var summary'), (single, 'test var summary 2')]:
+        v = Variable.objects.get(pk=v.pk)
+        with CaptureQueriesContext(connection) as context:
+            assert str(v) == identity
+            assert v.get_kp('atomic_origin') == 'imaginary'
+            assert v.get_kp('standard_name') is None
+            assert VariableSerializer().get_key_properties(v) == {
+                'ID':identity, 'AO':'imaginary', 'VL':'r1i1p1f1'}
+        assert len(context) == 0
+    assert bulk.get_kp('experiment') == 'hot'
+
+    Variable.objects.filter(pk=bulk.pk).update(key_summary=None)
+    old = Variable.objects.get(pk=bulk.pk)
+    assert old.get_kp('identity') == 'test var summary'
+    assert VariableSerializer().get_key_properties(old)['ID'] == 'test var summary'
+    assert test_db.variable.refresh_key_summaries() == test_db.variable.count()
+    assert Variable.objects.get(pk=bulk.pk).key_summary == bulk.key_summary
+    for v in [bulk, single]:
+        v.delete()
+
+
 def test_cell_methods_create(test_data):
     """ 
     Test creating a variable with cell methods in the properties 
@@ -241,6 +354,154 @@ def test_variables_and_collections(test_data):
     assert len(var2) == 1, f'Expected to recover just the one file from collection {c}'
     assert var2[0] == vars[0],f'Expected to recover the first variable from collection {c}'
 
+def test_facet_counts(test_data):
+    """
+    Facet counts should follow variables in and out of collections, however
+    they get there, and agree with counting the variables themselves.
+    """
+    from cfs.models import FacetCount
+    from cfs.db.interface import VariableProperyInterface
+    test_db, f, c  = test_data
+    def counted(collection):
+        counts = {}
+        for v in collection.variables.all():
+            for p in v.key_properties.properties.all():
+                counts[p.id] = counts.get(p.id, 0) + 1
+        return counts
+    def facets(collection):
+        return dict(FacetCount.objects.filter(collection=collection).values_list('property_id', 'variable_count'))
+
+    assert facets(c) == counted(c)
+    held = list(c.variables.all())
+    c1 = test_db.collection.create(name='facet test')
+    test_db.collection.bulk_add_variables([c1], held[:2])
+    test_db.collection.bulk_add_variables([c1], held[:2])
+    assert facets(c1) == counted(c1)
+    c1.variables.add(held[2])
+    held[2].contained_in.remove(c1)
+    c1.variables.add(*held)
+    assert facets(c1) == counted(c1) == facets(c)
+
+    identity = held[0].key_properties.properties.get(key='ID')
+    found = VariableProperyInterface.filter_properties(keylist=['ID'], collection_ids=[c1.id])
+    assert [(p.value, p.variable_count) for p in found if p.id == identity.id] == [(identity.value, 1)]
+    assert VariableProperyInterface.facet_counts(c1)['identity'][identity.value] == 1
+
+    c1.variables.remove(held[0])
+    assert facets(c1) == counted(c1)
+    c1.variables.clear()
+    assert facets(c1) == {}
+    FacetCount.objects.all().delete()
+    VariableProperyInterface.rebuild_facet_counts()
+    assert facets(c) == counted(c)
+    test_db.collection.delete(c1)
+
+
+def test_bitmap_index(test_data):
+    """
+    Facet selections from the bitmap index should match those made in SQL, follow
+    changes made here, and give way to SQL when the database changes elsewhere.
+    """
+    import numpy as np
+    from cfs.db import bitmaps
+    from cfs.db.bitmaps import Bitset
+    from cfs.models import Collection, Variable, VariableProperty
+    test_db, f, c  = test_data
+
+    rng = np.random.default_rng(1)
+    for sizes in [(5, 3), (400, 300), (30, 400)]:
+        a, b = (set(rng.choice(1000, n, replace=False).tolist()) for n in sizes)
+        ba, bb = Bitset.of(list(a)), Bitset.of(list(b))
+        assert set((ba & bb).to_ids()) == a & b
+        assert set((ba | bb).to_ids()) == a | b
+        assert set((ba - bb).to_ids()) == a - b
+        assert len(ba) == len(a)
+
+    common = {'atomic_origin':'imaginary', 'spatial_domain': STD_DOMAIN_PROPERTIES,
+              'time_domain':DAILY_TEMPORAL, 'in_file':f}
+    variables = test_db.variable.bulk_create([
+        common | {'identity':f'test var bitmap {i}', 'standard_name':['air_temperature', 'wind_speed'][i % 2],
+                  'frequency':['day', 'mon', '1hr'][i % 3]} for i in range(6)])
+    c1 = test_db.collection.create(name='bitmap test')
+    test_db.collection.bulk_add_variables([c1], variables[:4])
+    def pid(key, value):
+        return VariableProperty.objects.get(key=key, value=value).id
+    selections = [([[pid('SN', 'air_temperature')], [pid('F', 'day'), pid('F', 'mon')]], []),
+                  ([[pid('SN', 'wind_speed')]], [c1.id]),
+                  ([[], [pid('F', '1hr')]], [c1.id, c.id])]
+    def sql(keysets, collections):
+        results = test_db.variable.all()
+        for keyset in keysets:
+            if keyset:
+                results = results.filter(key_properties__properties__id__in=keyset)
+        if collections:
+            results = results.filter(contained_in__in=collections)
+        return sorted(set(results.values_list('id', flat=True)))
+    def check():
+        for keysets, collections in selections:
+            found = test_db.variable.filter_by_property_keys(keysets, collections)
+            assert sorted(found.values_list('id', flat=True)) == sql(keysets, collections)
+
+    index = bitmaps.index
+    index.build()
+    builds = index.builds
+    assert index.lookup(*selections[0]) == [v.id for v in variables if v.id in sql(*selections[0])]
+    check()
+
+    # changes made here are followed without rebuilding
+    extra = test_db.variable.bulk_create([common | {'identity':'test var bitmap 6',
+                                         'standard_name':'wind_speed', 'frequency':'1hr'}])[0]
+    c1.variables.add(extra)
+    variables[1].contained_in.remove(c1)
+    variables[3].delete()
+    check()
+    assert index.lookup(*selections[1]) == [extra.id]
+    assert index.builds == builds and not index.stale
+
+    # changes made elsewhere make it stale, even when interleaved with changes made
+    # here, so SQL is used until it is rebuilt
+    external = sqlite3.connect(connection.settings_dict['NAME'])
+    def elsewhere(sql, *args):
+        external.execute(sql, args)
+        external.commit()
+    index.REBUILD_INTERVAL = 3600
+    test_db.collection.bulk_add_variables([c1], [variables[1]])
+    elsewhere(f'DELETE FROM {Collection.variables.through._meta.db_table} '
+              f'WHERE collection_id = ? AND variable_id = ?', c1.id, extra.id)
+    c1.variables.remove(variables[0])
+    check()
+    assert index.stale and index.lookup(*selections[1]) is None
+    assert list(test_db.variable.filter_by_property_keys([], [c1.id]).order_by('id')) == variables[1:3]
+    index.REBUILD_INTERVAL = 0
+    check()
+    assert not index.stale and index.builds == builds + 1
+
+    # as do changes of key properties, which leave the tables the same size
+    index.REBUILD_INTERVAL = 3600
+    elsewhere(f'UPDATE {Variable._meta.db_table} SET key_properties_id = ? WHERE id = ?',
+              variables[0].key_properties_id, extra.id)
+    check()
+    assert index.stale
+    index.REBUILD_INTERVAL = 0
+    check()
+    assert not index.stale and index.builds == builds + 2
+    external.close()
+
+    # while memberships which go by cascade here are followed
+    c2 = test_db.collection.create(name='bitmap test 2')
+    c2.variables.add(*variables[:2])
+    assert index.lookup([], [c2.id]) == [variables[0].id, variables[1].id]
+    Collection.objects.filter(pk=c2.pk).delete()
+    assert index.lookup([], [c2.id]) == []
+    check()
+    assert not index.stale and index.builds == builds + 2
+    del index.REBUILD_INTERVAL
+
+    for v in variables[:3] + variables[4:] + [extra]:
+        v.delete()
+    test_db.collection.delete(c1)
+
+
 def test_deletion(test_data):
 
     test_db, f, c  = test_data
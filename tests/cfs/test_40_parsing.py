@@ -1,10 +1,12 @@
 from cfs.db.cfparsing import LookupT, extract_cfsdomain
-from cfs.db.cfparsing import parse_fields_todict, parse2atomic_name
+from cfs.db.cfparsing import parse_fields_todict, parse2atomic_name, parse_file_todict
+from cfs.db.header_parsing import NotSimple, parse_header_todict
 from cfs.db.standalone import setup_django
 from django.db import connection
 from pathlib import Path
 
 import cf
+import h5netcdf
 import numpy as np
 import pytest
 
@@ -83,6 +85,76 @@ def test_field_parsing(inputfield):
     assert adict['spatial_domain']['name'] == 'test'
     assert 'atomic_origin' in adict
 
+@pytest.fixture
+def header_files(tmp_path, inputfield):
+    """
+    Files which should be simple enough to parse from the headers. The first is
+    written by cf-python, with a mix of global and variable attributes, scalar
+    coordinates, and identities, the second by hand, with a non-standard time
+    coordinate name, qualified cell methods and no time for one variable.
+    """
+    f = inputfield.copy()
+    f.set_properties({'realm':'atmos', 'n':np.int32(3), 'd':2.5, 'history':'made up'})
+    f.nc_set_global_attributes({'institution':None, 'project':None, 'history':None})
+    g = f.copy()
+    g.del_property('standard_name')
+    g.set_property('long_name', 'something')
+    g.nc_set_variable('zzz')
+    h = f.copy()
+    h.standard_name = 'eastward_wind'
+    h.nc_set_variable('aaa')
+    h.set_construct(cf.DimensionCoordinate(properties={'standard_name':'height', 'units':'m'},
+                                           data=cf.Data([2.0])), axes=h.set_construct(cf.DomainAxis(1)))
+    h.set_property('interval_write', '1 month')
+    first = tmp_path/'header1.nc'
+    cf.write([f, g, h], first)
+
+    second = tmp_path/'header2.nc'
+    with h5netcdf.File(second, 'w') as d:
+        d.attrs['Conventions'] = 'CF-1.8'
+        d.attrs['gnum'] = np.int32(7)
+        d.dimensions = {'t':4, 'y':3, 'x':2}
+        for name, sname, units, values in [('t', 'time', 'hours since 2000-01-01', [0, 6, 12, 18]),
+                                           ('y', 'latitude', 'degrees_north', [1, 2, 3]),
+                                           ('x', 'longitude', 'degrees_east', [1, 2])]:
+            c = d.create_variable(name, (name,), 'f8')
+            c[:] = values
+            c.attrs['standard_name'] = sname
+            c.attrs['units'] = units
+        d.variables['t'].attrs['calendar'] = '360_day'
+        v = d.create_variable('v', ('t','y','x'), 'f4', fillvalue=np.float32(-99))
+        v.attrs['standard_name'] = 'air_temperature'
+        v.attrs['units'] = 'K'
+        v.attrs['scale_factor'] = np.float32(2)
+        v.attrs['cell_methods'] = 't: mean within days time: mean over days area: mean where land'
+        w = d.create_variable('w', ('y','x'), 'f4')
+        w.attrs['long_name'] = 'orog'
+        w.attrs['cell_methods'] = 'y: x: mean'
+        w.attrs['gnum'] = np.float64(3)
+    return [first, second]
+
+def test_header_parsing(header_files):
+    """
+    The descriptions from the netCDF headers should be identical to
+    those from the cf-python fields.
+    """
+    for path in header_files:
+        expected = parse_fields_todict(cf.read(path, aggregate=False))[0]
+        got, nfields = parse_header_todict(path)
+        assert nfields == len(expected)
+        assert got == expected
+        assert parse_file_todict(path, fast=True)[0] == expected
+
+def test_header_fallback(tmp_path, inputfield):
+    """ Files which are not simple should be left to cf-python """
+    path = tmp_path/'not_simple.nc'
+    aux = cf.AuxiliaryCoordinate(properties={'long_name':'band'}, data=cf.Data(np.arange(5)))
+    inputfield.set_construct(aux, axes=inputfield.domain_axis('Y', key=True))
+    cf.write(inputfield, path)
+    with pytest.raises(NotSimple):
+        parse_header_todict(path)
+    assert parse_file_todict(path, fast=True)[0] == parse_file_todict(path)[0]
+
 def test_upload_parsed_dict(inputfield, test_db):
     """ Can we sensibly upload a variable from this parsed dictionary?"""
 
@@ -1,12 +1,15 @@
 from pathlib import Path
-from cfs.db.cfa_tools import CFAhandler
+from cfs.db.cfa_tools import (CFAhandler, CFAReader, FragmentAccessor, db2numpy, fragment_bounds,
+                              blob_compression, is_legacy_blob, numpy2db)
 from cfs.db.cfparsing import parse_fields_todict
 from cfs.db.standalone import setup_django
 
 
 import cf
+import io
 import numpy as np
 import pytest
+from time import perf_counter
 
 @pytest.fixture(scope="module", autouse=True)
 def setup_test_db(tmp_path_factory, request):
@@ -68,6 +71,187 @@ def test_cfa_handler(cfa_only):
 
     assert len(c.known_manifests) == 1
 
+def test_fragment_sizes(cfa_only):
+    """
+    Fragment sizes should be found in one concurrent batch, and
+    remembered for any other manifests using the same files.
+    """
+    from cfs.plugins.posix import PosixAccessor
+
+    class CountingAccessor(PosixAccessor):
+        def __init__(self):
+            super().__init__(workers=4)
+            self.stats = []
+        def _stat(self, path):
+            self.stats.append(path)
+            return super()._stat(path)
+
+    accessor = CountingAccessor()
+    fields = cf.read(cfa_only.glob('*.cfa'))
+    c = CFAhandler(expected_fields=len(fields), accessor=accessor)
+    for f in fields:
+        key = c.parse_field_to_manifest(f)
+    fragments = c.known_manifests[key]['fragments']
+    assert len(fragments) == 3
+    for path, fragment in fragments.items():
+        assert fragment['size'] == Path(path.removeprefix('file:')).stat().st_size
+    assert len(accessor.stats) == 3
+
+    missing = str(cfa_only/'not_a_fragment.nc')
+    sizes = accessor.get_sizes(list(fragments) + [missing])
+    assert sizes[missing] is None
+    assert not accessor.exists(missing)
+    assert len(accessor.stats) == 4
+
+    with pytest.raises(NotImplementedError):
+        FragmentAccessor().get_size(missing)
+
+
+@pytest.mark.benchmark
+def test_fragment_bounds_benchmark():
+    """
+    The vectorised fragment bounds should match those from walking the
+    fragments one by one, for long aggregations (here 100k time steps in
+    5k fragments of varying length). The timings of both are reported
+    (run with -s to see them).
+    """
+    def loop_bounds(bounds, alocations):
+        newbounds = []
+        left = 0
+        for n in alocations:
+            right = left + n - 1
+            newbounds.append([bounds[left][0], bounds[right][1]])
+            left += n
+        return np.array(newbounds)
+
+    rng = np.random.default_rng(42)
+    sizes = rng.integers(1, 40, 5000)
+    sizes[-1] += 100000 - sizes.sum()
+    assert sizes.min() > 0
+    edges = np.arange(100001, dtype='f8')
+    bounds = np.column_stack((edges[:-1], edges[1:]))
+
+    t0 = perf_counter()
+    expected = loop_bounds(bounds, sizes)
+    t1 = perf_counter()
+    got = fragment_bounds(bounds, sizes)
+    t2 = perf_counter()
+    print(f'Fragment bounds: loop {t1-t0:.4f}s, vectorised {t2-t1:.4f}s')
+    assert np.array_equal(got, expected)
+
+    with pytest.raises(ValueError):
+        fragment_bounds(bounds, sizes[:-1])
+
+
+def test_non_leading_time(tmp_path, inputfield):
+    """
+    The fragment bounds should be found whichever dimension of the
+    aggregated variable is time.
+    """
+    f = inputfield.transpose(['Y', 'T', 'X'])
+    for x, index in enumerate(range(0, 36, 12)):
+        cf.write(f[:, index:index+12], tmp_path/f'test_file{x}.nc')
+    g = cf.read(tmp_path.glob('*.nc'), cfa_write='field')[0]
+    cf.write(g, tmp_path/'test_file.cfa', cfa='field')
+
+    fields = cf.read(tmp_path/'test_file.cfa')
+    c = CFAhandler(expected_fields=len(fields))
+    key = c.parse_field_to_manifest(fields[0])
+    bounds = db2numpy(c.known_manifests[key]['bounds'])
+    tbounds = inputfield.dimension_coordinate('T').bounds.data.array
+    expected = [[tbounds[i][0], tbounds[i+11][1]] for i in range(0, 36, 12)]
+    assert np.array_equal(bounds, expected)
+
+
+def test_cfa_reader(tmp_path, inputfield):
+    """
+    The reader should find the same fragments as cf-python does (here with relative
+    locations), and variables sharing fragment variables should share the results.
+    """
+    other = inputfield.copy()
+    other.standard_name = 'air_temperature'
+    other.nc_set_variable('ta')
+    for x, index in enumerate(range(0, 36, 12)):
+        cf.write([inputfield[index:index+12], other[index:index+12]], tmp_path/f'test_file{x}.nc')
+    g = cf.read(tmp_path.glob('*.nc'), cfa_write='field')
+    cfa_file = tmp_path/'test_file.cfa'
+    cf.write(g, cfa_file, cfa={'constructs':'field', 'uri':'relative'})
+
+    reader = CFAReader(cfa_file)
+    fields = cf.read(cfa_file)
+    assert len(fields) == 2
+    for f in fields:
+        expected = sorted(x for x in f.get_filenames() if Path(x).suffix != '.cfa')
+        assert reader.fragments(f.nc_get_variable()) == expected
+    ncvars = [f.nc_get_variable() for f in fields]
+    assert reader.fragments(ncvars[0]) is reader.fragments(ncvars[1])
+    assert reader.manikey(ncvars[0]) == reader.manikey(ncvars[1])
+    assert list(reader.fragment_sizes(ncvars[0], 'time')) == [12, 12, 12]
+
+    c = CFAhandler(expected_fields=len(fields), cfa_file=cfa_file)
+    keys = {c.parse_field_to_manifest(f) for f in fields}
+    assert len(keys) == 1
+    assert len(c.known_manifests) == 1
+
+
+def test_bounds_encoding():
+    """
+    Bounds should round trip exactly through each encoding, uncompressed blobs
+    should decode without copying, and blobs in the old format should still be read.
+    """
+    edges = 1.5 + 30*np.arange(1201, dtype='f8')
+    bounds = np.column_stack((edges[:-1], edges[1:]))
+    blobs = {c: numpy2db(bounds, compression=c) for c in [None, 'zlib', 'delta']}
+    for c, blob in blobs.items():
+        decoded = db2numpy(blob)
+        assert decoded.dtype == bounds.dtype
+        assert np.array_equal(decoded, bounds)
+        assert not is_legacy_blob(blob)
+        assert blob_compression(blob) == c
+    assert len(blobs['delta']) < len(blobs['zlib']) < len(blobs[None])
+
+    view = db2numpy(blobs[None])
+    assert not view.flags.owndata and not view.flags.writeable
+    assert np.array_equal(db2numpy(memoryview(blobs[None])), bounds)
+
+    ints = np.array([[3, -4], [2**40, -2**40]], dtype='>i8')
+    assert np.array_equal(db2numpy(numpy2db(ints, compression='delta')), ints)
+
+    stream = io.BytesIO()
+    np.save(stream, bounds)
+    assert is_legacy_blob(stream.getvalue())
+    assert np.array_equal(db2numpy(stream.getvalue()), bounds)
+
+    with pytest.raises(ValueError):
+        numpy2db(bounds, compression='lzma')
+
+
+def test_coverage_analysis():
+    """
+    Gaps, overlaps, repeated, misplaced and irregular fragments should all be found.
+    """
+    from cfs.db.coverage import analyse_bounds, covers
+    edges = 10.0*np.arange(11)
+    bounds = np.column_stack((edges[:-1], edges[1:]))
+    report = analyse_bounds(bounds, step=5)
+    assert report['complete'] and (report['start'], report['end']) == (0, 100)
+
+    bad = np.array([[0, 10], [10, 20], [20, 30], [40, 50], [45, 60], [60, 70], [20, 30], [70, 80],
+                    [60, 65], [90, 103]])
+    report = analyse_bounds(bad, step=5)
+    assert report['gaps'] == [[30, 40], [80, 90]]
+    assert report['overlaps'] == [4, 8]
+    assert report['duplicates'] == [6]
+    assert report['unordered'] == [8]
+    assert report['irregular'] == [9]
+    assert not report['complete']
+    assert analyse_bounds(bad)['irregular'] is None
+
+    assert covers(0, 100, report['gaps'], 0, 30)
+    assert not covers(0, 100, report['gaps'], 25, 45)
+    assert not covers(0, 100, report['gaps'], 95, 105)
+
+
 def test_variable_manifest_linkage(cfa_only):
     """ 
     The manikey should link variables to manifests found in the cfa file
@@ -105,6 +105,9 @@ def test_fragments(django_dependencies):
 
     assert len(fragments) == 3
     assert len(files) == 1
+    # the posix accessor should have found the fragment sizes
+    for f in fragments:
+        assert f.size == Path(f.path.removeprefix('file:')).stat().st_size
 
 
 def test_manifest(django_dependencies):
@@ -115,6 +118,22 @@ def test_manifest(django_dependencies):
 
     assert manifests[0].fragment_count() == 3
 
+    # fragments come back in bounds order, and can be read by position
+    fragments = manifests[0].fragments
+    names = [f.name for f in fragments.ordered_files()]
+    assert names == ['test_file0.nc', 'test_file1.nc', 'test_file2.nc']
+    assert [f.name for f in fragments.ordered_files(1, 3)] == names[1:3]
+    assert [f.name for f in fragments.files_at([0, 2])] == [names[0], names[2]]
+
+    # the same files in another order are another file set
+    from cfs.models import FileSet
+    files = list(fragments.ordered_files())
+    reverse, created = FileSet.get_or_create_from_files(files[::-1])
+    assert created and reverse != fragments
+    assert [f.name for f in reverse.ordered_files()] == names[::-1]
+    assert [f.name for f in fragments.ordered_files()] == names
+    reverse.delete()
+
 
 def test_variable(django_dependencies):
 
@@ -128,6 +147,84 @@ def test_variable(django_dependencies):
     m = test_db.manifest.all()[0]
     assert v.in_manifest == m
 
+def test_manifest_download(django_dependencies):
+    """
+    Manifests should download as streams of fragment names, as text for
+    one manifest, and as a zip otherwise.
+    """
+    import io, zipfile
+    from gui.views.collections import get_manifests, _stream_zip
+    test_db, ignore, ignore = django_dependencies
+    c = test_db.collection.retrieve(name='posix_cfa_example')
+    m = test_db.manifest.all()[0]
+    names = ['test_file0.nc', 'test_file1.nc', 'test_file2.nc']
+    assert list(m.fragment_names(chunk_size=2)) == names
+    assert m.fragments_as_text() == '\n'.join(names)
+
+    response = get_manifests(None, c.id)
+    assert response.streaming
+    assert b''.join(response.streaming_content).decode() == '\n'.join(names)
+
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(_stream_zip('zipped', [m]))))
+    assert archive.testzip() is None
+    assert archive.namelist() == [f'zipped_manifest_{m.id}.txt']
+    assert archive.read(archive.namelist()[0]).decode() == '\n'.join(names)
+
+
+def test_quark_range(django_dependencies):
+    """
+    The fragments and bounds found for a quark should be the same as those
+    found by subspacing a cf field with the manifest bounds.
+    """
+    from cfs.db.cfa_tools import cf_cells_overlap, db2numpy, get_quark_range
+    test_db, ignore, ignore = django_dependencies
+    m = test_db.manifest.all()[0]
+    units = cf.Units(m.units, calendar=m.calendar)
+    bounds = db2numpy(m.bounds)
+    fld = cf.Field()
+    axis = fld.set_construct(cf.DomainAxis(len(bounds)))
+    fld.set_data(np.arange(len(bounds)), axes=axis)
+    fld.set_construct(cf.DimensionCoordinate(properties={'standard_name':'time', 'units':units},
+                                             data=np.mean(bounds, axis=1), bounds=cf.Bounds(data=bounds)),
+                      axes=axis)
+    # dates given in other units should be converted
+    other = cf.Units('hours since 1950-01-01', calendar=m.calendar)
+    for start, end in [((1959, 12, 15), (1962, 11, 15)), ((1960, 5, 15), (1961, 9, 15)),
+                       ((1960, 12, 1), (1960, 12, 1)), ((1961, 1, 1), (1962, 11, 30))]:
+        start_date = cf.Data(cf.dt(*start), units=other)
+        end_date = cf.Data(cf.dt(*end), units=units)
+        quark = fld.subspace(time=cf_cells_overlap(start_date, end_date))
+        first, stop, qbounds = get_quark_range(m, start_date, end_date)
+        assert list(range(first, stop)) == quark.data.array.tolist()
+        assert np.array_equal(qbounds, quark.dimension_coordinate('T').bounds.data.array)
+    with pytest.raises(ValueError):
+        get_quark_range(m, cf.Data(cf.dt(1950, 1, 1), units=units), cf.Data(cf.dt(1961, 1, 1), units=units))
+
+
+def test_migrate_bounds(django_dependencies):
+    """
+    Bounds stored in the original format should be rewritten in
+    the compact one, with the same values.
+    """
+    import io
+    from cfs.db.cfa_tools import db2numpy, is_legacy_blob
+    test_db, ignore, ignore = django_dependencies
+    m = test_db.manifest.all()[0]
+    bounds = db2numpy(m.bounds)
+    stream = io.BytesIO()
+    np.save(stream, bounds)
+    m.bounds = stream.getvalue()
+    m.save()
+    assert test_db.manifest.migrate_bounds() == 1
+    assert test_db.manifest.migrate_bounds() == 0
+    m.refresh_from_db()
+    assert not is_legacy_blob(m.bounds)
+    assert np.array_equal(db2numpy(m.bounds), bounds)
+    assert test_db.manifest.migrate_bounds(compression='delta', force=True) == 1
+    m.refresh_from_db()
+    assert np.array_equal(db2numpy(m.bounds), bounds)
+
+
 def test_tdquarking(django_dependencies):
     test_db, ignore, ignore = django_dependencies
     v = test_db.variable.all()[0]
@@ -211,3 +308,208 @@ def test_deletion(django_dependencies):
    
 
 
+
+
+def test_shared_manifest(django_dependencies, cfa_resources):
+    """
+    A second CFA file aggregating the same fragments should share the
+    manifest, which should outlive whichever file is removed first.
+    """
+    import shutil
+    posix_path = cfa_resources
+    test_db, p, ignore = django_dependencies
+    copy_path = posix_path.parent/'cfa_copy'
+    copy_path.mkdir()
+    shutil.copy(posix_path/'test_file.cfa', copy_path/'copy_file.cfa')
+    for name, path in [('cfa_first', posix_path), ('cfa_second', copy_path)]:
+        p.add_collection(str(path), name, 'one aggregated variable', regex='*.cfa', intent='C')
+
+    assert test_db.manifest.count() == 1
+    m = test_db.manifest.all()[0]
+    assert m.manikey is not None and m.bounds_hash is not None
+    assert set(v.in_manifest for v in test_db.variable.all()) == {m}
+    assert test_db.file.findall_by_type('F').count() == 3
+
+    test_db.collection.delete('cfa_first', force=True)
+    v = test_db.variable.all()[0]
+    assert v.in_manifest == m
+    assert v.in_manifest.cfa_file.name == 'copy_file.cfa'
+    assert test_db.file.findall_by_type('F').count() == 3
+
+    test_db.collection.delete('cfa_second', force=True)
+    assert test_db.manifest.count() == 0
+    assert test_db.file.findall_by_type('F').count() == 0
+    assert test_db.file.findall_by_type('C').count() == 0
+
+
+def test_bulk_fragments(django_dependencies):
+    """
+    Fragment files should be found or created, and put in their locations, with a
+    number of queries which does not depend on the number of fragments, and
+    each file should end up in the location given by its own base.
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from cfs.db.cfa_tools import numpy2db
+    test_db, p, ignore = django_dependencies
+    cfa = test_db.file.create({'name':'bulk.cfa','path':'/bulk/bulk.cfa','size':10,'type':'C','location':'bulk_a'})
+    existing = test_db.file.create({'name':'f0.nc','path':'/bulk/f0.nc','size':5,'type':'F','location':'bulk_a'})
+    test_db.location.get_or_create('bulk_b')
+
+    def manifest(n, start):
+        fragments = {}
+        for i in range(start, start+n):
+            path = f'/bulk/f{i}.nc'
+            fragments[path] = {'name':f'f{i}.nc','path':path,'size':5,'type':'F',
+                               'base':['bulk_a','bulk_b'][i%2]}
+        bounds = np.column_stack((np.arange(n), np.arange(1, n+1))).astype('f8')
+        return {'cfa_file':cfa, 'fragments':fragments, 'bounds':numpy2db(bounds),
+                'units':'days since 2000-01-01', 'calendar':'standard', '_bounds_ncvar':'time_bnds'}
+
+    queries = []
+    for n, start in [(4, 0), (40, 100)]:
+        with CaptureQueriesContext(connection) as context:
+            m = test_db.manifest.add(manifest(n, start))
+        queries.append(len(context))
+        files = list(m.fragments.ordered_files())
+        assert [f.name for f in files] == [f'f{i}.nc' for i in range(start, start+n)]
+        for i, f in zip(range(start, start+n), files):
+            assert [l.name for l in f.locations.all()] == [['bulk_a','bulk_b'][i%2]]
+    assert queries[0] == queries[1]
+
+    # the existing file was used, and the locations hold the new copies
+    assert test_db.file.retrieve(name='f0.nc', path='/bulk/f0.nc').id == existing.id
+    assert test_db.location.retrieve('bulk_a').volume == 10 + 5*(2+20)
+    assert test_db.location.retrieve('bulk_b').volume == 5*(2+20)
+
+    for m in test_db.manifest.all():
+        m.delete()
+    assert test_db.location.retrieve('bulk_a').volume == 10
+    assert test_db.location.retrieve('bulk_b').volume == 0
+    test_db.file.delete_with_variables(cfa)
+    for name in ['bulk_a', 'bulk_b']:
+        test_db.location.delete(name)
+
+
+def test_growing_aggregation(django_dependencies, tmp_path, inputfield):
+    """
+    When fragments are appended to a CFA file, an update should extend the stored
+    manifest and time domain in place, giving the same result as a fresh upload.
+    """
+    from cfs.db.cfa_tools import db2numpy
+    from cfs.db.cfparsing import parse_file_todict
+    from cfs.db.parse_cache import ParseCache
+    test_db, p, ignore = django_dependencies
+    for x, index in enumerate(range(0, 36, 12)):
+        cf.write(inputfield[index:index+12], tmp_path/f'fragment{x}.nc')
+    def aggregate(n):
+        fragments = [tmp_path/f'fragment{x}.nc' for x in range(n)]
+        g = cf.read(fragments, cfa_write='field')[0]
+        cf.write(g, tmp_path/'growing.cfa', cfa='field')
+
+    aggregate(2)
+    p.add_collection(str(tmp_path), 'growing_cfa', 'a growing aggregation', regex='*.cfa', intent='C')
+    c = test_db.collection.retrieve(name='growing_cfa')
+    v = c.variables.get()
+    m = v.in_manifest
+    ending, old_size = v.time_domain.ending, v.in_file.size
+    volume = test_db.location.retrieve('vftesting').volume
+
+    # the file is parsed once, as for any other upload (here, through a parse cache)
+    aggregate(3)
+    cache = ParseCache(tmp_path/'parse_cache')
+    outcome = p.update_collection('growing_cfa', parse_cache=cache)
+    assert cache.misses == 1
+    assert [Path(x).name for x in outcome['extended']] == ['growing.cfa']
+    assert outcome['changed'] == []
+    v2 = c.variables.get()
+    assert v2.id == v.id and v2.in_manifest.id == m.id
+    assert v2.time_domain.ending > ending
+    assert [f.name for f in v2.in_manifest.fragments.ordered_files()] == [f'fragment{x}.nc' for x in range(3)]
+    size = (tmp_path/'growing.cfa').stat().st_size
+    assert v2.in_file.size == size
+    assert test_db.location.retrieve('vftesting').volume == volume - old_size + size
+
+    # just as if it had been uploaded like this
+    descriptions, manifests, nfields, timer = parse_file_todict(tmp_path/'growing.cfa', cfa=True)
+    fresh = manifests[descriptions[0]['manikey']]
+    assert v2.in_manifest.manikey == fresh['manikey']
+    assert np.array_equal(db2numpy(v2.in_manifest.bounds), db2numpy(fresh['bounds']))
+    assert test_db.tdomain.get_or_create(descriptions[0]['time_domain']) == v2.time_domain
+
+    # a shorter aggregation is not an extension, so is uploaded again
+    aggregate(1)
+    outcome = p.update_collection('growing_cfa')
+    assert outcome['extended'] == [] and len(outcome['changed']) == 1
+    assert c.variables.get().in_manifest.fragment_count() == 1
+    test_db.collection.delete('growing_cfa', force=True)
+    assert test_db.manifest.count() == 0
+
+
+def test_growing_edited_aggregation(django_dependencies, tmp_path, inputfield):
+    """
+    An aggregation which has grown, but whose metadata has also been edited, is not an
+    extension, so should be uploaded again (and the edit kept).
+    """
+    test_db, p, ignore = django_dependencies
+    for x, index in enumerate(range(0, 36, 12)):
+        cf.write(inputfield[index:index+12], tmp_path/f'fragment{x}.nc')
+    def aggregate(n, **properties):
+        fragments = [tmp_path/f'fragment{x}.nc' for x in range(n)]
+        g = cf.read(fragments, cfa_write='field')[0]
+        g.set_properties(properties)
+        cf.write(g, tmp_path/'edited.cfa', cfa='field')
+
+    aggregate(2)
+    p.add_collection(str(tmp_path), 'edited_cfa', 'an edited aggregation', regex='*.cfa', intent='C')
+    c = test_db.collection.retrieve(name='edited_cfa')
+    v = c.variables.get()
+    manifests = test_db.manifest.count()
+
+    aggregate(3, long_name='an edited long name')
+    outcome = p.update_collection('edited_cfa', workers=2)
+    assert outcome['extended'] == []
+    assert [Path(x).name for x in outcome['changed']] == ['edited.cfa']
+    v2 = c.variables.get()
+    assert v2.id != v.id
+    assert v2.get_kp('long_name') == 'an edited long name'
+    assert v2.in_manifest.fragment_count() == 3
+    # and nothing was left behind by the attempt to extend it
+    assert test_db.manifest.count() == manifests
+    test_db.collection.delete('edited_cfa', force=True)
+    assert test_db.manifest.count() == 0
+
+
+def test_coverage(django_dependencies, tmp_path, inputfield):
+    """
+    The coverage of the manifests in a collection should be analysed and kept on the
+    manifests, and questions about coverage answered from that.
+    """
+    test_db, p, ignore = django_dependencies
+    # the first and last years only
+    for x in [0, 2]:
+        cf.write(inputfield[12*x:12*x+12], tmp_path/f'fragment{x}.nc')
+    g = cf.read(tmp_path.glob('fragment*.nc'), cfa_write='field')[0]
+    cf.write(g, tmp_path/'gappy.cfa', cfa='field')
+    p.add_collection(str(tmp_path), 'gappy_cfa', 'an aggregation with a gap', regex='*.cfa', intent='C')
+
+    m = test_db.manifest.all().get()
+    # a summary is made on upload, without the time step
+    assert m.coverage['irregular'] is None and len(m.coverage['gaps']) == 1
+
+    reports = test_db.collection.coverage('gappy_cfa', (1, 1, 1960), (1, 1, 1962))
+    report = reports[m.id]
+    assert report['fragments'] == 2 and report['irregular'] == [] and not report['covers']
+    assert not report['complete']
+    units = cf.Units(m.units, calendar=m.calendar)
+    gap = cf.Data(report['gaps'][0], units=units).datetime_array
+    assert [(d.year, d.month) for d in gap] == [(1960, 12), (1961, 12)]
+
+    m.refresh_from_db()
+    assert m.coverage == {'gaps':report['gaps'], 'overlaps':0, 'duplicates':0, 'unordered':0,
+                          'irregular':0, 'complete':False}
+    assert test_db.manifest.covers(m, (1, 1, 1960), (1, 6, 1960))
+    assert test_db.manifest.covers(m, (1, 1, 1962), (1, 11, 1962))
+    assert not test_db.manifest.covers(m, (1, 6, 1960), (1, 6, 1961))
+    assert not test_db.manifest.covers(m, (1, 1, 1950), (1, 6, 1960))
+    test_db.collection.delete('gappy_cfa', force=True)
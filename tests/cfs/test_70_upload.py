@@ -1,4 +1,8 @@
 import cf
+import io
+import json
+import os
+import shutil
 import pytest
 from pathlib import Path
 
@@ -104,6 +108,160 @@ def test_posix_class_nested(django_dependencies, posix_nest):
     assert rout+rin == 2
 
 
+def test_parallel_parsing(django_dependencies, posix_info):
+    """
+    Parsing in worker processes should give the same content as parsing
+    in the writing process.
+    """
+    posix_path, s = posix_info
+    test_db, p, ignore = django_dependencies
+    p.add_collection(
+        str(posix_path),
+        'parallel_test_collection',
+        'collection of variables from the test data',
+        workers=2, commit_every=2, profile=posix_path.parent/'profile.json')
+    c1 = test_db.collection.retrieve(name='parallel_test_collection')
+    assert set([x.get_kp('standard_name') for x in c1.variables.all()]) == set(VARIABLE_LIST)
+    # the stage timings should have come back from the workers
+    profile = json.loads((posix_path.parent/'profile.json').read_text())
+    assert profile['files'] == profile['fields'] == 3
+    for stage in ['cf_read', 'properties', 'extract_cfstemporal', 'extract_cfsdomain', 'db_write']:
+        assert profile['stages'][stage]['total'] > 0
+    assert profile['queries']['total'] > 0
+    assert profile['commits']['count'] == 2
+    assert len(profile['slowest_files']) == 3
+    test_db.collection.delete(c1.name, force=True)
+
+
+def test_update_collection(django_dependencies, posix_info, inputfield):
+    """
+    A re-scan should only pick up new and changed files, and remove
+    those which have gone away.
+    """
+    posix_path, s = posix_info
+    test_db, p, ignore = django_dependencies
+    p.add_collection(str(posix_path), 'update_test_collection', 'will be updated')
+    c1 = test_db.collection.retrieve(name='update_test_collection')
+    assert c1.variables.count() == 3
+
+    outcome = p.update_collection('update_test_collection')
+    assert len(outcome['unchanged']) == 3
+    assert outcome['new'] == outcome['changed'] == outcome['vanished'] == []
+
+    (posix_path/'test_file0.nc').unlink()
+    inputfield.standard_name = 'eastward_wind'
+    cf.write([inputfield,], posix_path/'test_file1.nc')
+    inputfield.standard_name = 'northward_wind'
+    cf.write([inputfield,], posix_path/'test_file3.nc')
+
+    outcome = p.update_collection('update_test_collection')
+    assert [Path(x).name for x in outcome['new']] == ['test_file3.nc']
+    assert [Path(x).name for x in outcome['changed']] == ['test_file1.nc']
+    assert [Path(x).name for x in outcome['vanished']] == ['test_file0.nc']
+    assert set([x.get_kp('standard_name') for x in c1.variables.all()]) == set(
+        [VARIABLE_LIST[2], 'eastward_wind', 'northward_wind'])
+    test_db.collection.delete(c1.name, force=True)
+
+
+def test_update_failure(django_dependencies, posix_info):
+    """
+    If a changed file can't be parsed, the update should fail without
+    losing what we already knew about that file.
+    """
+    posix_path, s = posix_info
+    test_db, p, ignore = django_dependencies
+    p.add_collection(str(posix_path), 'failing_update_collection', 'will not be updated')
+    c1 = test_db.collection.retrieve(name='failing_update_collection')
+    before = set([x.get_kp('standard_name') for x in c1.variables.all()])
+
+    (posix_path/'test_file1.nc').write_bytes(b'still being written')
+    with pytest.raises(Exception):
+        p.update_collection('failing_update_collection')
+    assert set([x.get_kp('standard_name') for x in c1.variables.all()]) == before
+    assert 'test_file1.nc' in [f.name for f in test_db.file.in_collection(c1, p.location)]
+    test_db.collection.delete(c1.name, force=True)
+
+
+def test_file_list(django_dependencies, posix_info, monkeypatch):
+    """
+    We should be able to use a precomputed list of files (from a text file
+    or standard input) rather than walking the directory tree.
+    """
+    posix_path, s = posix_info
+    test_db, p, ignore = django_dependencies
+    listing = posix_path.parent/'listing.txt'
+    listing.write_text(f'# some files\n{posix_path}/test_file0.nc\n\ntest_file2.nc\nnotthere.nc\n')
+    p.add_collection(str(posix_path), 'listed_test_collection', 'from a file list', file_list=listing)
+    c1 = test_db.collection.retrieve(name='listed_test_collection')
+    assert set([x.get_kp('standard_name') for x in c1.variables.all()]) == set(
+        [VARIABLE_LIST[0], VARIABLE_LIST[2]])
+
+    monkeypatch.setattr('sys.stdin', io.StringIO('test_file1.nc\n'))
+    outcome = p.update_collection('listed_test_collection', file_list='-')
+    assert [Path(x).name for x in outcome['new']] == ['test_file1.nc']
+    assert len(outcome['vanished']) == 2
+    assert set([x.get_kp('standard_name') for x in c1.variables.all()]) == set([VARIABLE_LIST[1]])
+    test_db.collection.delete(c1.name, force=True)
+
+
+def test_parse_cache(django_dependencies, posix_info, tmp_path):
+    """
+    A second ingest of the same files should take the parse results
+    from the cache, and give the same variables.
+    """
+    from cfs.db.parse_cache import ParseCache
+    posix_path, s = posix_info
+    test_db, p, ignore = django_dependencies
+    for workers in [1, 2]:
+        cache = ParseCache(tmp_path/'parse_cache')
+        p.add_collection(str(posix_path), 'cached_test_collection', 'parsed via a cache',
+                         parse_cache=cache, workers=workers)
+        c1 = test_db.collection.retrieve(name='cached_test_collection')
+        assert set([x.get_kp('standard_name') for x in c1.variables.all()]) == set(VARIABLE_LIST)
+        test_db.collection.delete(c1.name, force=True)
+        assert (cache.hits, cache.misses) == ((0, 3) if workers == 1 else (3, 0))
+
+    # keys depend on file modification and fixer version
+    def fixer(f, path):
+        pass
+    path = posix_path/'test_file0.nc'
+    key = cache.key(path)
+    fixed = cache.key(path, fixer=fixer)
+    assert fixed != key
+    fixer.version = 2
+    assert cache.key(path, fixer=fixer) != fixed
+    os.utime(path, (0, 0))
+    assert cache.key(path) != key
+
+    # and the cache is kept within its size limit
+    small = ParseCache(tmp_path/'parse_cache', max_bytes=cache.size//2)
+    small.put(small.key(path), ([], {}, 0))
+    assert small.size <= cache.size//2
+
+
+def test_fast_parsing(django_dependencies, posix_info):
+    """
+    Parsing from the netCDF headers should give exactly the same
+    database content as parsing with cf-python.
+    """
+    posix_path, s = posix_info
+    test_db, p, ignore = django_dependencies
+    copy_path = posix_path.parent/'posix_copy'
+    shutil.copytree(posix_path, copy_path)
+    rows = {}
+    for fast, path in [(False, posix_path), (True, copy_path)]:
+        name = f'fast_{fast}_test_collection'
+        p.add_collection(str(path), name, 'parsed fast or not', fast=fast)
+        c = test_db.collection.retrieve(name=name)
+        rows[fast] = sorted([(v.in_file.name, v.key_properties_id, v.spatial_domain_id, v.time_domain_id,
+                              v.cell_methods_id, json.dumps(v._proxied, sort_keys=True))
+                             for v in c.variables.all()])
+    assert len(rows[True]) == 3
+    assert rows[True] == rows[False]
+    for fast in [False, True]:
+        test_db.collection.delete(f'fast_{fast}_test_collection', force=True)
+
+
 def test_deleting_collections(django_dependencies):
     """
     We should be able to empty all those subcollections which have no files
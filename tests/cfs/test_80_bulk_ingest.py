@@ -0,0 +1,149 @@
+from cfs.db.cfparsing import parse_fields_todict
+from cfs.db.standalone import setup_django
+from pathlib import Path
+
+import cf
+import pytest
+
+###
+### This test file concentrates on the set based (bulk) variable ingest
+###
+
+@pytest.fixture(scope="module", autouse=True)
+def setup_test_db(tmp_path_factory, request):
+    """
+    Get ourselves a db to work with. Note that this database is progressively
+    modified by all the tests that follow. So if you're debugging tests, you
+    have to work though them consecutively.
+    """
+    module_name = request.module.__name__  # Get the module (test file) name
+    tmp_path = tmp_path_factory.mktemp(module_name)  # Create a unique temp directory for the module
+    dbfile = str(Path(tmp_path) / f'{module_name}.db')
+    migrations_location = str(Path(tmp_path)/'migrations')
+    setup_django(db_file=dbfile,  migrations_location=migrations_location)
+    yield # This marks the end of the setup phase and begins the test execution
+
+@pytest.fixture
+def test_db():
+    from cfs.db.interface import CollectionDB
+    return CollectionDB()
+
+@pytest.fixture
+def several_fields(inputfield):
+    """ A few fields which share domains and cell methods, but not identities """
+    fields = []
+    for name in ['air_temperature','specific_humidity','air_potential_temperature']:
+        f = inputfield.copy()
+        f.standard_name = name
+        fields.append(f)
+    f = inputfield.copy()
+    f.standard_name = 'eastward_wind'
+    f.set_property('grid', 'another grid')
+    fields.append(f)
+    return fields
+
+def _rows(variables):
+    """ Everything that makes a variable row, apart from the file it is in """
+    return sorted([(v.key_properties_id, v.spatial_domain_id, v.time_domain_id,
+                    v.cell_methods_id, str(sorted(v._proxied.items()))) for v in variables])
+
+def test_bulk_matches_serial(test_db, several_fields):
+    """
+    Loading the same descriptions with both paths should produce the
+    same rows (and reuse all the same shared entities).
+    """
+    test_db.location.create('bulkloc')
+    c = test_db.collection.create(name='bulkcol')
+    results = {}
+    for bulk in [False, True]:
+        descriptions, _ = parse_fields_todict(several_fields)
+        properties = {'name':f'bulk_{bulk}','path':'/nowhere/','size':10,'location':'bulkloc'}
+        filedata = {'properties':properties, 'variables':descriptions}
+        results[bulk] = test_db.upload_file_to_collection('bulkloc', c.name, filedata, bulk=bulk)
+        if not bulk:
+            counts = [m.objects.count() for m in [test_db.xydomain.model, test_db.tdomain.model,
+                                                  test_db.cell.model]]
+    assert _rows(results[True]) == _rows(results[False])
+    assert counts == [m.objects.count() for m in [test_db.xydomain.model, test_db.tdomain.model,
+                                                  test_db.cell.model]]
+    assert c.variables.count() == 8
+    v = test_db.variable.retrieve_by_properties({'standard_name':'eastward_wind'}, from_collection=c)
+    assert len(v) == 2
+
+def test_bulk_rejects_duplicates(test_db, several_fields):
+    descriptions, _ = parse_fields_todict(several_fields[0:1])
+    f = test_db.file.retrieve(name='bulk_True')
+    descriptions[0]['in_file'] = f
+    with pytest.raises(PermissionError):
+        test_db.variable.bulk_create(descriptions)
+    existing = test_db.variable.bulk_create(descriptions, unique=False)
+    assert existing[0].in_file == f
+
+def test_failed_upload_rolls_back(test_db, several_fields):
+    """
+    A failure part way through a file upload should leave nothing
+    behind, including the change to the location volume.
+    """
+    volume = test_db.location.retrieve('bulkloc').volume
+    nvars = test_db.variable.count()
+    descriptions, _ = parse_fields_todict(several_fields)
+    descriptions[-1].pop('identity')
+    properties = {'name':'bulk_broken','path':'/nowhere/','size':10,'location':'bulkloc'}
+    filedata = {'properties':properties, 'variables':descriptions}
+    for bulk in [True, False]:
+        with pytest.raises(ValueError):
+            test_db.upload_file_to_collection('bulkloc', 'bulkcol', filedata.copy(), bulk=bulk)
+        assert test_db.file.retrieve_all(name='bulk_broken').count() == 0
+        assert test_db.location.retrieve('bulkloc').volume == volume
+        assert test_db.variable.count() == nvars
+
+def test_interning_session(test_db, several_fields):
+    """
+    Inside an interning session repeated entities should come from the caches,
+    which are emptied when the session ends.
+    """
+    from cfs.db import interning
+    with interning.session():
+        for bulk in [False, True]:
+            descriptions, _ = parse_fields_todict(several_fields)
+            properties = {'name':f'bulk_interned_{bulk}','path':'/nowhere/','size':10,'location':'bulkloc'}
+            filedata = {'properties':properties, 'variables':descriptions}
+            test_db.upload_file_to_collection('bulkloc', 'bulkcol', filedata, bulk=bulk)
+        stats = interning.cache_stats()
+        assert stats['domain']['hits'] > 0
+        assert stats['variable_property']['hits'] > 0
+        assert stats['cell_method_set']['size'] == 1
+    assert all(s['size'] == 0 for s in interning.cache_stats().values())
+    # and outside a session, nothing is cached
+    test_db.xydomain.get_or_create(descriptions[0]['spatial_domain'])
+    assert interning.cache_stats()['domain']['hits'] == stats['domain']['hits']
+
+def test_interning_rollback(test_db, several_fields):
+    """
+    Entities created in a transaction which is rolled back must not be
+    reused from the caches.
+    """
+    from cfs.db import interning
+    with interning.session():
+        for name, broken in [('bulk_rolled_back', True), ('bulk_after_rollback', False)]:
+            descriptions, _ = parse_fields_todict(several_fields)
+            for d in descriptions:
+                d['spatial_domain']['name'] = 'rollback_domain'
+            if broken:
+                descriptions[-1].pop('identity')
+            properties = {'name':name,'path':'/nowhere/','size':10,'location':'bulkloc'}
+            filedata = {'properties':properties, 'variables':descriptions}
+            if broken:
+                with pytest.raises(ValueError):
+                    test_db.upload_file_to_collection('bulkloc', 'bulkcol', filedata, bulk=False)
+                assert test_db.xydomain.retrieve_by_name('rollback_domain') is None
+            else:
+                variables = test_db.upload_file_to_collection('bulkloc', 'bulkcol', filedata)
+    d = test_db.xydomain.retrieve_by_name('rollback_domain')
+    assert all(v.spatial_domain == d for v in variables)
+
+def test_bulk_cleanup(test_db):
+    c = test_db.collection.retrieve(name='bulkcol')
+    test_db.collection.delete(c, force=True)
+    assert test_db.variable.retrieve_all(in_file__name__startswith='bulk_').count() == 0
+    assert test_db.file.retrieve_all(name__startswith='bulk_').count() == 0
@@ -107,7 +107,7 @@ def test_quarks(django_dependencies):
     assert quark.is_quark is True
     print(quark)
     expected = 'cn134a_999_u_mon__197012-197012.nc'
-    fragments = list(quark.fragments.files.all())
+    fragments = list(quark.fragments.ordered_files())
     assert expected == fragments[-1].name
 
 